@@ -0,0 +1,200 @@
+"""Headless benchmarks of the game scene.
+
+Times terrain rendering up close and zoomed out, minimap rendering, tile
+and mob searches and mob updates over a range of map sizes and mob
+counts, rendering and tile searches on chunked terrain as well (the
+_chunked results), and writes the results as JSON:
+
+    python benchmark.py --out bench.json
+    python benchmark.py --sizes 64 256 --mobs 10 1000
+    python benchmark.py --mob-processes 16
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+import pygame
+
+import main
+from gamesystem import mobsim
+
+DEFAULT_SIZES = [64, 256, 1024]
+DEFAULT_MOB_COUNTS = [10, 100, 1000, 10000]
+
+
+def measure(func, min_time=0.2, max_repeats=50):
+    """Call func until min_time has passed or max_repeats is reached and
+    return the timings in seconds.
+    """
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_repeats and (
+            not timings or time.perf_counter() - started < min_time):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def result(name, timings, **params):
+    return dict(name=name, **params, repeats=len(timings),
+                mean_s=sum(timings) / len(timings), min_s=min(timings),
+                max_s=max(timings))
+
+
+def build_scene(game, size, seed, vectorized_mobs=False, mob_processes=0,
+                chunked_terrain=False):
+    """A GameScene on a size x size map with seeded water and trees"""
+    rng = random.Random(seed)
+    scene = main.GameScene(game.sm, vectorized_mobs=vectorized_mobs,
+                           seed=seed, map_width=size, map_height=size,
+                           mob_processes=mob_processes,
+                           chunked_terrain=chunked_terrain)
+    terrain = scene.terrain
+    with terrain.history.paused():
+        for _ in range(size * size // 256):
+            terrain.fill_map(0, rng.randrange(size), rng.randint(1, 8),
+                             rng.randrange(size), rng.randint(1, 8), "Water")
+        tree_id = terrain.tile_id_assign["Tree"]
+        for _ in range(size * size // 20):
+            terrain.map.set(3, rng.randrange(size), rng.randrange(size),
+                            tree_id)
+        terrain.notify_write(3, 0, 0, size, size)
+    return scene
+
+
+def spawn_mobs(scene, count, seed):
+    rng = random.Random(seed)
+    world_size = scene.MAP_WIDTH * scene.TILESIZE, \
+        scene.MAP_HEIGHT * scene.TILESIZE
+    for _ in range(count):
+        scene.mob_group.add(main.HumanSprite(
+            rng.randrange(world_size[0]), rng.randrange(world_size[1]),
+            scene.terrain, sim=scene.mob_sim))
+
+
+def bench_size(game, size, mob_counts, seed, min_time, mob_processes=0):
+    results = []
+    scene = build_scene(game, size, seed)
+    chunked_scene = build_scene(game, size, seed, chunked_terrain=True)
+    parallel_scene = (build_scene(game, size, seed,
+                                  mob_processes=mob_processes)
+                      if mob_processes else None)
+
+    for suffix, terrain_scene in (("", scene), ("_chunked", chunked_scene)):
+        def render_terrain_cold():
+            terrain_scene.terrain_chunks.clear()
+            terrain_scene.render_terrain(terrain_scene.terrain.map)
+        results.append(result("render_terrain_cold" + suffix,
+                              measure(render_terrain_cold, min_time),
+                              map_size=size))
+        results.append(result(
+            "render_terrain_warm" + suffix,
+            measure(lambda: terrain_scene.render_terrain(
+                terrain_scene.terrain.map), min_time),
+            map_size=size))
+
+    def render_terrain_zoomed_out():
+        scene.terrain_pyramid.render(
+            game.sm.screen, scene.terrain.map, scene.zoom,
+            scene.level_viewport(), (scene.MAP_VIEWER_X, scene.MAP_VIEWER_Y))
+    scene.set_zoom(main.MAX_ZOOM, (scene.MAP_VIEWER_X, scene.MAP_VIEWER_Y))
+    # the first frames build the pyramid cells in view
+    measure(render_terrain_zoomed_out, min_time)
+    results.append(result("render_terrain_zoomed_out",
+                          measure(render_terrain_zoomed_out, min_time),
+                          map_size=size, zoom=scene.zoom))
+    scene.set_zoom(0, (scene.MAP_VIEWER_X, scene.MAP_VIEWER_Y))
+    results.append(result(
+        "render_minimap",
+        measure(lambda: scene.render_minimap(scene.terrain.map), min_time),
+        map_size=size))
+
+    for count in mob_counts:
+        scene.mob_group.empty()
+        random.seed(seed)
+        spawn_mobs(scene, count, seed)
+        mobs = list(scene.mob_group)
+        results.append(result(
+            "search_tile",
+            measure(lambda: [mob.search_tile("Tree", 3) for mob in mobs],
+                    min_time),
+            map_size=size, mobs=count))
+        chunked_scene.mob_group.empty()
+        spawn_mobs(chunked_scene, count, seed)
+        chunked_mobs = list(chunked_scene.mob_group)
+        results.append(result(
+            "search_tile_chunked",
+            measure(lambda: [mob.search_tile("Tree", 3)
+                             for mob in chunked_mobs], min_time),
+            map_size=size, mobs=count))
+        results.append(result(
+            "mobs_in_sightrange",
+            measure(lambda: [mob.mobs_in_sightrange() for mob in mobs],
+                    min_time),
+            map_size=size, mobs=count))
+        results.append(result("update_mobs",
+                              measure(scene.update_mobs, min_time),
+                              map_size=size, mobs=count))
+        if mobsim.is_available():
+            vector_scene = build_scene(game, size, seed, True)
+            spawn_mobs(vector_scene, count, seed)
+            results.append(result(
+                "update_mobs_vectorized",
+                measure(vector_scene.update_mobs, min_time),
+                map_size=size, mobs=count))
+        if parallel_scene is not None:
+            parallel_scene.mob_group.empty()
+            spawn_mobs(parallel_scene, count, seed)
+            results.append(result("update_mobs_parallel",
+                                  measure(parallel_scene.update_mobs,
+                                          min_time),
+                                  map_size=size, mobs=count,
+                                  processes=mob_processes))
+    if parallel_scene is not None:
+        parallel_scene.region_sim.close()
+    chunked_scene.terrain.close_map()
+    return results
+
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=DEFAULT_SIZES, help="map widths in tiles")
+    parser.add_argument("--mobs", type=int, nargs="+",
+                        default=DEFAULT_MOB_COUNTS, help="mob counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds to repeat each measurement for")
+    parser.add_argument("--mob-processes", type=int, default=0,
+                        help="also time mob updates in this many processes")
+    parser.add_argument("--out", help="JSON file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    game = main.Game(headless=True, seed=args.seed)
+    results = []
+    for size in args.sizes:
+        results += bench_size(game, size, args.mobs, args.seed,
+                              args.min_time, args.mob_processes)
+    report = {
+        "meta": {"python": platform.python_version(),
+                 "pygame": pygame.version.ver,
+                 "platform": platform.platform(),
+                 "seed": args.seed,
+                 "mob_processes": args.mob_processes,
+                 "vectorized_mobs": mobsim.is_available()},
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,196 @@
+"""Saving worlds on a worker thread.
+
+A save takes a GridSnapshot of the tiles on the main thread, which copies
+nothing up front: it reads the live grid, except for the rows written
+since it was taken, whose old tiles the writer hands to it before
+writing them (copy on write). A ChunkedGridSnapshot does the same with
+whole chunks of a chunked grid. The BackgroundSaver thread then writes
+the file from the snapshot while the game goes on.
+"""
+import atexit
+from collections import deque
+import threading
+
+
+class GridSnapshot:
+    """Read-only view of a TileGrid as it was when taken.
+
+    capture() must be called for every region of the grid before it is
+    written while the snapshot is open. Reading from another thread is
+    safe, and close() frees the rows kept.
+    """
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.layer_num = grid.layer_num
+        self.width = grid.width
+        self.height = grid.height
+        # {(z, y): the tiles of a row before it was first written}
+        self.rows = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def __len__(self):
+        return self.layer_num
+
+    def capture(self, z, x, y, width, height):
+        x, y, width, height = self.grid.clip_region(x, y, width, height)
+        if not width or not height:
+            return
+        with self.lock:
+            if self.closed:
+                return
+            for row_y in range(y, y + height):
+                if (z, row_y) not in self.rows:
+                    self.rows[z, row_y] = self.grid.row_bytes(
+                        z, 0, row_y, self.width)
+
+    def row_bytes(self, z, x, y, width) -> bytes:
+        with self.lock:
+            row = self.rows.get((z, y))
+            if row is None:
+                return self.grid.row_bytes(z, x, y, width)
+        return row[x:x + width]
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.rows = {}
+
+
+class ChunkedGridSnapshot:
+    """Read-only view of a ChunkedTileGrid as it was when taken, saved by
+    worldfile as a chunked world.
+
+    It keeps the init values and refers to the chunks that existed, the
+    TileGrid of those in memory and the swap file of the others, and
+    copies a chunk when capture() is called before its first write.
+    Chunks created later are not part of it. Reading from another thread
+    is safe, and close() frees the copies.
+    """
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.layer_num = grid.layer_num
+        self.width = grid.width
+        self.height = grid.height
+        self.chunk_size = grid.chunk_size
+        self.init_values = list(grid.init_values)
+        # {key: the TileGrid of the chunk, the bytes of its tiles before
+        # it was first written, or None to read it from its swap file}
+        self.chunks = {}
+        for key in grid.known_chunks():
+            chunk = grid.store.peek(key)
+            self.chunks[key] = None if chunk is None else chunk.grid
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def __len__(self):
+        return self.layer_num
+
+    def capture(self, z, x, y, width, height):
+        grid = self.grid
+        with self.lock:
+            if self.closed:
+                return
+            if grid.covers_world(x, y, width, height):
+                keys = list(self.chunks)
+            else:
+                keys = grid.chunks_in_region(x, y, width, height)
+            for key in keys:
+                if key in self.chunks and not isinstance(self.chunks[key],
+                                                         bytes):
+                    self.chunks[key] = self.read_chunk(key)
+
+    def read_chunk(self, key) -> bytes:
+        """Tiles of a chunk as they were, with lock held"""
+        tiles = self.chunks[key]
+        if tiles is None:
+            return self.grid.swap_path(key).read_bytes()
+        if isinstance(tiles, bytes):
+            return tiles
+        return bytes(tiles.data)
+
+    def known_chunks(self):
+        return set(self.chunks)
+
+    def chunk_bytes(self, key) -> bytes:
+        with self.lock:
+            return self.read_chunk(key)
+
+    def row_bytes(self, z, x, y, width) -> bytes:
+        size = self.chunk_size
+        row = bytearray()
+        for chunk_x in range(x // size, (x + width - 1) // size + 1):
+            left = chunk_x * size
+            start = max(x, left)
+            end = min(x + width, left + size, self.width)
+            key = chunk_x, y // size
+            if key not in self.chunks:
+                row += bytes([self.init_values[z]]) * (end - start)
+                continue
+            chunk_width = min(size, self.width - left)
+            chunk_height = min(size, self.height - key[1] * size)
+            offset = ((z * chunk_height + y % size) * chunk_width +
+                      start - left)
+            row += self.chunk_bytes(key)[offset:offset + end - start]
+        return bytes(row)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.chunks = {}
+
+
+class BackgroundSaver:
+    """Runs save jobs one at a time on a worker thread, in order.
+
+    A job is a callable with a name, the world it saves. Jobs still
+    pending when the program exits are finished first.
+    """
+
+    def __init__(self):
+        self.jobs = deque()
+        self.condition = threading.Condition()
+        self.running = None
+        self.thread = None
+        atexit.register(self.wait)
+
+    def submit(self, name, job):
+        with self.condition:
+            self.jobs.append((name, job))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work,
+                                               name="world saver",
+                                               daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def busy(self, name):
+        """Whether a save of name is pending or running"""
+        with self.condition:
+            return (self.running == name or
+                    any(job_name == name for job_name, _ in self.jobs))
+
+    def wait(self):
+        """Block until every job submitted has run"""
+        with self.condition:
+            while self.jobs or self.running is not None:
+                self.condition.wait()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                self.running, job = self.jobs.popleft()
+            try:
+                job()
+            except Exception as e:
+                print(f"could not save world {self.running}: {e}")
+            finally:
+                # what the job holds, e.g. a snapshot, is freed now
+                job = None
+                with self.condition:
+                    self.running = None
+                    self.condition.notify_all()
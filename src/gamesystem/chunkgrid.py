@@ -0,0 +1,367 @@
+import math
+from pathlib import Path
+import shutil
+import tempfile
+import weakref
+
+from gamesystem import chunkstore
+from gamesystem import tilegrid
+from gamesystem import tileindex
+
+
+class Chunk:
+    def __init__(self, grid):
+        self.grid = grid
+        self.index = tileindex.TileIndex(grid)
+        # whether the tiles differ from the copy in the swap directory
+        self.modified = False
+
+
+class ChunkedRow:
+    def __init__(self, grid, z, y):
+        self.grid = grid
+        self.z = z
+        self.y = y
+
+    def __len__(self):
+        return self.grid.width
+
+    def __getitem__(self, x):
+        if x < 0:
+            x += self.grid.width
+        if not 0 <= x < self.grid.width:
+            raise IndexError("tile column index out of range")
+        return self.grid.get(self.z, x, self.y)
+
+    def __setitem__(self, x, value):
+        if x < 0:
+            x += self.grid.width
+        if not 0 <= x < self.grid.width:
+            raise IndexError("tile column index out of range")
+        self.grid.set(self.z, x, self.y, value)
+
+
+class ChunkedLayer:
+    def __init__(self, grid, z):
+        self.grid = grid
+        self.z = z
+
+    def __len__(self):
+        return self.grid.height
+
+    def __getitem__(self, y):
+        if y < 0:
+            y += self.grid.height
+        if not 0 <= y < self.grid.height:
+            raise IndexError("tile row index out of range")
+        return ChunkedRow(self.grid, self.z, y)
+
+
+class ChunkedTileGrid:
+    """Layered tile map split into chunk_size x chunk_size chunks.
+
+    A chunk is a small TileGrid with its own TileIndex. It is only created
+    when a tile in it is first written, so untouched parts of the world cost
+    no memory and read as the init value of their layer. Filling a whole
+    layer only changes that value and the chunks that exist. Chunks are
+    kept in an LRU ChunkStore; those over memory_budget are written to
+    swap_dir and read back when touched again. Without a swap_dir, a
+    temporary one is made and removed by close(), at the end of a with
+    block or when the grid is garbage collected.
+
+    It offers the TileGrid methods the game uses, plus any_within() and
+    nearest() of TileIndex, so it can serve as its own tile index.
+    """
+
+    def __init__(self, layer_num, height, width, init_value=0,
+                 chunk_size=64, memory_budget=64 << 20, swap_dir=None):
+        self.layer_num = layer_num
+        self.height = height
+        self.width = width
+        self.init_values = [init_value] * layer_num
+        self.chunk_size = chunk_size
+        if swap_dir is None:
+            swap_dir = tempfile.mkdtemp(prefix="boxrush-chunks-")
+            self.remove_swap_dir = weakref.finalize(
+                self, shutil.rmtree, swap_dir, True)
+        else:
+            self.remove_swap_dir = None
+        self.swap_dir = Path(swap_dir)
+        # chunks that have a copy in swap_dir
+        self.swapped = set()
+        self.store = chunkstore.ChunkStore(
+            self.load_chunk, self.unload_chunk, memory_budget,
+            layer_num * chunk_size * chunk_size)
+        self.layers = [ChunkedLayer(self, z) for z in range(layer_num)]
+        # {(width, height): chunk of init values} answering the queries on
+        # missing chunks, for blank_values
+        self.blank_chunks = {}
+        self.blank_values = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Remove the temporary swap_dir, the swapped chunks being lost"""
+        if self.remove_swap_dir is not None:
+            self.remove_swap_dir()
+            self.swapped.clear()
+
+    def __len__(self):
+        return self.layer_num
+
+    def __getitem__(self, z):
+        return self.layers[z]
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    clip_region = tilegrid.TileGrid.clip_region
+
+    def chunk_region(self, chunk_x, chunk_y):
+        """Tile region (x, y, width, height) covered by a chunk"""
+        return self.clip_region(
+            chunk_x * self.chunk_size, chunk_y * self.chunk_size,
+            self.chunk_size, self.chunk_size)
+
+    def chunks_in_region(self, x, y, width, height):
+        """Yield (chunk_x, chunk_y) of the chunks overlapping a region"""
+        x, y, width, height = self.clip_region(x, y, width, height)
+        if not width or not height:
+            return
+        size = self.chunk_size
+        for chunk_y in range(y // size, (y + height - 1) // size + 1):
+            for chunk_x in range(x // size, (x + width - 1) // size + 1):
+                yield chunk_x, chunk_y
+
+    def swap_path(self, key):
+        return self.swap_dir / "{}_{}.chunk".format(*key)
+
+    def load_chunk(self, key):
+        if key not in self.swapped:
+            return None
+        x, y, width, height = self.chunk_region(*key)
+        data = bytearray(self.swap_path(key).read_bytes())
+        return Chunk(tilegrid.TileGrid(
+            self.layer_num, height, width, data=data))
+
+    def unload_chunk(self, key, chunk):
+        if chunk.modified or key not in self.swapped:
+            self.swap_path(key).write_bytes(chunk.grid.data)
+            self.swapped.add(key)
+
+    def chunk(self, chunk_x, chunk_y, create=False) -> Chunk:
+        """The chunk at chunk coordinates, or None if it was never created.
+        With create, a missing chunk is created filled with init values.
+        """
+        key = chunk_x, chunk_y
+        chunk = self.store.get(key)
+        if chunk is None and create:
+            chunk = self.new_chunk(key)
+            self.store.add(key, chunk)
+        return chunk
+
+    def put_chunk(self, key, grid):
+        """Make a TileGrid read from elsewhere, e.g. a world file, the
+        chunk at key
+        """
+        chunk = Chunk(grid)
+        chunk.modified = True
+        self.store.add(key, chunk)
+
+    def chunk_bytes(self, key) -> bytes:
+        """Tiles of the chunk at key, layer by layer"""
+        return bytes(self.chunk(*key).grid.data)
+
+    def new_chunk(self, key) -> Chunk:
+        x, y, width, height = self.chunk_region(*key)
+        grid = tilegrid.TileGrid(self.layer_num, height, width)
+        for z, value in enumerate(self.init_values):
+            grid.fill_layer(z, value)
+        return Chunk(grid)
+
+    def query_chunk(self, key) -> Chunk:
+        """The chunk to query at key: the one in the store, or for a
+        missing one a shared chunk of init values kept out of the store
+        """
+        chunk = self.store.get(key)
+        if chunk is not None:
+            return chunk
+        if self.blank_values != self.init_values:
+            self.blank_chunks.clear()
+            self.blank_values = list(self.init_values)
+        size = self.chunk_region(*key)[2:]
+        chunk = self.blank_chunks.get(size)
+        if chunk is None:
+            chunk = self.blank_chunks[size] = self.new_chunk(key)
+        return chunk
+
+    def pin_region(self, x, y, width, height):
+        """Keep the chunks overlapping a region in memory, e.g. the ones
+        around the viewport. Replaces the previously pinned region.
+        """
+        self.store.pin(self.chunks_in_region(x, y, width, height))
+
+    def get(self, z, x, y):
+        chunk = self.chunk(x // self.chunk_size, y // self.chunk_size)
+        if chunk is None:
+            return self.init_values[z]
+        return chunk.grid.get(z, x % self.chunk_size, y % self.chunk_size)
+
+    def set(self, z, x, y, value):
+        chunk = self.chunk(x // self.chunk_size, y // self.chunk_size, True)
+        local_x = x % self.chunk_size
+        local_y = y % self.chunk_size
+        chunk.grid.set(z, local_x, local_y, value)
+        chunk.index.update_region(z, local_x, local_y, 1, 1)
+        chunk.modified = True
+
+    def row_bytes(self, z, x, y, width) -> bytes:
+        row = bytearray()
+        for chunk_x, chunk_y in self.chunks_in_region(x, y, width, 1):
+            left, top, chunk_width, chunk_height = self.chunk_region(
+                chunk_x, chunk_y)
+            start = max(x, left)
+            end = min(x + width, left + chunk_width)
+            chunk = self.chunk(chunk_x, chunk_y)
+            if chunk is None:
+                row += bytes([self.init_values[z]]) * (end - start)
+            else:
+                row += chunk.grid.row_bytes(z, start - left, y - top,
+                                            end - start)
+        return bytes(row)
+
+    def for_each_chunk(self, x, y, width, height, create=False):
+        """Yield (chunk, local x, local y, width, height) for the part of a
+        region inside each chunk. Missing chunks are skipped unless create.
+        """
+        if not create and self.covers_world(x, y, width, height):
+            keys = self.known_chunks()
+        else:
+            keys = self.chunks_in_region(x, y, width, height)
+        for chunk_x, chunk_y in keys:
+            chunk = self.chunk(chunk_x, chunk_y, create)
+            if chunk is None:
+                continue
+            left, top, chunk_width, chunk_height = self.chunk_region(
+                chunk_x, chunk_y)
+            part_x, part_y, part_width, part_height = \
+                chunk.grid.clip_region(x - left, y - top, width, height)
+            yield chunk, part_x, part_y, part_width, part_height
+
+    def covers_world(self, x, y, width, height):
+        return (x <= 0 and y <= 0 and x + width >= self.width and
+                y + height >= self.height)
+
+    def fill(self, z, x, y, width, height, value):
+        whole_layer = self.covers_world(x, y, width, height)
+        if whole_layer:
+            self.init_values[z] = value
+        for chunk, part_x, part_y, part_width, part_height in \
+                self.for_each_chunk(x, y, width, height, not whole_layer):
+            chunk.grid.fill(z, part_x, part_y, part_width, part_height,
+                            value)
+            chunk.index.update_region(
+                z, part_x, part_y, part_width, part_height)
+            chunk.modified = True
+
+    def fill_layer(self, z, value):
+        self.fill(z, 0, 0, self.width, self.height, value)
+
+    def replace(self, z, old_value, new_value,
+                x=0, y=0, width=None, height=None):
+        width = self.width if width is None else width
+        height = self.height if height is None else height
+        # untouched chunks hold the init value, so replacing it means
+        # changing it for the whole layer or creating the chunks of region
+        create = False
+        if old_value == self.init_values[z]:
+            if self.covers_world(x, y, width, height):
+                self.init_values[z] = new_value
+            else:
+                create = True
+        for chunk, part_x, part_y, part_width, part_height in \
+                self.for_each_chunk(x, y, width, height, create):
+            chunk.grid.replace(z, old_value, new_value,
+                               part_x, part_y, part_width, part_height)
+            chunk.index.update_region(
+                z, part_x, part_y, part_width, part_height)
+            chunk.modified = True
+
+    def known_chunks(self):
+        return set(self.store.chunks) | self.swapped
+
+    def count(self, z, value):
+        total = 0
+        for key in self.known_chunks():
+            total += self.chunk(*key).grid.count(z, value)
+        if value == self.init_values[z]:
+            total += self.width * self.height - sum(
+                self.chunk_region(*key)[2] * self.chunk_region(*key)[3]
+                for key in self.known_chunks())
+        return total
+
+    # TileIndex interface, chunks keep their own indexes up to date
+    def update_region(self, z, x, y, width, height):
+        pass
+
+    def any_within(self, z, value, center_x, center_y, radius,
+                   min_radius=0) -> bool:
+        # missing chunks are all init values
+        blank = value == self.init_values[z]
+        for chunk_x, chunk_y in self.chunks_in_region(
+                math.floor(center_x - radius), math.floor(center_y - radius),
+                math.ceil(radius * 2) + 1, math.ceil(radius * 2) + 1):
+            chunk = (self.query_chunk((chunk_x, chunk_y)) if blank else
+                     self.chunk(chunk_x, chunk_y))
+            if chunk is None:
+                continue
+            left, top = chunk_x * self.chunk_size, chunk_y * self.chunk_size
+            if chunk.index.any_within(z, value, center_x - left,
+                                      center_y - top, radius, min_radius):
+                return True
+        return False
+
+    def nearest(self, z, value, center_x, center_y, max_radius=None):
+        if max_radius is None:
+            keys = self.known_chunks()
+            if value == self.init_values[z]:
+                keys |= set(self.chunks_in_region(
+                    0, 0, self.width, self.height))
+        else:
+            keys = set(self.chunks_in_region(
+                math.floor(center_x - max_radius),
+                math.floor(center_y - max_radius),
+                math.ceil(max_radius * 2) + 1,
+                math.ceil(max_radius * 2) + 1))
+
+        def chunk_distance_sq(key):
+            left, top, width, height = self.chunk_region(*key)
+            near_x = min(max(center_x, left), left + width)
+            near_y = min(max(center_y, top), top + height)
+            return (near_x - center_x)**2 + (near_y - center_y)**2
+
+        best = None
+        best_radius = max_radius
+        for key in sorted(keys, key=chunk_distance_sq):
+            if (best_radius is not None and
+                    chunk_distance_sq(key) > best_radius**2):
+                break
+            chunk = (self.query_chunk(key) if value == self.init_values[z]
+                     else self.chunk(*key))
+            if chunk is None:
+                continue
+            left, top = key[0] * self.chunk_size, key[1] * self.chunk_size
+            found = chunk.index.nearest(
+                z, value, center_x - left, center_y - top, best_radius)
+            if found is not None:
+                best = found[0] + left, found[1] + top
+                best_radius = math.hypot(best[0] + 0.5 - center_x,
+                                         best[1] + 0.5 - center_y)
+        return best
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+
+
+class ChunkStore:
+    """LRU cache of chunks kept within a memory budget.
+
+    load(key) is called for a chunk that is not in memory and may return
+    None when there is nothing to load. unload(key, chunk), if given, is
+    called for every chunk evicted, e.g. to write it to disk. Pinned chunks
+    are never evicted, so the store can go over budget while they are
+    pinned.
+    """
+
+    def __init__(self, load, unload=None, memory_budget=64 << 20,
+                 chunk_bytes=1):
+        self.load = load
+        self.unload = unload
+        self.max_chunks = max(memory_budget // chunk_bytes, 1)
+        self.chunks = OrderedDict()
+        self.pinned = set()
+
+    def __contains__(self, key):
+        return key in self.chunks
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def get(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.chunks.move_to_end(key)
+            return chunk
+        chunk = self.load(key)
+        if chunk is not None:
+            self.add(key, chunk)
+        return chunk
+
+    def peek(self, key):
+        """The chunk if it is in memory, without loading or touching it"""
+        return self.chunks.get(key)
+
+    def add(self, key, chunk):
+        self.chunks[key] = chunk
+        self.chunks.move_to_end(key)
+        self.evict(keep=key)
+
+    def pin(self, keys):
+        """Keep exactly these chunks from being evicted"""
+        self.pinned = set(keys)
+        self.evict()
+
+    def evict(self, keep=None):
+        if len(self.chunks) <= self.max_chunks:
+            return
+        for key in list(self.chunks):
+            if len(self.chunks) <= self.max_chunks:
+                break
+            if key == keep or key in self.pinned:
+                continue
+            self.discard(key)
+
+    def discard(self, key):
+        chunk = self.chunks.pop(key)
+        if self.unload is not None:
+            self.unload(key, chunk)
+
+    def clear(self):
+        for key in list(self.chunks):
+            self.discard(key)
@@ -0,0 +1,291 @@
+"""Undo and redo of tile grid edits.
+
+An edit is kept as a Delta: the runs of tiles it changed, each with its
+layer, index in the layer, length and the tile before and after, so
+painting a few tiles of a huge world costs a few bytes. The rows about to
+be written are captured first and compared with the grid when the edit
+is committed.
+
+Every checkpoint_interval edits, a checkpoint delta covering them all is
+kept as well, so undoing or redoing many edits at once applies one delta
+per interval instead of every edit. Edits and checkpoints live within
+memory_budget bytes, the oldest ones being dropped first.
+"""
+from array import array
+import contextlib
+from itertools import groupby
+
+# bytes per delta besides its runs
+DELTA_OVERHEAD = 256
+
+
+class Capture:
+    """Tiles of rows as they were before being written"""
+
+    def __init__(self):
+        # {(z, y): [start x, bytearray of the tiles from start x on]}
+        self.rows = {}
+        self.size = 0
+
+    def __bool__(self):
+        return bool(self.rows)
+
+    def add(self, grid, z, x, y, width, height):
+        x, y, width, height = grid.clip_region(x, y, width, height)
+        for row_y in range(y, y + height):
+            row = self.rows.get((z, row_y))
+            if row is None:
+                self.rows[z, row_y] = [x, bytearray(
+                    grid.row_bytes(z, x, row_y, width))]
+                self.size += width
+                continue
+            # the tiles out of the row so far were not written since
+            start, tiles = row
+            if x < start:
+                tiles[:0] = grid.row_bytes(z, x, row_y, start - x)
+                self.size += start - x
+                start = row[0] = x
+            end = start + len(tiles)
+            if x + width > end:
+                tiles += grid.row_bytes(z, end, row_y, x + width - end)
+                self.size += x + width - end
+
+    def delta(self, grid):
+        """The Delta from the captured tiles to those in grid now"""
+        delta = Delta(grid.width * grid.height)
+        for (z, y), (start, old_tiles) in sorted(self.rows.items()):
+            new_tiles = grid.row_bytes(z, start, y, len(old_tiles))
+            if new_tiles != old_tiles:
+                delta.add_row(z, y * grid.width + start, old_tiles,
+                              new_tiles)
+        return delta
+
+
+class Delta:
+    """Runs of tiles changed by one or more edits"""
+
+    def __init__(self, layer_size):
+        self.layers = bytearray()
+        self.indexes = array("I" if layer_size <= 0xFFFFFFFF else "Q")
+        self.lengths = array("I")
+        self.old = bytearray()
+        self.new = bytearray()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def size(self):
+        return (DELTA_OVERHEAD + len(self) *
+                (3 + self.indexes.itemsize + self.lengths.itemsize))
+
+    def add_row(self, z, index, old_tiles, new_tiles):
+        for (old, new), run in groupby(zip(old_tiles, new_tiles)):
+            length = len(list(run))
+            if old != new:
+                self.layers.append(z)
+                self.indexes.append(index)
+                self.lengths.append(length)
+                self.old.append(old)
+                self.new.append(new)
+            index += length
+
+    def apply(self, grid, undo=False, before_write=None):
+        """Write the tiles after the delta to grid, or those before with
+        undo. before_write(z, x, y, width, height) is called before each
+        write. Return {z: [left, top, right, bottom]} of the tiles written.
+        """
+        values = self.old if undo else self.new
+        regions = {}
+        for z, index, length, value in zip(self.layers, self.indexes,
+                                           self.lengths, values):
+            y, x = divmod(index, grid.width)
+            if before_write is not None:
+                before_write(z, x, y, length, 1)
+            grid.fill(z, x, y, length, 1, value)
+            region = regions.get(z)
+            if region is None:
+                regions[z] = [x, y, x + length, y + 1]
+            else:
+                region[0] = min(region[0], x)
+                region[1] = min(region[1], y)
+                region[2] = max(region[2], x + length)
+                region[3] = max(region[3], y + 1)
+        return regions
+
+
+class EditHistory:
+    """Edits of a tile grid that can be undone and redone.
+
+    capture() must be called before each write to the grid and commit()
+    once an edit is complete. position is the number of edits done, the
+    ones after it were undone and can be redone until a new edit is made.
+    Edits are numbered from the reset, first being the oldest one kept.
+    """
+
+    def __init__(self, memory_budget=4 << 20, checkpoint_interval=32):
+        self.memory_budget = memory_budget
+        self.checkpoint_interval = checkpoint_interval
+        self.pause_depth = 0
+        self.group_depth = 0
+        self.reset(None)
+
+    def reset(self, grid):
+        """Forget all edits and follow grid"""
+        self.grid = grid
+        self.edits = []
+        self.first = 0
+        self.position = 0
+        self.size = 0
+        self.capture_now = Capture()
+        # {first edit: (edit after the last, Delta)} of the checkpoints
+        self.checkpoints = {}
+        self.checkpoint_ends = {}
+        self.restart_checkpoint()
+
+    def restart_checkpoint(self):
+        # tiles as they were at edit checkpoint_start, for the next
+        # checkpoint
+        self.checkpoint_start = self.position
+        self.checkpoint_capture = Capture()
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Leave the writes made in the with block out of the history, which
+        then starts over from the grid they leave
+        """
+        self.pause_depth += 1
+        try:
+            yield
+        finally:
+            self.pause_depth -= 1
+            self.reset(self.grid)
+
+    def capture(self, z, x, y, width, height):
+        if self.grid is None or self.pause_depth:
+            return
+        self.capture_now.add(self.grid, z, x, y, width, height)
+        self.checkpoint_capture.add(self.grid, z, x, y, width, height)
+
+    def begin_group(self):
+        """Make the writes until the matching end_group() one edit"""
+        self.group_depth += 1
+
+    def end_group(self):
+        self.group_depth = max(self.group_depth - 1, 0)
+        self.commit()
+
+    def commit(self):
+        """Record the writes captured since the last commit as an edit"""
+        if self.group_depth or not self.capture_now:
+            return
+        delta = self.capture_now.delta(self.grid)
+        self.capture_now = Capture()
+        if not len(delta):
+            return
+        self.drop_redo()
+        self.edits.append(delta)
+        self.position += 1
+        self.size += delta.size
+        if (self.position - self.checkpoint_start >=
+                self.checkpoint_interval or
+                self.checkpoint_capture.size > self.memory_budget // 4):
+            self.add_checkpoint()
+        self.evict()
+
+    def add_checkpoint(self):
+        delta = self.checkpoint_capture.delta(self.grid)
+        if self.position - self.checkpoint_start > 1:
+            self.checkpoints[self.checkpoint_start] = (self.position, delta)
+            self.checkpoint_ends[self.position] = self.checkpoint_start
+            self.size += delta.size
+        self.restart_checkpoint()
+
+    def drop_checkpoint(self, start):
+        end, delta = self.checkpoints.pop(start)
+        del self.checkpoint_ends[end]
+        self.size -= delta.size
+
+    def drop_redo(self):
+        end = self.first + len(self.edits)
+        if self.position == end:
+            return
+        for delta in self.edits[self.position - self.first:]:
+            self.size -= delta.size
+        del self.edits[self.position - self.first:]
+        for start, (checkpoint_end, _) in list(self.checkpoints.items()):
+            if checkpoint_end > self.position:
+                self.drop_checkpoint(start)
+
+    def evict(self):
+        while self.size > self.memory_budget and self.edits:
+            if self.position > self.first:
+                self.size -= self.edits.pop(0).size
+                self.first += 1
+                for start in list(self.checkpoints):
+                    if start < self.first:
+                        self.drop_checkpoint(start)
+            else:
+                # only edits to redo are left
+                self.size -= self.edits.pop().size
+                for start, (end, _) in list(self.checkpoints.items()):
+                    if end > self.first + len(self.edits):
+                        self.drop_checkpoint(start)
+        if self.checkpoint_start < self.first:
+            self.restart_checkpoint()
+
+    @property
+    def undo_count(self):
+        return self.position - self.first
+
+    @property
+    def redo_count(self):
+        return self.first + len(self.edits) - self.position
+
+    def jump(self, position, before_write=None):
+        """Undo or redo edits until position, clamped to the edits kept,
+        and return [(z, x, y, width, height), ...] of the tiles written.
+        before_write is passed to Delta.apply.
+        """
+        # an open group ends here
+        self.group_depth = 0
+        self.commit()
+        position = max(self.first,
+                       min(position, self.first + len(self.edits)))
+        regions = {}
+        while self.position != position:
+            if self.position > position:
+                start = self.checkpoint_ends.get(self.position)
+                if start is not None and start >= position:
+                    delta = self.checkpoints[start][1]
+                    next_position = start
+                else:
+                    delta = self.edits[self.position - self.first - 1]
+                    next_position = self.position - 1
+                written = delta.apply(self.grid, True, before_write)
+            else:
+                end = self.checkpoints.get(self.position, (None,))[0]
+                if end is not None and end <= position:
+                    delta = self.checkpoints[self.position][1]
+                    next_position = end
+                else:
+                    delta = self.edits[self.position - self.first]
+                    next_position = self.position + 1
+                written = delta.apply(self.grid, False, before_write)
+            self.position = next_position
+            for z, (left, top, right, bottom) in written.items():
+                region = regions.setdefault(z, [left, top, right, bottom])
+                region[0] = min(region[0], left)
+                region[1] = min(region[1], top)
+                region[2] = max(region[2], right)
+                region[3] = max(region[3], bottom)
+        if regions:
+            self.restart_checkpoint()
+        return [(z, left, top, right - left, bottom - top)
+                for z, (left, top, right, bottom) in sorted(regions.items())]
+
+    def undo(self, steps=1, before_write=None):
+        return self.jump(self.position - steps, before_write)
+
+    def redo(self, steps=1, before_write=None):
+        return self.jump(self.position + steps, before_write)
@@ -0,0 +1,243 @@
+try:
+    import numpy as np
+except ImportError:  # the vectorized backend is optional
+    np = None
+
+from gamesystem import navigation
+
+# dx and dy by FlowField step, 1 + index in DIRECTIONS, 0 for none
+STEP_X = [0] + [dx for dx, dy in navigation.DIRECTIONS]
+STEP_Y = [0] + [dy for dx, dy in navigation.DIRECTIONS]
+
+
+def is_available():
+    return np is not None
+
+
+class MobSimulation:
+    """Structure-of-arrays mob simulation.
+
+    Every mob is a slot in a set of NumPy arrays (position, velocity, sight
+    range and target), and step() moves the whole population at once. Each
+    slot has an owner object, usually the sprite drawing the mob, so only
+    the sprites that are actually drawn need to be synced from the arrays.
+    """
+
+    fields = {"x": "int32", "y": "int32", "dx": "int32", "dy": "int32",
+              "max_sightrange": "float32", "min_sightrange": "float32",
+              "target_x": "int32", "target_y": "int32",
+              "has_target": "bool"}
+
+    def __init__(self, capacity=256, speed=2, seed=None):
+        if np is None:
+            raise ImportError("MobSimulation needs numpy")
+        self.count = 0
+        self.speed = speed
+        self.rng = np.random.default_rng(seed)
+        self.owners = []
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        for name, dtype in self.fields.items():
+            array = np.zeros(capacity, dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                array[:self.count] = old[:self.count]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def add(self, owner, x, y, max_sightrange=160, min_sightrange=0) -> int:
+        """Add a mob and return its slot. owner.sim_index is kept equal to
+        the slot of the mob, which changes when other mobs are removed.
+        """
+        if self.count == self.capacity:
+            self.allocate(self.capacity * 2)
+        index = self.count
+        self.x[index] = x
+        self.y[index] = y
+        self.dx[index] = 0
+        self.dy[index] = 0
+        self.max_sightrange[index] = max_sightrange
+        self.min_sightrange[index] = min_sightrange
+        self.has_target[index] = False
+        self.owners.append(owner)
+        owner.sim_index = index
+        self.count += 1
+        return index
+
+    def remove(self, index):
+        """Remove a mob by moving the last mob into its slot."""
+        last = self.count - 1
+        for name in self.fields:
+            array = getattr(self, name)
+            array[index] = array[last]
+        owner = self.owners.pop()
+        if index != last:
+            self.owners[index] = owner
+            owner.sim_index = index
+        self.count = last
+
+    def set_target(self, index, pos):
+        if pos is None:
+            self.has_target[index] = False
+        else:
+            self.target_x[index], self.target_y[index] = pos
+            self.has_target[index] = True
+
+    def step(self, navigator=None, tilesize=16):
+        """Move every mob one tick: towards its target if it has one,
+        along the flow fields of navigator if given, otherwise one random
+        step in each axis.
+        """
+        n = self.count
+        if not n:
+            return
+        move_x = self.rng.integers(-1, 2, n, dtype=np.int32) * self.speed
+        move_y = self.rng.integers(-1, 2, n, dtype=np.int32) * self.speed
+        targeted = self.has_target[:n]
+        if targeted.any():
+            move_x[targeted] = np.clip(
+                self.target_x[:n] - self.x[:n],
+                -self.speed, self.speed)[targeted]
+            move_y[targeted] = np.clip(
+                self.target_y[:n] - self.y[:n],
+                -self.speed, self.speed)[targeted]
+            if navigator is not None:
+                self.follow_paths(navigator, tilesize,
+                                  np.flatnonzero(targeted), move_x, move_y)
+        self.dx[:n] = np.sign(move_x)
+        self.dy[:n] = np.sign(move_y)
+        self.x[:n] += move_x
+        self.y[:n] += move_y
+
+    def follow_paths(self, navigator, tilesize, indices, move_x, move_y):
+        """Turn the moves of the mobs at indices, straight for their
+        targets, to follow the flow fields of navigator as
+        HumanSprite.head_for_target does. Each field is sampled once for
+        all the mobs using it.
+        """
+        col = self.x[indices] // tilesize
+        row = self.y[indices] // tilesize
+        goal_x = self.target_x[indices] // tilesize
+        goal_y = self.target_y[indices] // tilesize
+        steps = np.zeros(len(indices), np.uint8)
+        # the mobs going straight that must keep out of blocked tiles
+        checked = np.ones(len(indices), bool)
+        for x, y in np.unique(np.stack([goal_x, goal_y]), axis=1).T.tolist():
+            mine = (goal_x == x) & (goal_y == y)
+            field = navigator.field(x, y)
+            if field is None:
+                continue
+            sample_field(field, col, row, mine, steps)
+            checked[mine & (col == x) & (row == y)] = False
+            lost = mine & checked & (steps == 0)
+            if lost.any():
+                self.follow_portals(navigator, navigator.coarse_field(x, y),
+                                    col, row, lost, steps)
+        guided = steps > 0
+        move_x[indices[guided]] = (
+            np.array(STEP_X, np.int32)[steps[guided]] * self.speed)
+        move_y[indices[guided]] = (
+            np.array(STEP_Y, np.int32)[steps[guided]] * self.speed)
+        checked &= ~guided
+        if checked.any():
+            indices = indices[checked]
+            dir_x = np.sign(move_x[indices])
+            dir_y = np.sign(move_y[indices])
+            open_x, open_y = open_directions(
+                navigator, col[checked], row[checked], dir_x, dir_y)
+            turned = (open_x != dir_x) | (open_y != dir_y)
+            move_x[indices[turned]] = open_x[turned] * self.speed
+            move_y[indices[turned]] = open_y[turned] * self.speed
+
+    def follow_portals(self, navigator, coarse, col, row, lost, steps):
+        """Set the steps of the lost mobs, those out of the field of their
+        goal, toward the portals of its coarse field. The mobs in one
+        component of a block share a portal.
+        """
+        size = coarse.size
+        block_x = col // size
+        block_y = row // size
+        for x, y in np.unique(np.stack([block_x[lost], block_y[lost]]),
+                              axis=1).T.tolist():
+            block = coarse.block(x, y)
+            if block is None:
+                continue
+            here = lost & (block_x == x) & (block_y == y)
+            if block.labels is None:
+                components = np.where(here, 1, 0)
+            else:
+                labels = np.frombuffer(block.labels, np.uint16)
+                cells = np.where(here, (row - block.y) * block.width +
+                                 col - block.x, 0)
+                components = np.where(here, labels[cells], 0)
+            for component in np.unique(components[here]).tolist():
+                if not component:
+                    continue
+                portal = coarse.node_portal((x, y, component))
+                if portal is not None:
+                    sample_field(navigator.portal_field(*portal), col, row,
+                                 here & (components == component), steps)
+
+    def indices_in_rect(self, x, y, width, height, margin=0):
+        """Slots of the mobs whose position is inside a rect grown by
+        margin on each side.
+        """
+        n = self.count
+        mob_x = self.x[:n]
+        mob_y = self.y[:n]
+        inside = ((mob_x >= x - margin) & (mob_x < x + width + margin) &
+                  (mob_y >= y - margin) & (mob_y < y + height + margin))
+        return np.flatnonzero(inside)
+
+
+def sample_field(field, col, row, mask, steps):
+    """Set the steps where mask is to those of a FlowField at the tiles
+    (col, row), if inside its window
+    """
+    inside = (mask & (col >= field.x) & (col < field.x + field.width) &
+              (row >= field.y) & (row < field.y + field.height))
+    cells = (row[inside] - field.y) * field.width + col[inside] - field.x
+    steps[inside] = np.frombuffer(field.steps, np.uint8)[cells]
+
+
+def open_directions(navigator, col, row, dir_x, dir_y):
+    """navigator.open_direction of arrays of tiles and directions"""
+    grid = navigator.grid
+    if not hasattr(grid, "layer_buffer"):
+        # a chunked grid, one mob at a time
+        turned = [navigator.open_direction(*args) for args in zip(
+            col.tolist(), row.tolist(), dir_x.tolist(), dir_y.tolist())]
+        return np.array(turned, np.int32).reshape(-1, 2).T
+    blocked_tiles = np.frombuffer(navigator.blocked_tiles, np.uint8) > 0
+    layers = [np.frombuffer(grid.layer_buffer(z), np.uint8)
+              for z in range(grid.layer_num)]
+
+    def blocked(x, y):
+        inside = (x >= 0) & (x < grid.width) & (y >= 0) & (y < grid.height)
+        cells = np.where(inside, y * grid.width + x, 0)
+        found = np.zeros(len(x), bool)
+        for layer in layers:
+            found |= blocked_tiles[layer[cells]]
+        return found & inside
+
+    ring_x = np.array([dx for dx, dy in navigation.RING], np.int32)
+    ring_y = np.array([dy for dx, dy in navigation.RING], np.int32)
+    # index in RING of every direction by (dy + 1, dx + 1), -1 for none
+    turns = np.full((3, 3), -1)
+    for turn, (dx, dy) in enumerate(navigation.RING):
+        turns[dy + 1, dx + 1] = turn
+    turn = turns[dir_y + 1, dir_x + 1]
+    open_x = np.zeros(len(col), np.int32)
+    open_y = np.zeros(len(col), np.int32)
+    pending = turn >= 0
+    for offset in (0, 1, -1, 2, -2):
+        step_x = ring_x[(turn + offset) % 8]
+        step_y = ring_y[(turn + offset) % 8]
+        free = (pending & ~blocked(col + step_x, row + step_y) &
+                ~((step_x != 0) & (step_y != 0) &
+                  (blocked(col + step_x, row) | blocked(col, row + step_y))))
+        open_x[free] = step_x[free]
+        open_y[free] = step_y[free]
+        pending &= ~free
+    return open_x, open_y
@@ -0,0 +1,651 @@
+"""Flow-field navigation over a tile grid.
+
+Every tile position has a cost to enter, the highest tile_costs gives
+the tiles of its layers, and BLOCKED ones are never entered. A FlowField
+holds, for every tile in a window around a goal, the direction of the
+cheapest path to the goal. It is computed once with Dijkstra from the
+goal, so any number of mobs heading for the same goal share it.
+
+A FlowField only covers tiles near its goal. Farther away, mobs follow a
+CoarseField over square blocks of tiles. The open tiles of a block are
+split into components, the parts connected inside it, so a wall through
+a block keeps its two sides apart. The CoarseField gives each component
+the tile of the next block to head for, the portal, and mobs reach it
+with a small FlowField, so every step still keeps out of blocked tiles.
+
+Navigator caches fields per goal. A terrain edit only marks stale
+the fields whose window it overlaps and whose tile costs it really
+changed. Stale fields keep being used until they are rebuilt, which is
+put off until their window has not been edited for a while and limited
+to a few rebuilds per step, so a stroke painted near a goal does not
+rebuild its field on every step.
+"""
+from array import array
+import heapq
+import re
+
+from gamesystem import chunkstore
+
+BLOCKED = 255
+# (dx, dy) of the eight neighbours of a tile, orthogonal ones first
+DIRECTIONS = [(0, -1), (1, 0), (0, 1), (-1, 0),
+              (1, -1), (1, 1), (-1, 1), (-1, -1)]
+# the same clockwise from north, to turn aside by steps of 45 degrees
+RING = [(0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1)]
+# index in DIRECTIONS of the opposite direction
+OPPOSITE = [DIRECTIONS.index((-dx, -dy)) for dx, dy in DIRECTIONS]
+# step costs are tile costs times these, so diagonals cost about sqrt(2)
+ORTHOGONAL_STEP = 10
+DIAGONAL_STEP = 14
+UNREACHED = 2**31 - 1
+# blocks kept measured, past which they are all dropped
+MAX_BLOCKS = 1 << 16
+# bytes.translate table adding 1 to every byte
+PLUS_ONE = bytes(range(1, 256)) + bytes([0])
+# a run of tiles that are not BLOCKED
+OPEN_RUN = re.compile(rb"[^\xff]+")
+
+
+def cost_table(tile_costs) -> bytes:
+    """bytes.translate table from tile ids to costs.
+    tile_costs: {tile id: cost}, other tiles cost 1.
+    """
+    table = bytearray([1]) * 256
+    for tile_id, cost in tile_costs.items():
+        table[tile_id] = cost
+    return bytes(table)
+
+
+class FlowField:
+    """Directions to a goal for the tiles of the window x, y, width,
+    height. costs are the tile costs of the window it was computed with.
+    """
+
+    def __init__(self, goal, x, y, width, height, costs):
+        self.goal = goal
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.costs = costs
+        # per tile, 1 + index in DIRECTIONS of the next step, 0 for none
+        self.steps = bytearray(width * height)
+        self.distances = array("l", [UNREACHED]) * (width * height)
+        self.compute()
+
+    def compute(self):
+        width = self.width
+        height = self.height
+        costs = self.costs
+        steps = self.steps
+        distances = self.distances
+        goal = (self.goal[1] - self.y) * width + self.goal[0] - self.x
+        distances[goal] = 0
+        heap = [(0, goal)]
+        while heap:
+            distance, i = heapq.heappop(heap)
+            if distance > distances[i]:
+                continue
+            y, x = divmod(i, width)
+            for direction, (dx, dy) in enumerate(DIRECTIONS):
+                next_x = x + dx
+                next_y = y + dy
+                if not (0 <= next_x < width and 0 <= next_y < height):
+                    continue
+                j = next_y * width + next_x
+                cost = costs[j]
+                if cost == BLOCKED:
+                    continue
+                if dx and dy:
+                    # no cutting corners of blocked tiles
+                    if (costs[y * width + next_x] == BLOCKED or
+                            costs[next_y * width + x] == BLOCKED):
+                        continue
+                    next_distance = distance + cost * DIAGONAL_STEP
+                else:
+                    next_distance = distance + cost * ORTHOGONAL_STEP
+                if next_distance < distances[j]:
+                    distances[j] = next_distance
+                    # the step from j goes back the way we came
+                    steps[j] = OPPOSITE[direction] + 1
+                    heapq.heappush(heap, (next_distance, j))
+
+    def contains(self, x, y):
+        return (self.x <= x < self.x + self.width and
+                self.y <= y < self.y + self.height)
+
+    def direction(self, x, y):
+        """(dx, dy) of the next step from tile (x, y) toward the goal,
+        (0, 0) at the goal, or None outside the window or when the goal
+        cannot be reached
+        """
+        if not self.contains(x, y):
+            return None
+        i = (y - self.y) * self.width + x - self.x
+        step = self.steps[i]
+        if step:
+            return DIRECTIONS[step - 1]
+        if self.distances[i] == 0:
+            return 0, 0
+        return None
+
+    def distance(self, x, y):
+        """Path cost from tile (x, y) to the goal, or None if unreachable"""
+        if not self.contains(x, y):
+            return None
+        distance = self.distances[(y - self.y) * self.width + x - self.x]
+        return None if distance == UNREACHED else distance
+
+
+class Block:
+    """Tile costs of the block x, y, width, height of a grid, with its open
+    tiles numbered by component from 1.
+    """
+
+    def __init__(self, x, y, width, height, costs):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.costs = costs
+        # per tile, its component or 0 if BLOCKED, None when no tile is
+        self.labels = None
+        # mean tile cost of each component
+        self.component_costs = []
+        if BLOCKED in costs:
+            self.label()
+        else:
+            self.component_costs.append(sum(costs) // len(costs))
+
+    def label(self):
+        """Number the components, joining the open runs of a row to those
+        they touch in the row above
+        """
+        width = self.width
+        parent = []
+
+        def find(run):
+            while parent[run] != run:
+                parent[run] = parent[parent[run]]
+                run = parent[run]
+            return run
+
+        runs = []
+        above = []
+        for row in range(self.height):
+            line = self.costs[row * width:(row + 1) * width]
+            current = []
+            for match in OPEN_RUN.finditer(line):
+                start, end = match.span()
+                run = len(parent)
+                parent.append(run)
+                for other_start, other_end, other in above:
+                    if other_start < end and start < other_end:
+                        parent[find(other)] = run
+                current.append((start, end, run))
+                runs.append((row * width, start, end, run))
+            above = current
+        self.labels = array("H", bytes(2 * len(self.costs)))
+        components = {}
+        sums = []
+        counts = []
+        for offset, start, end, run in runs:
+            component = components.setdefault(find(run), len(components) + 1)
+            if component > len(sums):
+                sums.append(0)
+                counts.append(0)
+            self.labels[offset + start:offset + end] = (
+                array("H", [component]) * (end - start))
+            sums[component - 1] += sum(
+                self.costs[offset + start:offset + end])
+            counts[component - 1] += end - start
+        self.component_costs = [total // count
+                                for total, count in zip(sums, counts)]
+
+    def component(self, x, y):
+        """Component of the tile (x, y) of the block, 0 if BLOCKED"""
+        if self.labels is None:
+            return 1
+        return self.labels[(y - self.y) * self.width + x - self.x]
+
+
+def crossings(block, other):
+    """(component of block, component of other, tile of block, tile of
+    other) for every pair of components touching across the border
+    between two blocks, other right of or below block. The tiles are the
+    middle pair of those touching.
+    """
+    if block.labels is None and other.labels is None:
+        # open on both sides
+        if other.x > block.x:
+            y = block.y + block.height // 2
+            return [(1, 1, (other.x - 1, y), (other.x, y))]
+        x = block.x + block.width // 2
+        return [(1, 1, (x, other.y - 1), (x, other.y))]
+    if other.x > block.x:
+        # the last column of block and the first of other
+        tiles = [((other.x - 1, y), (other.x, y))
+                 for y in range(block.y, block.y + block.height)]
+        sides = zip(border(block, block.width - 1, block.width),
+                    border(other, 0, other.width))
+    else:
+        # the last row of block and the first of other
+        tiles = [((x, other.y - 1), (x, other.y))
+                 for x in range(block.x, block.x + block.width)]
+        start = (block.height - 1) * block.width
+        sides = zip(border(block, start, 1)[:block.width],
+                    border(other, 0, 1)[:other.width])
+    touching = {}
+    for pair, (component, other_component) in zip(tiles, sides):
+        if component and other_component:
+            touching.setdefault((component, other_component), []).append(
+                pair)
+    return [components + pairs[len(pairs) // 2]
+            for components, pairs in touching.items()]
+
+
+def border(block, start, step):
+    """Components of the tiles of a block from start on, every step"""
+    if block.labels is None:
+        return [1] * len(range(start, len(block.costs), step))
+    return block.labels[start::step]
+
+
+class CoarseField:
+    """Paths to a goal tile over the components of the blocks of the
+    window x, y, width, height of blocks of size tiles. measure_row(block
+    y) gives the Blocks of a row of the window by (block x, block y).
+
+    Nodes are (block x, block y, component). Neighbouring nodes are joined
+    where their tiles touch, at the sum of their mean tile costs. The
+    search from the goal only goes as far as the nodes asked about so far,
+    and only measures the rows it reaches.
+    """
+
+    def __init__(self, goal, x, y, width, height, size, measure_row):
+        self.goal = goal
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.size = size
+        self.measure_row = measure_row
+        # the Blocks of the rows measured so far
+        self.blocks = {}
+        # {node: the tile of the next node to enter on the way, None for
+        # the node of the goal}
+        self.portals = {}
+        self.distances = {}
+        self.settled = set()
+        # {(left or top block, right or bottom block): their crossings}
+        self.links = {}
+        self.heap = []
+        start = self.node(*goal)
+        if start is not None:
+            self.portals[start] = None
+            self.distances[start] = 0
+            self.heap.append((0, start))
+
+    def block(self, block_x, block_y):
+        """The Block at (block_x, block_y), or None out of the window"""
+        if not (self.x <= block_x < self.x + self.width and
+                self.y <= block_y < self.y + self.height):
+            return None
+        if (self.x, block_y) not in self.blocks:
+            self.blocks.update(self.measure_row(block_y))
+        return self.blocks[block_x, block_y]
+
+    def node(self, x, y):
+        """Node of the tile (x, y), or None out of the window or if it is
+        BLOCKED
+        """
+        key = x // self.size, y // self.size
+        block = self.block(*key)
+        if block is None:
+            return None
+        component = block.component(x, y)
+        return key + (component,) if component else None
+
+    def search(self, target):
+        """Settle nodes, nearest to the goal first, until target is"""
+        heap = self.heap
+        distances = self.distances
+        while heap and target not in self.settled:
+            distance, node = heapq.heappop(heap)
+            if node in self.settled:
+                continue
+            self.settled.add(node)
+            block_x, block_y, component = node
+            block = self.blocks[block_x, block_y]
+            for dx, dy in DIRECTIONS[:4]:
+                key = block_x + dx, block_y + dy
+                other = self.block(*key)
+                if other is None:
+                    continue
+                if dx + dy > 0:
+                    pair = (block_x, block_y), key
+                else:
+                    pair = key, (block_x, block_y)
+                links = self.links.get(pair)
+                if links is None:
+                    links = self.links[pair] = crossings(
+                        self.blocks[pair[0]], self.blocks[pair[1]])
+                for link in links:
+                    if dx + dy < 0:
+                        link = link[1], link[0], link[3], link[2]
+                    mine, theirs, tile, other_tile = link
+                    if mine != component:
+                        continue
+                    next_node = key + (theirs,)
+                    next_distance = (distance +
+                                     block.component_costs[mine - 1] +
+                                     other.component_costs[theirs - 1])
+                    if next_distance < distances.get(next_node, UNREACHED):
+                        distances[next_node] = next_distance
+                        # from there, step into this block
+                        self.portals[next_node] = tile
+                        heapq.heappush(heap, (next_distance, next_node))
+
+    def portal(self, x, y):
+        """The tile to head for from the tile (x, y), in the next block on
+        the way to the goal, or None in the goal's own component, out of
+        the window or when the goal cannot be reached
+        """
+        node = self.node(x, y)
+        if node is None:
+            return None
+        return self.node_portal(node)
+
+    def node_portal(self, node):
+        """The portal from a node, or None as for portal()"""
+        self.search(node)
+        if node not in self.settled:
+            return None
+        return self.portals[node]
+
+
+class Navigator:
+    """Flow fields of a tile grid, cached per goal.
+
+    Fields only cover field_radius tiles around their goal, which bounds
+    the work per field and lets edits elsewhere keep them. Beyond, mobs
+    follow the coarse field of the goal, over blocks of block_size tiles
+    up to coarse_radius blocks from the goal's, through portal fields of
+    block_size tiles around each portal. The max_fields, max_portal_fields
+    and max_coarse_fields most recently used ones are kept. A stale field
+    is rebuilt when it is asked for rebuild_delay steps after the last edit
+    of its window, at most rebuilds_per_step of them between two calls of
+    tick(), or any number with None.
+    """
+
+    def __init__(self, grid, tile_costs, field_radius=48, max_fields=32,
+                 rebuilds_per_step=None, rebuild_delay=0, block_size=16,
+                 coarse_radius=64, max_portal_fields=256,
+                 max_coarse_fields=4):
+        self.grid = grid
+        self.table = cost_table(tile_costs)
+        # (cost, translate table to 1 for the tiles costing that or more)
+        # for every cost above 1, lowest first
+        self.levels = [
+            (level, bytes(cost >= level for cost in self.table))
+            for level in sorted(set(self.table)) if level > 1]
+        # translate table to 1 for the BLOCKED tiles
+        self.blocked_tiles = bytes(cost == BLOCKED for cost in self.table)
+        self.field_radius = field_radius
+        self.block_size = block_size
+        self.coarse_radius = coarse_radius
+        # {(block x, block y): Block} measured since their last edit
+        self.blocks = {}
+        # a field counts as one byte, so the budget is the field count
+        self.stores = {
+            "tile": chunkstore.ChunkStore(
+                self.build_field, memory_budget=max_fields),
+            "portal": chunkstore.ChunkStore(
+                self.build_portal_field, memory_budget=max_portal_fields),
+            "coarse": chunkstore.ChunkStore(
+                self.build_coarse_field, memory_budget=max_coarse_fields)}
+        self.rebuilds_per_step = rebuilds_per_step
+        self.rebuild_delay = rebuild_delay
+        self.rebuilds_left = rebuilds_per_step
+        self.step = 0
+        # {(kind, goal): step of the last edit} of the stale fields
+        self.stale = {}
+
+    def set_grid(self, grid):
+        self.grid = grid
+        self.blocks.clear()
+        for store in self.stores.values():
+            store.clear()
+        self.stale.clear()
+
+    def tick(self):
+        """Start a new step"""
+        self.step += 1
+        self.rebuilds_left = self.rebuilds_per_step
+
+    def region_costs(self, x, y, width, height) -> bytes:
+        """Tile costs of a region of the grid, row by row"""
+        size = width * height
+        if not size:
+            return b""
+        layers = [b"".join(self.grid.row_bytes(z, x, row_y, width)
+                           for row_y in range(y, y + height))
+                  for z in range(self.grid.layer_num)]
+        # A cost is 1 plus, for every level reached by the tile of some
+        # layer, the step up to it from the level below. The tiles are
+        # summed as big ints, so no Python code runs per tile, and a sum
+        # never carries over into the next tile as it stays below 255.
+        total = 0
+        below = 1
+        for level, table in self.levels:
+            reached = 0
+            for tiles in layers:
+                reached |= int.from_bytes(tiles.translate(table), "little")
+            total += reached * (level - below)
+            below = level
+        return total.to_bytes(size, "little").translate(PLUS_ONE)
+
+    def cost(self, x, y):
+        return self.region_costs(x, y, 1, 1)[0]
+
+    def blocked(self, x, y):
+        """Whether the tile (x, y) is BLOCKED, tiles off the grid are not"""
+        if not self.grid.in_bounds(x, y):
+            return False
+        return any(self.blocked_tiles[self.grid.get(z, x, y)]
+                   for z in range(self.grid.layer_num))
+
+    def can_step(self, x, y, dx, dy):
+        """Whether a step from the tile (x, y) enters no blocked tile, nor
+        cuts the corner of one
+        """
+        if self.blocked(x + dx, y + dy):
+            return False
+        return not (dx and dy and (self.blocked(x + dx, y) or
+                                   self.blocked(x, y + dy)))
+
+    def open_direction(self, x, y, dx, dy):
+        """(dx, dy) if a step that way from the tile (x, y) can be made,
+        or else the nearest direction up to 90 degrees off that can, or
+        (0, 0)
+        """
+        if (dx, dy) == (0, 0):
+            return 0, 0
+        turn = RING.index((dx, dy))
+        for offset in (0, 1, -1, 2, -2):
+            step_x, step_y = RING[(turn + offset) % 8]
+            if self.can_step(x, y, step_x, step_y):
+                return step_x, step_y
+        return 0, 0
+
+    def measure_blocks(self, first, end, block_y):
+        """Measure the blocks first to end - 1 of the row of blocks block_y
+        from one region of tiles
+        """
+        size = self.block_size
+        x, y, width, height = self.grid.clip_region(
+            first * size, block_y * size, (end - first) * size, size)
+        costs = self.region_costs(x, y, width, height)
+        rows = [costs[row * width:(row + 1) * width] for row in range(height)]
+        for block_x in range(first, end):
+            left = block_x * size - x
+            block_width = min(size, width - left)
+            self.blocks[block_x, block_y] = Block(
+                x + left, y, block_width, height,
+                b"".join(row[left:left + block_width] for row in rows))
+
+    def block(self, block_x, block_y) -> Block:
+        if (block_x, block_y) not in self.blocks:
+            self.measure_blocks(block_x, block_x + 1, block_y)
+        return self.blocks[block_x, block_y]
+
+    def window_blocks(self, x, y, width, height):
+        """{(block x, block y): Block} of a region of blocks"""
+        if len(self.blocks) > MAX_BLOCKS:
+            self.blocks.clear()
+        window = {}
+        for block_y in range(y, y + height):
+            missing = [block_x for block_x in range(x, x + width)
+                       if (block_x, block_y) not in self.blocks]
+            if missing:
+                self.measure_blocks(missing[0], missing[-1] + 1, block_y)
+            for block_x in range(x, x + width):
+                window[block_x, block_y] = self.blocks[block_x, block_y]
+        return window
+
+    def forget_blocks(self, x, y, width, height):
+        """Drop the blocks measured in a region of tiles"""
+        size = self.block_size
+        columns = range(x // size, (x + width - 1) // size + 1)
+        rows = range(y // size, (y + height - 1) // size + 1)
+        if len(columns) * len(rows) > len(self.blocks):
+            for key in [key for key in self.blocks
+                        if key[0] in columns and key[1] in rows]:
+                del self.blocks[key]
+            return
+        for block_y in rows:
+            for block_x in columns:
+                self.blocks.pop((block_x, block_y), None)
+
+    def window(self, goal, radius):
+        return self.grid.clip_region(goal[0] - radius, goal[1] - radius,
+                                     radius * 2 + 1, radius * 2 + 1)
+
+    def build_field(self, goal) -> FlowField:
+        x, y, width, height = self.window(goal, self.field_radius)
+        return FlowField(goal, x, y, width, height,
+                         self.region_costs(x, y, width, height))
+
+    def build_portal_field(self, goal) -> FlowField:
+        x, y, width, height = self.window(goal, self.block_size)
+        return FlowField(goal, x, y, width, height,
+                         self.region_costs(x, y, width, height))
+
+    def build_coarse_field(self, goal) -> CoarseField:
+        size = self.block_size
+        radius = self.coarse_radius
+        columns = -(-self.grid.width // size)
+        rows = -(-self.grid.height // size)
+        left = max(goal[0] // size - radius, 0)
+        top = max(goal[1] // size - radius, 0)
+        width = min(goal[0] // size + radius + 1, columns) - left
+        height = min(goal[1] // size + radius + 1, rows) - top
+        return CoarseField(
+            goal, left, top, width, height, size,
+            lambda block_y: self.window_blocks(left, block_y, width, 1))
+
+    def cached_field(self, kind, goal):
+        store = self.stores[kind]
+        edited = self.stale.get((kind, goal))
+        if edited is not None:
+            if goal not in store:
+                # dropped since, built anew below
+                del self.stale[kind, goal]
+            elif (self.rebuilds_left != 0 and
+                  self.step - edited >= self.rebuild_delay):
+                if self.rebuilds_left is not None:
+                    self.rebuilds_left -= 1
+                del self.stale[kind, goal]
+                store.discard(goal)
+        return store.get(goal)
+
+    def field(self, goal_x, goal_y):
+        """The flow field to the tile (goal_x, goal_y), or None if it is
+        outside the grid
+        """
+        if not self.grid.in_bounds(goal_x, goal_y):
+            return None
+        return self.cached_field("tile", (goal_x, goal_y))
+
+    def portal_field(self, x, y) -> FlowField:
+        """The flow field to a portal tile, covering the blocks next to it"""
+        return self.cached_field("portal", (x, y))
+
+    def coarse_field(self, goal_x, goal_y):
+        """The coarse field to the tile (goal_x, goal_y), or None if it is
+        outside the grid
+        """
+        if not self.grid.in_bounds(goal_x, goal_y):
+            return None
+        return self.cached_field("coarse", (goal_x, goal_y))
+
+    def direction(self, x, y, goal_x, goal_y):
+        """(dx, dy) of the next step from tile (x, y) to the goal tile, or
+        None when there is no known path. Out of the field of the goal,
+        the step is toward the next portal of its coarse field.
+        """
+        field = self.field(goal_x, goal_y)
+        if field is None:
+            return None
+        direction = field.direction(x, y)
+        if direction is not None:
+            return direction
+        portal = self.coarse_field(goal_x, goal_y).portal(x, y)
+        if portal is None:
+            return None
+        return self.portal_field(*portal).direction(x, y)
+
+    def invalidate_region(self, x, y, width, height):
+        """Mark stale the fields whose tile costs changed in a region"""
+        self.forget_blocks(x, y, width, height)
+        for kind, store in self.stores.items():
+            # coarse fields have windows of blocks
+            scale = self.block_size if kind == "coarse" else 1
+            for goal, field in store.chunks.items():
+                left = max(x // scale, field.x)
+                top = max(y // scale, field.y)
+                right = min((x + width - 1) // scale + 1,
+                            field.x + field.width)
+                bottom = min((y + height - 1) // scale + 1,
+                             field.y + field.height)
+                if left >= right or top >= bottom:
+                    continue
+                if (kind, goal) in self.stale:
+                    # still being edited, wait longer
+                    self.stale[kind, goal] = self.step
+                    continue
+                if kind == "coarse":
+                    # blocks not measured yet will be measured as they are
+                    changed = any(
+                        self.block(block_x, block_y).costs !=
+                        field.blocks[block_x, block_y].costs
+                        for block_y in range(top, bottom)
+                        if (field.x, block_y) in field.blocks
+                        for block_x in range(left, right))
+                else:
+                    changed = self.costs_changed(field, left, top,
+                                                 right - left, bottom - top)
+                if changed:
+                    self.stale[kind, goal] = self.step
+
+    def costs_changed(self, field, x, y, width, height):
+        """Whether the tile costs of a region inside the window of a
+        FlowField changed since it was computed
+        """
+        costs = self.region_costs(x, y, width, height)
+        for row in range(height):
+            start = (y + row - field.y) * field.width + x - field.x
+            if (field.costs[start:start + width] !=
+                    costs[row * width:(row + 1) * width]):
+                return True
+        return False
@@ -0,0 +1,105 @@
+"""Per-frame timings of the game loop.
+
+FrameProfiler keeps the time spent in each named phase of the last
+history frames, such as event handling, update, render steps and the
+display update. The frames can be written out as a CSV or JSON trace, and
+cProfile can be run over the next few frames.
+"""
+from collections import deque
+import contextlib
+import cProfile
+import csv
+import json
+import time
+
+
+class FrameProfiler:
+    def __init__(self, history=300):
+        # one {phase: seconds} dict per frame, "frame" being the whole frame
+        self.frames = deque(maxlen=history)
+        # phase names in the order first seen, used as dict for the order
+        self.phase_names = {}
+        self.current = None
+        self.frame_start = None
+        self.profile = None
+        self.profile_path = None
+        self.profile_frames_left = 0
+
+    def begin_frame(self):
+        """Start a frame, ending the one before. A frame lasts until the
+        next begin_frame, so it includes waiting for the frame rate.
+        """
+        now = time.perf_counter()
+        if self.current is not None:
+            self.current["frame"] = now - self.frame_start
+            self.frames.append(self.current)
+            if self.profile is not None:
+                self.profile_frames_left -= 1
+                if self.profile_frames_left <= 0:
+                    self.stop_profile()
+        self.frame_start = now
+        self.current = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to phase name of the
+        current frame
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                self.current[name] = (self.current.get(name, 0) +
+                                      time.perf_counter() - start)
+                self.phase_names.setdefault(name, None)
+
+    def stats(self, frame_num=60):
+        """Mean seconds per phase, including "frame", over the last
+        frame_num frames
+        """
+        frames = list(self.frames)[-frame_num:]
+        if not frames:
+            return {}
+        return {name: sum(frame.get(name, 0) for frame in frames) /
+                len(frames)
+                for name in ["frame"] + list(self.phase_names)}
+
+    def write_trace(self, path):
+        """Write the recorded frames to path, as JSON if it ends with .json
+        and as CSV otherwise. Times are in seconds.
+        """
+        path = str(path)
+        names = ["frame"] + list(self.phase_names)
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump({"phases": names, "frames": list(self.frames)}, f)
+            return
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["index"] + names)
+            for index, frame in enumerate(self.frames):
+                writer.writerow([index] + [frame.get(name, 0)
+                                           for name in names])
+
+    def start_profile(self, frame_num, path):
+        """Run cProfile over the next frame_num frames and write the stats
+        to path, to be read with pstats
+        """
+        if self.profile is not None:
+            return
+        self.profile = cProfile.Profile()
+        self.profile_path = str(path)
+        self.profile_frames_left = frame_num
+        self.profile.enable()
+
+    def stop_profile(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.profile.dump_stats(self.profile_path)
+        self.profile = None
+
+    @property
+    def profiling(self):
+        return self.profile is not None
@@ -0,0 +1,183 @@
+"""Mob updates spread over worker processes by map region.
+
+The terrain lives in a memory-mapped file that the main process writes
+and the workers map read-only, so tiles are never pickled. Each step the
+mobs are grouped by the region_size x region_size tile region they stand
+in. Every region is stepped by a worker, cut in parts of at most one
+process' share of the mobs: a random move and a vision query against
+the worker's own TileIndex. Workers bring their index up to date from
+the log of terrain writes sent along with each task, which only holds
+the writes some worker may not have seen yet.
+"""
+import atexit
+from collections import deque
+import mmap
+import multiprocessing
+import os
+import random
+import signal
+import tempfile
+
+from gamesystem import tilegrid
+from gamesystem import tileindex
+
+# terrain writes kept for workers that fell behind, a worker that missed
+# older ones rebuilds its index
+EDIT_LOG_SIZE = 256
+
+# state of a worker process, set up by init_worker
+worker_state = {}
+
+
+def init_worker(path, layer_num, height, width, serial):
+    # a worker forked from a process running SDL inherits its SIGTERM
+    # handler, which would keep Pool.terminate from stopping it
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    f = open(path, "rb")
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    grid = tilegrid.TileGrid(layer_num, height, width, data=data)
+    worker_state.update(file=f, grid=grid, index=tileindex.TileIndex(grid),
+                        serial=serial)
+
+
+def catch_up(serial, edits):
+    """Update the worker index for the writes up to serial"""
+    if serial == worker_state["serial"]:
+        return
+    index = worker_state["index"]
+    if not edits or edits[0][0] > worker_state["serial"] + 1:
+        index.reset(worker_state["grid"])
+    else:
+        for edit_serial, z, x, y, width, height in edits:
+            if edit_serial > worker_state["serial"]:
+                index.update_region(z, x, y, width, height)
+    worker_state["serial"] = serial
+
+
+def step_region(task):
+    """Step the mobs of one region like HumanSprite.update. Return the
+    worker pid and (x, y, dx, dy, found) for each mob, found telling
+    whether a tile of value on layer is in sight.
+    """
+    serial, edits, seed, speed, tilesize, layer, value, mobs = task
+    catch_up(serial, edits)
+    index = worker_state["index"]
+    rng = random.Random(seed)
+    results = []
+    for x, y, max_sightrange, min_sightrange in mobs:
+        dx = rng.randint(-1, 1)
+        dy = rng.randint(-1, 1)
+        x += dx * speed
+        y += dy * speed
+        found = index.any_within(
+            layer, value, x / tilesize, y / tilesize,
+            max_sightrange / tilesize, min_sightrange / tilesize)
+        results.append((x, y, dx, dy, found))
+    return os.getpid(), results
+
+
+def shared_dir():
+    """A RAM-backed directory for the terrain file where there is one"""
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class RegionSimulation:
+    """Runs mob steps in a pool of processes, one task per map region, or
+per part of one when there are fewer regions with mobs than processes.
+
+    share_grid() copies a TileGrid into the shared file and returns the
+    TileGrid to use from then on. Writes to it must be reported with
+    on_write(), and must not happen during step().
+    """
+
+    def __init__(self, processes=None, region_size=64, speed=2, seed=None):
+        self.processes = processes or os.cpu_count()
+        self.region_size = region_size
+        self.speed = speed
+        self.rng = random.Random(seed)
+        self.grid = None
+        self.path = None
+        self.pool = None
+        self.serial = 0
+        self.edits = deque(maxlen=EDIT_LOG_SIZE)
+        # {pid: serial} of the writes each worker has applied
+        self.worker_serials = {}
+        atexit.register(self.close)
+
+    def share_grid(self, grid) -> tilegrid.TileGrid:
+        fd, path = tempfile.mkstemp(prefix="boxrush-terrain-",
+                                    dir=shared_dir())
+        with os.fdopen(fd, "w+b") as f:
+            for z in range(grid.layer_num):
+                for y in range(grid.height):
+                    f.write(grid.row_bytes(z, 0, y, grid.width))
+            if not f.tell():
+                # an empty file cannot be mapped
+                f.write(b"\0")
+            f.flush()
+            data = mmap.mmap(f.fileno(), 0)
+        self.close()
+        self.path = path
+        self.grid = tilegrid.TileGrid(grid.layer_num, grid.height,
+                                      grid.width, data=data)
+        self.serial = 0
+        self.edits.clear()
+        self.worker_serials.clear()
+        return self.grid
+
+    def on_write(self, layer_id, x, y, width, height):
+        self.serial += 1
+        self.edits.append((self.serial, layer_id, x, y, width, height))
+
+    def start(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(
+                self.processes, init_worker,
+                (self.path, self.grid.layer_num, self.grid.height,
+                 self.grid.width, self.serial))
+
+    def step(self, mobs, tilesize, layer, value):
+        """Step mobs, a list of (x, y, max_sightrange, min_sightrange) in
+        pixels, and return (x, y, dx, dy, found) for each in the same order
+        """
+        self.start()
+        regions = {}
+        for i, mob in enumerate(mobs):
+            key = (int(mob[0]) // tilesize // self.region_size,
+                   int(mob[1]) // tilesize // self.region_size)
+            regions.setdefault(key, []).append(i)
+        # every process gets work even when the mobs are in a few regions
+        task_size = max(-(-len(mobs) // self.processes), 1)
+        batches = [regions[key][start:start + task_size]
+                   for key in sorted(regions)
+                   for start in range(0, len(regions[key]), task_size)]
+        edits = list(self.edits)
+        tasks = [(self.serial, edits, self.rng.getrandbits(32), self.speed,
+                  tilesize, layer, value, [mobs[i] for i in batch])
+                 for batch in batches]
+        results = [None] * len(mobs)
+        for batch, (pid, batch_results) in zip(
+                batches, self.pool.map(step_region, tasks)):
+            self.worker_serials[pid] = self.serial
+            for i, result in zip(batch, batch_results):
+                results[i] = result
+        if len(self.worker_serials) == self.processes:
+            # every worker has seen these
+            seen = min(self.worker_serials.values())
+            while self.edits and self.edits[0][0] <= seen:
+                self.edits.popleft()
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        # the mapping itself goes away with the last user of the grid
+        self.grid = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:  # still mapped, on Windows
+                pass
+            self.path = None
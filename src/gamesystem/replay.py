@@ -0,0 +1,167 @@
+"""Recordings of game sessions, to replay them exactly.
+
+A recording holds what a session started from, then the input of every
+frame: how many simulation steps ran, whether it rendered, the mouse and
+the held keys the scenes read, and the input events. Fed the same frames,
+the game ends in the same state whatever the time each frame takes, so a
+recording can be replayed headless as fast as it runs. The digest of the
+final state is stored at the end to check that it did. Worlds read from
+disk during the session are not part of the recording.
+
+    header  magic, version, seed, mob_processes, length of the start
+            scene name (see HEADER), then the name and the OPTIONS of the
+            game scene
+    frames  FRAME_TAG, FRAME, a KEY per held key and an EVENT per event
+    end     END_TAG, END: the frame count and state digest
+
+The stream is gzip compressed.
+"""
+import gzip
+import struct
+
+MAGIC = b"BXRP"
+VERSION = 3
+HEADER = struct.Struct("<4sHqBB")
+# map width, map height, OPTION_ flags; version 1 has none
+OPTIONS = struct.Struct("<IIB")
+OPTION_CHUNKED_TERRAIN = 1
+OPTION_VECTORIZED_MOBS = 2
+TAG = struct.Struct("<B")
+FRAME_TAG = 0
+END_TAG = 1
+# steps, flags, mouse x, mouse y, mouse buttons, key count, event count.
+# Steps fit 16 bits, enough for FixedTimestep at speeds up to 65535 /
+# max_steps.
+FRAME = struct.Struct("<HBhhBBH")
+# FRAME of versions 1 and 2, whose steps fit a byte
+FRAME_V2 = struct.Struct("<BBhhBBH")
+FLAG_RENDER = 1
+KEY = struct.Struct("<I")
+# kind, key or button, key modifiers, x, y, mouse buttons
+EVENT = struct.Struct("<BIHhhB")
+END = struct.Struct("<I20s")
+
+
+class ReplayError(Exception):
+    pass
+
+
+class FrameInput:
+    """Input of one frame. events are (kind, code, mod, x, y, buttons)
+    tuples, mouse_buttons a tuple of three bools and keys the held keys
+    among those recorded.
+    """
+
+    def __init__(self, steps=0, render=True, mouse_pos=(0, 0),
+                 mouse_buttons=(False, False, False), keys=(), events=()):
+        self.steps = steps
+        self.render = render
+        self.mouse_pos = mouse_pos
+        self.mouse_buttons = mouse_buttons
+        self.keys = frozenset(keys)
+        self.events = events
+
+    def key_pressed(self, key):
+        return key in self.keys
+
+
+def pack_buttons(buttons):
+    return sum(1 << i for i, pressed in enumerate(buttons) if pressed)
+
+
+def unpack_buttons(bits):
+    return tuple(bool(bits >> i & 1) for i in range(3))
+
+
+class Recorder:
+    def __init__(self, path, seed, mob_processes, scene, map_width=64,
+                 map_height=64, chunked_terrain=False, vectorized_mobs=False):
+        self.file = gzip.open(str(path), "wb")
+        name = scene.encode()
+        flags = ((OPTION_CHUNKED_TERRAIN if chunked_terrain else 0) |
+                 (OPTION_VECTORIZED_MOBS if vectorized_mobs else 0))
+        self.file.write(HEADER.pack(MAGIC, VERSION, seed, mob_processes,
+                                    len(name)) + name +
+                        OPTIONS.pack(map_width, map_height, flags))
+        self.frame_num = 0
+
+    def write_frame(self, frame):
+        parts = [TAG.pack(FRAME_TAG), FRAME.pack(
+            frame.steps, FLAG_RENDER if frame.render else 0,
+            frame.mouse_pos[0], frame.mouse_pos[1],
+            pack_buttons(frame.mouse_buttons), len(frame.keys),
+            len(frame.events))]
+        parts += [KEY.pack(key) for key in sorted(frame.keys)]
+        parts += [EVENT.pack(*event) for event in frame.events]
+        self.file.write(b"".join(parts))
+        self.frame_num += 1
+
+    def close(self, digest):
+        """End the recording with the digest of the final state"""
+        if self.file is None:
+            return
+        self.file.write(TAG.pack(END_TAG) + END.pack(self.frame_num, digest))
+        self.file.close()
+        self.file = None
+
+
+class Replay:
+    """A recording being read. digest and frame_num are those stored at
+    its end, known once frames() is exhausted, and None for a recording
+    that was cut short.
+    """
+
+    def __init__(self, path):
+        self.file = gzip.open(str(path), "rb")
+        try:
+            magic, version, self.seed, self.mob_processes, name_length = \
+                HEADER.unpack(self.read(HEADER.size))
+            if magic != MAGIC:
+                raise ReplayError("not a recording")
+            if not 1 <= version <= VERSION:
+                raise ReplayError(f"unsupported recording version {version}")
+            self.scene = self.read(name_length).decode()
+            self.map_width, self.map_height, flags = (
+                OPTIONS.unpack(self.read(OPTIONS.size)) if version > 1 else
+                (64, 64, 0))
+            self.chunked_terrain = bool(flags & OPTION_CHUNKED_TERRAIN)
+            self.frame_struct = FRAME if version > 2 else FRAME_V2
+            self.vectorized_mobs = bool(flags & OPTION_VECTORIZED_MOBS)
+        except (OSError, struct.error, UnicodeDecodeError) as e:
+            self.file.close()
+            raise ReplayError(f"bad recording header: {e}") from e
+        self.digest = None
+        self.frame_num = None
+
+    def read(self, size) -> bytes:
+        data = self.file.read(size)
+        if len(data) != size:
+            raise ReplayError("recording ends early")
+        return data
+
+    def frames(self):
+        """Yield the FrameInput of each recorded frame"""
+        try:
+            while True:
+                tag = self.file.read(TAG.size)
+                if not tag:
+                    return
+                if TAG.unpack(tag)[0] == END_TAG:
+                    self.frame_num, self.digest = END.unpack(
+                        self.read(END.size))
+                    return
+                (steps, flags, mouse_x, mouse_y, buttons, key_num,
+                 event_num) = self.frame_struct.unpack(
+                    self.read(self.frame_struct.size))
+                keys = [KEY.unpack(self.read(KEY.size))[0]
+                        for _ in range(key_num)]
+                events = [EVENT.unpack(self.read(EVENT.size))
+                          for _ in range(event_num)]
+                yield FrameInput(steps, bool(flags & FLAG_RENDER),
+                                 (mouse_x, mouse_y), unpack_buttons(buttons),
+                                 keys, events)
+        except (OSError, EOFError, ReplayError):
+            # a recording cut short by a crash replays up to there
+            return
+        finally:
+            self.file.close()
@@ -1,13 +1,29 @@
 class SceneManager:
     def __init__(self):
         self.scene_list = {}
+        # factories of the scenes not built yet
+        self.scene_factories = {}
         self.current_scene = None
 
     def append_scene(self, scene_name, scene):
-        self.scene_list[scene_name] = scene
+        """scene is a Scene, or a callable returning one which is called
+        when the scene is first used
+        """
+        if isinstance(scene, Scene):
+            self.scene_list[scene_name] = scene
+        else:
+            self.scene_factories[scene_name] = scene
+
+    def scene(self, scene_name):
+        """The scene of scene_name, built now if it was not yet"""
+        if scene_name not in self.scene_list:
+            self.scene_list[scene_name] = \
+                self.scene_factories.pop(scene_name)()
+        return self.scene_list[scene_name]
 
     def set_current_scene(self, scene_name):
-        self.current_scene = self.scene_list[scene_name]
+        self.current_scene = self.scene(scene_name)
+        self.current_scene.enter()
 
 
 class Scene:
@@ -20,5 +36,12 @@ class Scene:
     def update(self):
         pass
 
+    def enter(self):
+        """Called when the scene becomes the current one"""
+        pass
+
     def render(self):
+        """Draw the scene. May return the list of screen rects it changed;
+        None means the whole screen.
+        """
         pass
@@ -0,0 +1,143 @@
+from gamesystem.tileindex import ring_cells
+
+
+class SpatialHash:
+    """Uniform grid of points, each one an item at (x, y).
+
+    The plane is cut into cell_size x cell_size cells and each cell keeps
+    the items whose point is inside it, so queries only look at the items
+    of the cells that can be inside the searched area. Moving an item only
+    touches the cells when it leaves its cell. Items must be hashable and
+    are yielded in the order they entered their cell.
+    """
+
+    def __init__(self, cell_size=128):
+        self.cell_size = cell_size
+        # {(cell x, cell y): {item: None}}
+        self.cells = {}
+        # {item: [x, y, cell]}
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, item):
+        return item in self.points
+
+    def cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def insert(self, item, x, y):
+        if item in self.points:
+            self.move(item, x, y)
+            return
+        cell = self.cell(x, y)
+        self.points[item] = [x, y, cell]
+        self.cells.setdefault(cell, {})[item] = None
+
+    def move(self, item, x, y):
+        point = self.points[item]
+        point[0] = x
+        point[1] = y
+        cell = self.cell(x, y)
+        if cell == point[2]:
+            return
+        self.discard_from_cell(item, point[2])
+        point[2] = cell
+        self.cells.setdefault(cell, {})[item] = None
+
+    def remove(self, item):
+        self.discard_from_cell(item, self.points.pop(item)[2])
+
+    def discard_from_cell(self, item, cell):
+        items = self.cells[cell]
+        del items[item]
+        if not items:
+            del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.points.clear()
+
+    def position(self, item):
+        point = self.points[item]
+        return point[0], point[1]
+
+    def query_rect(self, x, y, width, height):
+        """Items whose point is inside the rect, right and bottom edges
+        excluded.
+        """
+        if width <= 0 or height <= 0:
+            return []
+        first_x, first_y = self.cell(x, y)
+        last_x, last_y = self.cell(x + width, y + height)
+        found = []
+        if (last_x - first_x + 1) * (last_y - first_y + 1) > len(self.cells):
+            # fewer cells hold items than the rect covers
+            cells = (items for (cell_x, cell_y), items in self.cells.items()
+                     if first_x <= cell_x <= last_x and
+                     first_y <= cell_y <= last_y)
+        else:
+            cells = (self.cells.get((cell_x, cell_y))
+                     for cell_y in range(first_y, last_y + 1)
+                     for cell_x in range(first_x, last_x + 1))
+        for items in cells:
+            if not items:
+                continue
+            for item in items:
+                item_x, item_y = self.points[item][:2]
+                if x <= item_x < x + width and y <= item_y < y + height:
+                    found.append(item)
+        return found
+
+    def query_radius(self, x, y, radius, min_radius=0):
+        """Items whose point is at a distance between min_radius and radius
+        from (x, y).
+        """
+        radius_sq = radius**2
+        min_radius_sq = min_radius**2
+        return [item for item in self.query_rect(
+                    x - radius, y - radius, radius * 2 + 1, radius * 2 + 1)
+                if min_radius_sq <= (self.points[item][0] - x)**2 +
+                (self.points[item][1] - y)**2 <= radius_sq]
+
+    def nearest(self, x, y, max_radius=None, exclude=None):
+        """The item nearest to (x, y) other than exclude, or None if there
+        is none within max_radius.
+        """
+        size = self.cell_size
+        best = None
+        best_sq = float("inf") if max_radius is None else max_radius**2
+        origin_x, origin_y = self.cell(x, y)
+        cells_seen = 0
+        lookups = 0
+        ring = 0
+        while cells_seen < len(self.cells):
+            # every cell of this ring is at least this far away
+            if ring > 0 and ((ring - 1) * size)**2 > best_sq:
+                return best
+            if lookups > len(self.points):
+                # the items left are far apart, look at each of them
+                for item, (item_x, item_y, _) in self.points.items():
+                    dist_sq = (item_x - x)**2 + (item_y - y)**2
+                    if dist_sq <= best_sq and item is not exclude:
+                        best = item
+                        best_sq = dist_sq
+                return best
+            for cell in ring_cells(origin_x, origin_y, ring):
+                lookups += 1
+                items = self.cells.get(cell)
+                if not items:
+                    continue
+                cells_seen += 1
+                for item in items:
+                    if item is exclude:
+                        continue
+                    item_x, item_y = self.points[item][:2]
+                    dist_sq = (item_x - x)**2 + (item_y - y)**2
+                    if dist_sq <= best_sq:
+                        best = item
+                        best_sq = dist_sq
+            ring += 1
+        # every cell holding items was searched
+        return best
@@ -0,0 +1,174 @@
+class TileLayer:
+    """[y][x] access to one layer of a TileGrid.
+
+    Rows are memoryview slices of the grid buffer, so reading and writing
+    through them touches the grid directly.
+    """
+
+    def __init__(self, grid, z):
+        self.grid = grid
+        self.z = z
+        self.buffer = grid.layer_buffer(z)
+
+    def __len__(self):
+        return self.grid.height
+
+    def __getitem__(self, y):
+        if y < 0:
+            y += self.grid.height
+        if not 0 <= y < self.grid.height:
+            raise IndexError("tile row index out of range")
+        start = y * self.grid.width
+        return self.buffer[start:start + self.grid.width]
+
+    def __iter__(self):
+        for y in range(self.grid.height):
+            yield self[y]
+
+
+class TileGrid:
+    """Layered tile map stored in one contiguous uint8 buffer.
+
+    Tiles are laid out layer by layer, then row by row, so a layer is a
+    single slice of the buffer and a row is a single slice of a layer.
+    grid[z][y][x] works like the nested lists it replaces.
+
+    data can be an existing writable buffer with a find method, such as a
+    bytearray or an mmap, holding the tiles from byte offset on.
+    """
+
+    def __init__(self, layer_num, height, width, init_value=0,
+                 data=None, offset=0):
+        self.layer_num = layer_num
+        self.height = height
+        self.width = width
+        self.layer_size = width * height
+        self.offset = offset
+        if data is None:
+            data = bytearray([init_value]) * (self.layer_size * layer_num)
+        elif len(data) < offset + self.layer_size * layer_num:
+            raise ValueError("tile data is smaller than the grid")
+        self.data = data
+        self.layers = [TileLayer(self, z) for z in range(layer_num)]
+
+    def __len__(self):
+        return self.layer_num
+
+    def __getitem__(self, z):
+        return self.layers[z]
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def index(self, z, x, y):
+        return self.offset + z * self.layer_size + y * self.width + x
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def get(self, z, x, y):
+        return self.data[self.index(z, x, y)]
+
+    def set(self, z, x, y, value):
+        self.data[self.index(z, x, y)] = value
+
+    def row_bytes(self, z, x, y, width) -> bytes:
+        start = self.index(z, x, y)
+        return bytes(self.data[start:start + width])
+
+    def layer_buffer(self, z):
+        start = self.index(z, 0, 0)
+        return memoryview(self.data)[start:start + self.layer_size]
+
+    def clip_region(self, x, y, width, height):
+        """Clip a region to the grid and return it as (x, y, width, height).
+        width or height is 0 when nothing is left.
+        """
+        left = max(x, 0)
+        top = max(y, 0)
+        right = min(x + width, self.width)
+        bottom = min(y + height, self.height)
+        return left, top, max(right - left, 0), max(bottom - top, 0)
+
+    def fill(self, z, x, y, width, height, value):
+        x, y, width, height = self.clip_region(x, y, width, height)
+        if not width or not height:
+            return
+        if width == self.width:
+            start = self.index(z, 0, y)
+            end = start + width * height
+            self.data[start:end] = bytes([value]) * (end - start)
+            return
+        row = bytes([value]) * width
+        for row_y in range(y, y + height):
+            start = self.index(z, x, row_y)
+            self.data[start:start + width] = row
+
+    def fill_layer(self, z, value):
+        self.fill(z, 0, 0, self.width, self.height, value)
+
+    def copy_region(self, src_z, x, y, width, height, dst_z, dst_x, dst_y,
+                    src_grid=None):
+        """Copy a rectangle of tiles from src_grid (default self) into this
+        grid. The region is clipped against both grids.
+        """
+        src_grid = self if src_grid is None else src_grid
+        src_x, src_y, width, height = src_grid.clip_region(
+            x, y, width, height)
+        dst_x += src_x - x
+        dst_y += src_y - y
+        left, top, width, height = self.clip_region(
+            dst_x, dst_y, width, height)
+        src_x += left - dst_x
+        src_y += top - dst_y
+        if not width or not height:
+            return
+        # rows are copied out first so overlapping regions stay intact
+        rows = []
+        for i in range(height):
+            start = src_grid.index(src_z, src_x, src_y + i)
+            rows.append(bytes(src_grid.data[start:start + width]))
+        for i, row in enumerate(rows):
+            start = self.index(dst_z, left, top + i)
+            self.data[start:start + width] = row
+
+    def replace(self, z, old_value, new_value,
+                x=0, y=0, width=None, height=None):
+        """Replace every old_value tile with new_value in a region of layer z
+        (the whole layer by default).
+        """
+        width = self.width if width is None else width
+        height = self.height if height is None else height
+        x, y, width, height = self.clip_region(x, y, width, height)
+        if not width or not height:
+            return
+        table = bytearray(range(256))
+        table[old_value] = new_value
+        table = bytes(table)
+        if width == self.width:
+            start = self.index(z, 0, y)
+            end = start + width * height
+            self.data[start:end] = self.data[start:end].translate(table)
+            return
+        for row_y in range(y, y + height):
+            start = self.index(z, x, row_y)
+            self.data[start:start + width] = \
+                self.data[start:start + width].translate(table)
+
+    def count(self, z, value):
+        start = self.index(z, 0, 0)
+        end = start + self.layer_size
+        if isinstance(self.data, bytearray):
+            return self.data.count(bytes([value]), start, end)
+        return self.data[start:end].count(bytes([value]))
+
+    def positions(self, z, value):
+        """Yield (x, y) of every tile in layer z equal to value."""
+        start = self.index(z, 0, 0)
+        end = start + self.layer_size
+        needle = bytes([value])
+        i = self.data.find(needle, start, end)
+        while i != -1:
+            y, x = divmod(i - start, self.width)
+            yield x, y
+            i = self.data.find(needle, i + 1, end)
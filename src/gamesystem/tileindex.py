@@ -0,0 +1,190 @@
+from array import array
+from collections import Counter
+
+
+class TileIndex:
+    """Bucketed count index over a TileGrid.
+
+    The grid is cut into bucket_size x bucket_size buckets and, for every
+    layer and tile value, the index keeps how many tiles of that value each
+    bucket holds. Queries skip empty buckets and only look at the tiles of
+    buckets that can be inside the searched area. Buckets are only counted
+when a query first needs them, and again after they are written, so
+making an index of a large grid reads none of it.
+
+    Distances are measured in tiles from a point to tile centers, so the
+    center of tile (x, y) is (x + 0.5, y + 0.5). bucket_size must be 255 at
+    most.
+    """
+
+    def __init__(self, grid, bucket_size=8):
+        self.bucket_size = bucket_size
+        self.reset(grid)
+
+    def reset(self, grid):
+        self.grid = grid
+        self.bucket_columns = -(-grid.width // self.bucket_size)
+        self.bucket_rows = -(-grid.height // self.bucket_size)
+        bucket_num = self.bucket_columns * self.bucket_rows
+        # counts[z][value] is an array of per bucket counts, valid for the
+        # buckets that are 1 in counted[z]
+        self.counts = [{} for z in range(grid.layer_num)]
+        self.counted = [bytearray(bucket_num) for z in range(grid.layer_num)]
+        self.uncounted = [bucket_num] * grid.layer_num
+
+    def bucket_region(self, bucket_x, bucket_y):
+        return self.grid.clip_region(
+            bucket_x * self.bucket_size, bucket_y * self.bucket_size,
+            self.bucket_size, self.bucket_size)
+
+    def update_region(self, z, x, y, width, height):
+        """Have the buckets overlapping a region of layer z counted again.
+        Call it after the tiles there were written.
+        """
+        x, y, width, height = self.grid.clip_region(x, y, width, height)
+        if not width or not height:
+            return
+        size = self.bucket_size
+        counted = self.counted[z]
+        for bucket_y in range(y // size, (y + height - 1) // size + 1):
+            start = bucket_y * self.bucket_columns
+            first = start + x // size
+            last = start + (x + width - 1) // size + 1
+            self.uncounted[z] += counted.count(1, first, last)
+            counted[first:last] = bytes(last - first)
+
+    def bucket_count(self, z, value, bucket_x, bucket_y):
+        """How many tiles equal to value a bucket holds"""
+        bucket = bucket_y * self.bucket_columns + bucket_x
+        if not self.counted[z][bucket]:
+            self.count_bucket(z, bucket_x, bucket_y)
+        counts = self.counts[z].get(value)
+        return counts[bucket] if counts else 0
+
+    def count_bucket(self, z, bucket_x, bucket_y):
+        bucket = bucket_y * self.bucket_columns + bucket_x
+        layer_counts = self.counts[z]
+        left, top, width, height = self.bucket_region(bucket_x, bucket_y)
+        tiles = b"".join(self.grid.row_bytes(z, left, row_y, width)
+                         for row_y in range(top, top + height))
+        for counts in layer_counts.values():
+            counts[bucket] = 0
+        for value, count in Counter(tiles).items():
+            if value not in layer_counts:
+                layer_counts[value] = array("H", [0]) * len(self.counted[z])
+            layer_counts[value][bucket] = count
+        self.counted[z][bucket] = 1
+        self.uncounted[z] -= 1
+
+    def absent(self, z, value):
+        """Whether layer z surely holds no tile equal to value"""
+        counts = self.counts[z].get(value)
+        return not self.uncounted[z] and not (counts and any(counts))
+
+    def count(self, z, value):
+        return self.grid.count(z, value)
+
+    def bucket_distance_sq(self, bucket_x, bucket_y, center_x, center_y):
+        """Smallest and largest squared distance from the center to the
+        tile centers of a bucket.
+        """
+        left, top, width, height = self.bucket_region(bucket_x, bucket_y)
+        near_x = min(max(center_x, left + 0.5), left + width - 0.5)
+        near_y = min(max(center_y, top + 0.5), top + height - 0.5)
+        far_x = max(abs(center_x - left - 0.5),
+                    abs(center_x - left - width + 0.5))
+        far_y = max(abs(center_y - top - 0.5),
+                    abs(center_y - top - height + 0.5))
+        return ((near_x - center_x)**2 + (near_y - center_y)**2,
+                far_x**2 + far_y**2)
+
+    def bucket_tiles(self, z, value, bucket_x, bucket_y):
+        """Yield (x, y) of the tiles equal to value in a bucket."""
+        left, top, width, height = self.bucket_region(bucket_x, bucket_y)
+        data = self.grid.data
+        needle = bytes([value])
+        for row_y in range(top, top + height):
+            start = self.grid.index(z, left, row_y)
+            end = start + width
+            i = data.find(needle, start, end)
+            while i != -1:
+                yield left + i - start, row_y
+                i = data.find(needle, i + 1, end)
+
+    def any_within(self, z, value, center_x, center_y, radius,
+                   min_radius=0) -> bool:
+        """Whether a tile equal to value has its center at a distance
+        between min_radius and radius from (center_x, center_y).
+        """
+        if self.absent(z, value):
+            return False
+        radius_sq = radius**2
+        min_radius_sq = min_radius**2
+        size = self.bucket_size
+        first_x = max(int((center_x - radius) // size), 0)
+        last_x = min(int((center_x + radius) // size),
+                     self.bucket_columns - 1)
+        first_y = max(int((center_y - radius) // size), 0)
+        last_y = min(int((center_y + radius) // size), self.bucket_rows - 1)
+        for bucket_y in range(first_y, last_y + 1):
+            for bucket_x in range(first_x, last_x + 1):
+                near_sq, far_sq = self.bucket_distance_sq(
+                    bucket_x, bucket_y, center_x, center_y)
+                if near_sq > radius_sq or far_sq < min_radius_sq:
+                    continue
+                if not self.bucket_count(z, value, bucket_x, bucket_y):
+                    continue
+                for x, y in self.bucket_tiles(z, value, bucket_x, bucket_y):
+                    dist_sq = ((x + 0.5 - center_x)**2 +
+                               (y + 0.5 - center_y)**2)
+                    if min_radius_sq <= dist_sq <= radius_sq:
+                        return True
+        return False
+
+    def nearest(self, z, value, center_x, center_y, max_radius=None):
+        """(x, y) of the tile equal to value whose center is nearest to
+        (center_x, center_y), or None if there is none within max_radius.
+        """
+        if self.absent(z, value):
+            return None
+        size = self.bucket_size
+        best = None
+        best_sq = float("inf") if max_radius is None else max_radius**2
+        origin_x = int(center_x // size)
+        origin_y = int(center_y // size)
+        max_ring = max(origin_x, self.bucket_columns - 1 - origin_x,
+                       origin_y, self.bucket_rows - 1 - origin_y)
+        for ring in range(max_ring + 1):
+            # every bucket of this ring is at least this far away
+            if ring > 0 and ((ring - 1) * size)**2 > best_sq:
+                break
+            for bucket_x, bucket_y in ring_cells(origin_x, origin_y, ring):
+                if not (0 <= bucket_x < self.bucket_columns and
+                        0 <= bucket_y < self.bucket_rows):
+                    continue
+                near_sq, far_sq = self.bucket_distance_sq(
+                    bucket_x, bucket_y, center_x, center_y)
+                if near_sq > best_sq:
+                    continue
+                if not self.bucket_count(z, value, bucket_x, bucket_y):
+                    continue
+                for x, y in self.bucket_tiles(z, value, bucket_x, bucket_y):
+                    dist_sq = ((x + 0.5 - center_x)**2 +
+                               (y + 0.5 - center_y)**2)
+                    if dist_sq <= best_sq:
+                        best = x, y
+                        best_sq = dist_sq
+        return best
+
+
+def ring_cells(center_x, center_y, ring):
+    """Yield the cells at Chebyshev distance ring from a center cell."""
+    if ring == 0:
+        yield center_x, center_y
+        return
+    for x in range(center_x - ring, center_x + ring + 1):
+        yield x, center_y - ring
+        yield x, center_y + ring
+    for y in range(center_y - ring + 1, center_y + ring):
+        yield center_x - ring, y
+        yield center_x + ring, y
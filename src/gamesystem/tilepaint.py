@@ -0,0 +1,129 @@
+"""Tile shapes painted by the terrain editor.
+
+Shapes are lists of spans (x, y, width), runs of tiles on one row, so a
+shape of any size is written with one fill per row. flood_spans() finds
+the area of alike tiles around a tile with a scanline fill that stops
+after max_tiles tiles, which bounds its work however large the area is.
+"""
+from collections import deque
+import math
+
+
+def line_points(x0, y0, x1, y1):
+    """Tiles of the line from (x0, y0) to (x1, y1), both ends included"""
+    dx = abs(x1 - x0)
+    dy = -abs(y1 - y0)
+    step_x = 1 if x0 < x1 else -1
+    step_y = 1 if y0 < y1 else -1
+    error = dx + dy
+    points = [(x0, y0)]
+    while (x0, y0) != (x1, y1):
+        double_error = error * 2
+        if double_error >= dy:
+            error += dy
+            x0 += step_x
+        if double_error <= dx:
+            error += dx
+            y0 += step_y
+        points.append((x0, y0))
+    return points
+
+
+def merge_spans(rows):
+    """Spans of {y: [(start x, end x), ...]}, overlapping runs merged"""
+    spans = []
+    for y in sorted(rows):
+        runs = sorted(rows[y])
+        start, end = runs[0]
+        for run_start, run_end in runs[1:]:
+            if run_start > end:
+                spans.append((start, y, end - start))
+                start = run_start
+            end = max(end, run_end)
+        spans.append((start, y, end - start))
+    return spans
+
+
+def stroke_spans(points, radius):
+    """Spans of a round brush of radius tiles moved over points, radius 0
+    painting the points alone
+    """
+    half_widths = [int(math.sqrt((radius + 0.5) ** 2 - dy * dy))
+                   for dy in range(-radius, radius + 1)]
+    rows = {}
+    for x, y in points:
+        for dy, half_width in zip(range(-radius, radius + 1), half_widths):
+            rows.setdefault(y + dy, []).append(
+                (x - half_width, x + half_width + 1))
+    return merge_spans(rows) if rows else []
+
+
+def rect_spans(x0, y0, x1, y1):
+    """Spans of the rectangle with corner tiles (x0, y0) and (x1, y1)"""
+    left = min(x0, x1)
+    width = abs(x1 - x0) + 1
+    return [(left, y, width) for y in range(min(y0, y1), max(y0, y1) + 1)]
+
+
+def flood_spans(grid, x, y, max_tiles):
+    """Spans of the tiles 4-connected to (x, y) through tiles with the same
+    tiles on every layer, nearest rows first. Stops after max_tiles tiles.
+    """
+    if not grid.in_bounds(x, y):
+        return []
+    # only rows of tiles max_tiles away or closer can be reached
+    left, _, width, _ = grid.clip_region(x - max_tiles, 0,
+                                         max_tiles * 2 + 1, 1)
+    # bytes.translate tables turning the tiles like (x, y) to 1, others to 0
+    tables = []
+    for z in range(grid.layer_num):
+        table = bytearray(256)
+        table[grid.get(z, x, y)] = 1
+        tables.append(bytes(table))
+    # {row y: bytearray of 1 for the alike tiles not filled yet}
+    masks = {}
+
+    def row_mask(row_y):
+        mask = masks.get(row_y)
+        if mask is None:
+            bits = -1
+            for z, table in enumerate(tables):
+                bits &= int.from_bytes(
+                    grid.row_bytes(z, left, row_y, width).translate(table),
+                    "little")
+            mask = masks[row_y] = bytearray(bits.to_bytes(width, "little"))
+        return mask
+
+    spans = []
+    tiles_left = max_tiles
+    queue = deque([(x - left, y)])
+    while queue and tiles_left > 0:
+        seed_x, row_y = queue.popleft()
+        mask = row_mask(row_y)
+        if not mask[seed_x]:
+            continue
+        start = mask.rfind(0, 0, seed_x) + 1
+        end = mask.find(0, seed_x)
+        if end < 0:
+            end = width
+        if end - start > tiles_left:
+            # take what is left of the budget around the seed
+            start = max(start, min(seed_x - tiles_left // 2,
+                                   end - tiles_left))
+            end = start + tiles_left
+        mask[start:end] = bytes(end - start)
+        spans.append((left + start, row_y, end - start))
+        tiles_left -= end - start
+        for next_y in (row_y - 1, row_y + 1):
+            if not 0 <= next_y < grid.height:
+                continue
+            next_mask = row_mask(next_y)
+            # one seed per run of alike tiles next to the span
+            run_x = next_mask.find(1, start, end)
+            while run_x >= 0:
+                queue.append((run_x, next_y))
+                run_x = next_mask.find(0, run_x, end)
+                if run_x < 0:
+                    break
+                run_x = next_mask.find(1, run_x, end)
+    return spans
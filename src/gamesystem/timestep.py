@@ -0,0 +1,56 @@
+import math
+
+
+class FixedTimestep:
+    """Accumulator that turns real elapsed time into fixed simulation steps.
+
+    speed scales the simulated time per real second, so 4 runs the world
+    four times faster. max_steps caps the steps run for one frame at speed
+    1, and grows with the speed so that fast-forwarding is not clamped;
+    when the simulation falls further behind than that, the backlog is
+    dropped and the world slows down instead of stalling the game.
+    """
+
+    def __init__(self, step_rate=60, max_steps=5, speed=1.0):
+        self.step_time = 1 / step_rate
+        self.max_steps = max_steps
+        self.speed = speed
+        self.accumulator = 0.0
+        self.dropped_time = 0.0
+
+    def advance(self, elapsed) -> int:
+        """Add elapsed real seconds and return how many steps to run now."""
+        self.accumulator += elapsed * self.speed
+        steps = int(self.accumulator // self.step_time)
+        max_steps = self.max_steps * max(math.ceil(self.speed), 1)
+        if steps > max_steps:
+            steps = max_steps
+            backlog = self.accumulator - steps * self.step_time
+            self.dropped_time += backlog - backlog % self.step_time
+            self.accumulator = steps * self.step_time + (
+                backlog % self.step_time)
+        self.accumulator -= steps * self.step_time
+        return steps
+
+    @property
+    def alpha(self) -> float:
+        """How far into the next step the simulation is, from 0 to 1"""
+        return self.accumulator / self.step_time
+
+
+class RenderThrottle:
+    """Tells whether a frame is due at render_rate frames per second."""
+
+    def __init__(self, render_rate=60):
+        self.render_rate = render_rate
+        self.since_render = float("inf")
+
+    def due(self, elapsed) -> bool:
+        frame_time = 1 / self.render_rate
+        self.since_render += elapsed
+        # a little slack so frames timed by a clock at the same rate are
+        # not skipped because of jitter
+        if self.since_render < frame_time * 0.9:
+            return False
+        self.since_render = 0.0
+        return True
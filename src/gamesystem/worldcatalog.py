@@ -0,0 +1,105 @@
+"""Index of the worlds saved in a directory.
+
+The catalog keeps what the world select screen shows of every world: its
+size, layer and mob counts and modification time, plus the file name of
+its thumbnail. It is stored as JSON next to the worlds, so listing them
+opens no world file. refresh() picks up worlds written or removed by
+other means from their modification times, reading only the headers of
+the files that changed.
+"""
+import json
+import os
+from pathlib import Path
+
+from gamesystem import worldfile
+
+CATALOG_NAME = "catalog.json"
+CATALOG_VERSION = 1
+WORLD_SUFFIX = ".world"
+
+
+class WorldCatalog:
+    def __init__(self, saves_dir):
+        self.saves_dir = Path(saves_dir)
+        self.path = self.saves_dir / CATALOG_NAME
+        # {world name: entry dict}
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(str(self.path)) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+            return
+        if catalog.get("version") != CATALOG_VERSION:
+            self.entries = {}
+            return
+        self.entries = catalog.get("worlds", {})
+
+    def save(self):
+        self.saves_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = str(self.path) + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"version": CATALOG_VERSION, "worlds": self.entries},
+                      f, indent=1)
+        os.replace(temp_path, str(self.path))
+
+    def world_path(self, name) -> Path:
+        return self.saves_dir / (name + WORLD_SUFFIX)
+
+    def read_entry(self, name, stat, thumbnail=None):
+        with open(str(self.world_path(name)), "rb") as f:
+            header = worldfile.read_header(f)
+        return dict(name=name, width=header["width"],
+                    height=header["height"], layer_num=header["layer_num"],
+                    mob_count=header["mob_count"], mtime=stat.st_mtime,
+                    file_size=stat.st_size, thumbnail=thumbnail)
+
+    def update(self, name, thumbnail=None):
+        """Record the world name as just saved, with the file name of its
+        thumbnail in saves_dir
+        """
+        stat = os.stat(str(self.world_path(name)))
+        self.entries[name] = self.read_entry(name, stat, thumbnail)
+        self.save()
+
+    def refresh(self):
+        """Bring the catalog in line with the world files in saves_dir.
+        Worlds changed by other means lose their thumbnail, which no longer
+        matches.
+        """
+        changed = False
+        found = set()
+        try:
+            dir_entries = list(os.scandir(str(self.saves_dir)))
+        except OSError:
+            dir_entries = []
+        for dir_entry in dir_entries:
+            if not (dir_entry.name.endswith(WORLD_SUFFIX) and
+                    dir_entry.is_file()):
+                continue
+            name = dir_entry.name[:-len(WORLD_SUFFIX)]
+            found.add(name)
+            stat = dir_entry.stat()
+            entry = self.entries.get(name)
+            if (entry is not None and entry["mtime"] == stat.st_mtime and
+                    entry["file_size"] == stat.st_size):
+                continue
+            try:
+                self.entries[name] = self.read_entry(name, stat)
+            except (OSError, worldfile.WorldFileError):
+                self.entries.pop(name, None)
+                found.discard(name)
+            changed = True
+        for name in set(self.entries) - found:
+            del self.entries[name]
+            changed = True
+        if changed:
+            self.save()
+
+    def worlds(self):
+        """Entries of all worlds, the most recently saved first"""
+        return sorted(self.entries.values(),
+                      key=lambda entry: entry["mtime"], reverse=True)
@@ -0,0 +1,242 @@
+"""Binary world files.
+
+A world file is a header followed by the tiles of each layer, row by row,
+in chunks of chunk_rows rows, and then one record per mob:
+
+    header  magic, version, flags, layer_num, width, height, chunk_rows,
+            mob_count (see HEADER)
+    chunks  raw tiles, or with FLAG_ZLIB a length and zlib data per chunk
+    mobs    x, y, max_sightrange, min_sightrange (see MOB)
+
+Uncompressed tiles are stored as one contiguous run straight after the
+header, which lets load() map them into memory instead of reading them.
+
+A chunked world (FLAG_CHUNKED, since version 2) only stores the chunks it
+has, chunk_rows being its chunk size. Its tiles are instead
+
+    init    the tile of each layer outside the chunks, a byte per layer
+    count   the number of chunks (see CHUNK_COUNT)
+    chunks  per chunk its chunk x and y (see CHUNK_KEY) and its tiles layer
+            by layer, raw or with FLAG_ZLIB a length and zlib data
+"""
+import mmap
+import os
+import struct
+import zlib
+
+from gamesystem import chunkgrid
+from gamesystem import tilegrid
+
+MAGIC = b"BXRW"
+VERSION = 2
+FLAG_ZLIB = 1
+FLAG_CHUNKED = 2
+HEADER = struct.Struct("<4sHHH2xIIII")
+CHUNK_LENGTH = struct.Struct("<I")
+CHUNK_COUNT = struct.Struct("<I")
+CHUNK_KEY = struct.Struct("<II")
+MOB = struct.Struct("<iiff")
+
+
+class WorldFileError(Exception):
+    pass
+
+
+def save(path, grid, mobs=(), compress=False, chunk_rows=64):
+    """Write grid and mobs, an iterable of (x, y, max_sightrange,
+    min_sightrange), to path.
+
+    grid can be a TileGrid, or a chunked grid like ChunkedTileGrid, with
+    init_values, chunk_size, known_chunks() and chunk_bytes(), which is
+    saved as a chunked world. Tiles are written a chunk at a time, so no
+    copy of the whole map is made. The file is written next to path and
+    then moved over it, so a failed save leaves the old file intact.
+    """
+    path = str(path)
+    mobs = list(mobs)
+    chunked = hasattr(grid, "chunk_bytes")
+    flags = (FLAG_ZLIB if compress else 0) | (FLAG_CHUNKED if chunked else 0)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, flags, grid.layer_num,
+                            grid.width, grid.height,
+                            grid.chunk_size if chunked else chunk_rows,
+                            len(mobs)))
+        if chunked:
+            keys = sorted(grid.known_chunks())
+            f.write(bytes(grid.init_values) + CHUNK_COUNT.pack(len(keys)))
+            for key in keys:
+                f.write(CHUNK_KEY.pack(*key))
+                write_tiles(f, grid.chunk_bytes(key), compress)
+        else:
+            for z in range(grid.layer_num):
+                for y in range(0, grid.height, chunk_rows):
+                    rows = min(chunk_rows, grid.height - y)
+                    write_tiles(f, b"".join(
+                        grid.row_bytes(z, 0, row_y, grid.width)
+                        for row_y in range(y, y + rows)), compress)
+        for mob in mobs:
+            f.write(MOB.pack(*mob))
+    os.replace(temp_path, path)
+
+
+def write_tiles(f, tiles, compress):
+    if compress:
+        tiles = zlib.compress(tiles)
+        f.write(CHUNK_LENGTH.pack(len(tiles)))
+    f.write(tiles)
+
+
+def read_tiles(f, size, compressed) -> bytes:
+    if compressed:
+        try:
+            length, = CHUNK_LENGTH.unpack(f.read(CHUNK_LENGTH.size))
+            tiles = zlib.decompress(f.read(length))
+        except (struct.error, zlib.error) as e:
+            raise WorldFileError(f"broken tile chunk: {e}")
+    else:
+        tiles = f.read(size)
+    if len(tiles) != size:
+        raise WorldFileError("truncated tile data")
+    return tiles
+
+
+def read_header(f):
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise WorldFileError("truncated world file header")
+    (magic, version, flags, layer_num, width, height, chunk_rows,
+     mob_count) = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise WorldFileError("not a world file")
+    if not 1 <= version <= VERSION:
+        raise WorldFileError(f"unsupported world file version {version}")
+    return dict(flags=flags, layer_num=layer_num, width=width,
+                height=height, chunk_rows=chunk_rows, mob_count=mob_count)
+
+
+def read_mobs(f, mob_count):
+    data = f.read(MOB.size * mob_count)
+    if len(data) < MOB.size * mob_count:
+        raise WorldFileError("truncated mob data")
+    return list(MOB.iter_unpack(data))
+
+
+def load(path, use_mmap=True, chunk_size=None):
+    """Read a world file and return (grid, mobs).
+
+    With chunk_size, grid is a ChunkedTileGrid, of chunks of that size
+    unless the world is chunked already. Otherwise it is a TileGrid, whose
+    uncompressed tiles are memory-mapped copy-on-write when use_mmap is
+    true: pages are read only when touched and edits never reach the file.
+    """
+    with open(str(path), "rb") as f:
+        header = read_header(f)
+        if header["flags"] & FLAG_CHUNKED:
+            grid = read_chunked(f, header, chunk_size is not None)
+        else:
+            grid = read_dense(f, header, use_mmap)
+            if chunk_size is not None:
+                grid = chunked_copy(grid, chunk_size)
+        mobs = read_mobs(f, header["mob_count"])
+    return grid, mobs
+
+
+def read_dense(f, header, use_mmap) -> tilegrid.TileGrid:
+    layer_num = header["layer_num"]
+    width = header["width"]
+    height = header["height"]
+    size = layer_num * width * height
+    if header["flags"] & FLAG_ZLIB:
+        data = bytearray(size)
+        position = 0
+        while position < size:
+            try:
+                length, = CHUNK_LENGTH.unpack(f.read(CHUNK_LENGTH.size))
+                chunk = zlib.decompress(f.read(length))
+            except (struct.error, zlib.error) as e:
+                raise WorldFileError(f"broken tile chunk: {e}")
+            data[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        return tilegrid.TileGrid(layer_num, height, width, data=data)
+    if use_mmap and size:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if len(data) < HEADER.size + size:
+            raise WorldFileError("truncated tile data")
+        f.seek(HEADER.size + size)
+        return tilegrid.TileGrid(layer_num, height, width,
+                                 data=data, offset=HEADER.size)
+    data = bytearray(size)
+    if f.readinto(data) < size:
+        raise WorldFileError("truncated tile data")
+    return tilegrid.TileGrid(layer_num, height, width, data=data)
+
+
+def read_chunked(f, header, chunked):
+    """The tiles of a chunked world as a ChunkedTileGrid, or with chunked
+    false as a TileGrid
+    """
+    layer_num = header["layer_num"]
+    width = header["width"]
+    height = header["height"]
+    chunk_size = header["chunk_rows"]
+    init_values = f.read(layer_num)
+    if len(init_values) < layer_num:
+        raise WorldFileError("truncated init values")
+    try:
+        count, = CHUNK_COUNT.unpack(f.read(CHUNK_COUNT.size))
+    except struct.error:
+        raise WorldFileError("truncated chunk count")
+    if chunked:
+        grid = chunkgrid.ChunkedTileGrid(layer_num, height, width,
+                                         chunk_size=chunk_size)
+        grid.init_values = list(init_values)
+    else:
+        grid = tilegrid.TileGrid(layer_num, height, width)
+        for z, value in enumerate(init_values):
+            grid.fill_layer(z, value)
+    for _ in range(count):
+        try:
+            key = CHUNK_KEY.unpack(f.read(CHUNK_KEY.size))
+        except struct.error:
+            raise WorldFileError("truncated chunk")
+        x, y, chunk_width, chunk_height = grid.clip_region(
+            key[0] * chunk_size, key[1] * chunk_size, chunk_size, chunk_size)
+        if not chunk_width or not chunk_height:
+            raise WorldFileError(f"chunk {key} is outside the world")
+        tiles = read_tiles(f, layer_num * chunk_width * chunk_height,
+                           header["flags"] & FLAG_ZLIB)
+        chunk = tilegrid.TileGrid(layer_num, chunk_height, chunk_width,
+                                  data=bytearray(tiles))
+        if chunked:
+            grid.put_chunk(key, chunk)
+            continue
+        for z in range(layer_num):
+            for row in range(chunk_height):
+                start = grid.index(z, x, y + row)
+                grid.data[start:start + chunk_width] = chunk.row_bytes(
+                    z, 0, row, chunk_width)
+    return grid
+
+
+def chunked_copy(grid, chunk_size) -> chunkgrid.ChunkedTileGrid:
+    """A ChunkedTileGrid of the tiles of a TileGrid. Only the chunks with
+    tiles other than the top left one of their layer are created.
+    """
+    layer_num = grid.layer_num
+    chunked = chunkgrid.ChunkedTileGrid(layer_num, grid.height, grid.width,
+                                        chunk_size=chunk_size)
+    if not grid.width or not grid.height:
+        return chunked
+    chunked.init_values = [grid.get(z, 0, 0) for z in range(layer_num)]
+    for key in chunked.chunks_in_region(0, 0, grid.width, grid.height):
+        x, y, width, height = chunked.chunk_region(*key)
+        layers = [b"".join(grid.row_bytes(z, x, row_y, width)
+                           for row_y in range(y, y + height))
+                  for z in range(layer_num)]
+        if all(tiles.count(value) == len(tiles) for tiles, value in
+               zip(layers, chunked.init_values)):
+            continue
+        chunked.put_chunk(key, tilegrid.TileGrid(
+            layer_num, height, width, data=bytearray(b"".join(layers))))
+    return chunked
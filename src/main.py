@@ -1,23 +1,96 @@
+import argparse
+from collections import OrderedDict
+import contextlib
+import hashlib
+import os
 import pathlib
 from pathlib import Path
 import sys
+import threading
+import time
 from typing import Tuple
 import random
 import math
+import struct
 
 import pygame
 
 from gamesystem import scene_transision as scenetrans
+from gamesystem import autosave
+from gamesystem import chunkgrid
+from gamesystem import chunkstore
+from gamesystem import history
+from gamesystem import tilegrid
+from gamesystem import tileindex
+from gamesystem import tilepaint
+from gamesystem import mobsim
+from gamesystem import navigation
+from gamesystem import profiler
+from gamesystem import regionsim
+from gamesystem import replay
+from gamesystem import spatialhash
+from gamesystem import timestep
+from gamesystem import worldcatalog
+from gamesystem import worldfile
 
 GAME_TITLE = "YUMA"
+DEFAULT_FONT = "misaki_gothic_2nd.ttf"
 MAIN_PRG_DIR = pathlib.Path(__file__).absolute().parent
 SCRN_WIDTH = 768  # 512*1.5
 SCRN_HEIGHT = 651  # 434*1.5
 SCRN_SIZE = SCRN_WIDTH, SCRN_HEIGHT
 BLACK = 0, 0, 0
 WHITE = 255, 255, 255
+TOOLBAR_HEIGHT = 139
+TOOLBAR_COLOR = 144, 78, 144
+GAME_BG_COLOR = 127, 127, 255
+# the whole screen is updated at once when more of it than this is dirty
+FULL_UPDATE_FRACTION = 0.7
+# debug keys: performance overlay, write a frame trace, cProfile frames
+OVERLAY_KEY = pygame.K_F3
+TRACE_KEY = pygame.K_F4
+PROFILE_KEY = pygame.K_F5
+PROFILE_FRAMES = 120
+# keys whose held state the scenes read, and so recordings keep
+WATCHED_KEYS = [pygame.K_UP, pygame.K_DOWN, pygame.K_RIGHT, pygame.K_LEFT]
+# replay event kinds of the pygame events the scenes handle
+RECORDED_EVENTS = {pygame.QUIT: 0, pygame.KEYDOWN: 1, pygame.KEYUP: 2,
+                   pygame.MOUSEBUTTONDOWN: 3, pygame.MOUSEBUTTONUP: 4,
+                   pygame.MOUSEMOTION: 5}
+EVENT_TYPES = {kind: event_type
+               for event_type, kind in RECORDED_EVENTS.items()}
+# assets of the scenes after the title, read while the title shows
+PRELOAD_IMAGES = ["world_picture_frame.png", "button.png", "btn_icon.png",
+                  "skyeyebg.png", "human.png"]
+PRELOAD_FONT_SIZES = [16, 24, 32]
+THUMBNAIL_SIZE = 64  # most pixels per side of a saved world thumbnail
+AUTOSAVE_INTERVAL = 120  # seconds of game time between autosaves
+# zlib saves are smaller, uncompressed ones are memory-mapped when loaded
+COMPRESS_SAVES = False
 KEY_REPEAT_DELAY = 125
 KEY_REPEAT_INTERVAL = 125
+FPS = 60
+SIM_RATE = 60  # simulation steps per second of game time
+MAX_SIM_STEPS = 5  # most simulation steps run in one frame
+TILE_CHUNK_SIZE = 64  # tiles per side of a chunk of a chunked terrain
+TERRAIN_CHUNK_SIZE = 32  # tiles per side of a cached terrain surface
+TERRAIN_SURFACE_BUDGET = 64 << 20  # bytes of cached terrain surfaces
+MAX_ZOOM = 6  # zoom levels show 2**level world pixels per screen pixel
+LOD_ZOOM = 3  # first zoom level drawn from the terrain pyramid
+LOD_CELL_SIZE = 256  # pixels per side of a terrain pyramid cell
+LOD_SURFACE_BUDGET = 32 << 20  # bytes of cached terrain pyramid cells
+LOD_BUILDS_PER_FRAME = 4  # most pyramid cells built in one frame
+MINIMAP_SIZE = 128  # most tiles per side shown on the minimap
+MOB_HASH_CELL_SIZE = 128  # world pixels per side of a mob spatial hash cell
+# minimap color of a tile by its top non-empty layer, first for no layer
+MINIMAP_COLORS = [(0, 0, 0), (123, 0, 0), (123, 123, 0), (255, 255, 0),
+                  (78, 255, 125)]
+# bytes.translate tables from the layer bits of a tile to each channel of
+# its minimap color, the highest bit set being the top layer
+MINIMAP_CHANNEL_TABLES = [
+    bytes(MINIMAP_COLORS[min(flags.bit_length(), len(MINIMAP_COLORS) - 1)]
+          [channel] for flags in range(256))
+    for channel in range(3)]
 
 
 class AssetPathGetter:
@@ -42,21 +115,135 @@ assets_path = AssetPathGetter(
     MAIN_PRG_DIR / "assets", "fonts", "imgs", "saves")
 
 
+def minimap_image(terrain_map, x, y, width, height,
+                  step=1) -> pygame.Surface:
+    """Minimap pixels of a tile region, one per tile, or per step x step
+    tiles sampling the top left one.
+
+    Each layer becomes one bit per tile with bytes.translate, the layers
+    are merged with a single big-int OR and the bits are translated to
+    colors, so no Python code runs per tile.
+    """
+    image_width = len(range(0, width, step))
+    image_height = len(range(0, height, step))
+    flags = 0
+    for z in range(min(len(terrain_map), len(MINIMAP_COLORS) - 1)):
+        tiles = b"".join(terrain_map.row_bytes(z, x, row_y, width)[::step]
+                         for row_y in range(y, y + height, step))
+        layer_bit = bytes([0] + [1 << z] * 255)
+        flags |= int.from_bytes(tiles.translate(layer_bit), "big")
+    flags = flags.to_bytes(image_width * image_height, "big")
+    rgb = bytearray(image_width * image_height * 3)
+    for channel, table in enumerate(MINIMAP_CHANNEL_TABLES):
+        rgb[channel::3] = flags.translate(table)
+    return pygame.image.frombuffer(bytes(rgb), (image_width, image_height),
+                                   "RGB")
+
+
+def tile_color_image(terrain_map, x, y, width, height,
+                     color_tables) -> pygame.Surface:
+    """Pixels of a tile region, one per tile of the average color of its
+    top tile image. color_tables are the bytes.translate tables of
+    TileAtlas.color_tables(), so layers are merged with big-int ops as in
+    minimap_image.
+    """
+    channel_tables, clear_table = color_tables
+    channels = [0, 0, 0]
+    for z in range(len(terrain_map)):
+        tiles = b"".join(terrain_map.row_bytes(z, x, row_y, width)
+                         for row_y in range(y, y + height))
+        # tiles with an image hide those of the layers under them
+        clear = int.from_bytes(tiles.translate(clear_table), "little")
+        for channel, table in enumerate(channel_tables):
+            channels[channel] = (channels[channel] & clear) | int.from_bytes(
+                tiles.translate(table), "little")
+    rgb = bytearray(width * height * 3)
+    for channel, value in enumerate(channels):
+        rgb[channel::3] = value.to_bytes(width * height, "little")
+    return pygame.image.frombuffer(bytes(rgb), (width, height), "RGB")
+
+
+def world_thumbnail(terrain_map) -> pygame.Surface:
+    """Minimap of a whole map at most THUMBNAIL_SIZE pixels per side"""
+    step = max(-(-max(terrain_map.width, terrain_map.height) //
+                 THUMBNAIL_SIZE), 1)
+    return minimap_image(terrain_map, 0, 0, terrain_map.width,
+                         terrain_map.height, step)
+
+
 class WorldDataManager:
-    def __init__(self, saves_dir_path):
+    def __init__(self, saves_dir_path, compress=COMPRESS_SAVES):
         self.saves_dir = Path(saves_dir_path)
+        # whether worlds are saved compressed
+        self.compress = compress
+        self.catalog = worldcatalog.WorldCatalog(self.saves_dir)
+        # saver updates the catalog from its thread, under lock
+        self.saver = autosave.BackgroundSaver()
+        self.lock = threading.Lock()
 
     def list_worlds(self):
-        return self.saves_dir.iterdir()
-
-    def save_world(self):
-        pass
+        """Catalog entries of the saved worlds, the newest first"""
+        with self.lock:
+            self.catalog.refresh()
+            return self.catalog.worlds()
+
+    def world_path(self, name) -> pathlib.Path:
+        return self.catalog.world_path(name)
+
+    def thumbnail_path(self, thumbnail) -> pathlib.Path:
+        return self.saves_dir / "thumbnails" / thumbnail
+
+    def new_world_name(self):
+        """A name no saved world has yet"""
+        name = "world"
+        number = 1
+        with self.lock:
+            while (name in self.catalog.entries or
+                   self.world_path(name).exists()):
+                number += 1
+                name = f"world{number}"
+        return name
+
+    def save_world(self, name, terrain, mobs=()):
+        """mobs: iterable of (x, y, max_sightrange, min_sightrange)"""
+        self.write_world(name, terrain.map, mobs)
+
+    def save_world_in_background(self, name, terrain, mobs):
+        """Save from a snapshot on the saver thread. mobs is a list of
+        (x, y, max_sightrange, min_sightrange).
+        """
+        snapshot = terrain.snapshot()
+
+        def save():
+            try:
+                self.write_world(name, snapshot, mobs)
+            finally:
+                snapshot.close()
+        self.saver.submit(name, save)
+
+    def write_world(self, name, grid, mobs):
+        self.saves_dir.mkdir(parents=True, exist_ok=True)
+        worldfile.save(self.world_path(name), grid, mobs, self.compress)
+        thumbnail = f"{name}.png"
+        thumbnail_path = self.thumbnail_path(thumbnail)
+        thumbnail_path.parent.mkdir(exist_ok=True)
+        pygame.image.save(world_thumbnail(grid), str(thumbnail_path))
+        with self.lock:
+            self.catalog.update(name, thumbnail)
+
+    def load_world(self, name, chunk_size=None):
+        """Return (tile grid, mobs) of a saved world, the grid being a
+        ChunkedTileGrid with chunk_size
+        """
+        if self.saver.busy(name):
+            self.saver.wait()
+        return worldfile.load(self.world_path(name), chunk_size=chunk_size)
 
 
 class SpriteSheet:
     def __init__(self, filename, row_num: int, column_num: int,
                  cell_width: int, cell_height: int, colorkey: Tuple):
-        self.sheet = pygame.image.load(str(filename)).convert_alpha()
+        self.sheet = asset_cache.load_image(filename).convert_alpha()
         self.colorkey = colorkey
         # self.sheet.set_colorkey(self.colorkey)
         self.row_num = row_num
@@ -65,6 +252,7 @@ class SpriteSheet:
         self.cell_height = cell_height
         self.current_row = 0
         self.current_column = 0
+        self.cell_cache = {}
 
     def image_by_area(self, x, y, width, height) -> pygame.Surface:
         image = pygame.Surface((width, height))
@@ -85,46 +273,234 @@ class SpriteSheet:
     def image_by_current(self) -> pygame.Surface:
         return self.image_by_cell(self.current_row, self.current_column)
 
+    def cell(self, row, column) -> pygame.Surface:
+        """Same image as image_by_cell, but sliced once and then shared.
+        Do not draw on the returned surface.
+        """
+        key = row, column
+        if key not in self.cell_cache:
+            self.cell_cache[key] = self.image_by_cell(row, column).convert()
+        return self.cell_cache[key]
+
+
+class TileAtlas:
+    """Keeps every sprite sheet loaded once and maps tile ids to the cell
+    images they are drawn with.
+    """
+
+    def __init__(self):
+        self.sheets = {}
+        self.tile_imgs = {}
+        # {tile size: tile_imgs scaled to it}
+        self.scaled_imgs = {}
+
+    def sheet(self, filename, row_num: int, column_num: int,
+              cell_width: int, cell_height: int,
+              colorkey: Tuple = BLACK) -> SpriteSheet:
+        key = str(filename), cell_width, cell_height
+        if key not in self.sheets:
+            self.sheets[key] = SpriteSheet(
+                filename, row_num, column_num, cell_width, cell_height,
+                colorkey)
+        return self.sheets[key]
+
+    def assign_tiles(self, tile_id_assign, sheet: SpriteSheet, tile_cells):
+        """tile_cells: {tile type: (row, column) in sheet}"""
+        for tile, (row, column) in tile_cells.items():
+            self.tile_imgs[tile_id_assign[tile]] = sheet.cell(row, column)
+        self.scaled_imgs.clear()
+
+    def tile_img(self, tile_id) -> pygame.Surface:
+        return self.tile_imgs.get(tile_id)
+
+    def scaled_tile_imgs(self, size):
+        """tile_imgs scaled to size x size pixels"""
+        imgs = self.scaled_imgs.get(size)
+        if imgs is None:
+            imgs = self.scaled_imgs[size] = {
+                tile_id: (img if img.get_size() == (size, size) else
+                          pygame.transform.smoothscale(img.convert_alpha(),
+                                                       (size, size)))
+                for tile_id, img in self.tile_imgs.items()}
+        return imgs
+
+    def color_tables(self):
+        """bytes.translate tables from a tile id to each channel of the
+        average color of the opaque pixels of its image, and to 255 for
+        ids without an image (0 otherwise)
+        """
+        channel_tables = [bytearray(256) for _ in range(3)]
+        clear_table = bytearray(b"\xff" * 256)
+        for tile_id, img in self.tile_imgs.items():
+            red, green, blue, alpha = pygame.transform.average_color(
+                img.convert_alpha())
+            if not alpha:
+                continue
+            # transparent pixels are black, leave them out of the average
+            for table, value in zip(channel_tables, (red, green, blue)):
+                table[tile_id] = min(value * 255 // alpha, 255)
+            clear_table[tile_id] = 0
+        return [bytes(table) for table in channel_tables], bytes(clear_table)
+
+
+tile_atlas = TileAtlas()
+
+
+class AssetCache:
+    """Loads each font and image once and keeps the text rendered lately.
+
+    Fonts are keyed by (path, size) and images by path. Rendered text is
+    kept in an LRU of at most max_texts surfaces keyed by (text, font path,
+    size, color). Do not draw on the returned surfaces.
+    """
+
+    def __init__(self, max_texts=256):
+        self.fonts = {}
+        self.images = {}
+        self.texts = OrderedDict()
+        self.max_texts = max_texts
+        # images read by preload and not converted yet, by path
+        self.preloaded_images = {}
+        self.preload_thread = None
+
+    def preload(self, image_paths, font_sizes=()):
+        """Read images and open fonts of DEFAULT_FONT in a background
+        thread. Surfaces are only converted for the display when first
+        used, on the main thread.
+        """
+        def load():
+            for path in image_paths:
+                self.preloaded_images[str(path)] = \
+                    pygame.image.load(str(path))
+            for size in font_sizes:
+                self.font(assets_path.font_path(DEFAULT_FONT), size)
+        self.preload_thread = threading.Thread(target=load, daemon=True)
+        self.preload_thread.start()
+
+    def load_image(self, filename) -> pygame.Surface:
+        """The image at filename as read from disk, unconverted. Taken from
+        the preloaded ones when there.
+        """
+        image = self.preloaded_images.pop(str(filename), None)
+        if image is None:
+            image = pygame.image.load(str(filename))
+        return image
+
+    def font(self, filename, size) -> pygame.font.Font:
+        key = str(filename), size
+        if key not in self.fonts:
+            self.fonts[key] = pygame.font.Font(str(filename), size)
+        return self.fonts[key]
+
+    def image(self, filename) -> pygame.Surface:
+        key = str(filename)
+        if key not in self.images:
+            self.images[key] = self.load_image(key).convert_alpha()
+        return self.images[key]
+
+    def text(self, text, size, color=WHITE,
+             filename=None) -> pygame.Surface:
+        if filename is None:
+            filename = assets_path.font_path(DEFAULT_FONT)
+        key = text, str(filename), size, tuple(color)
+        surface = self.texts.get(key)
+        if surface is not None:
+            self.texts.move_to_end(key)
+            return surface
+        surface = self.font(filename, size).render(text, True, color)
+        self.texts[key] = surface
+        if len(self.texts) > self.max_texts:
+            self.texts.popitem(last=False)
+        return surface
+
+
+asset_cache = AssetCache()
+
 
 class HumanSprite(pygame.sprite.Sprite):
-    def __init__(self, x, y, terrain, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    """A human mob. Given a mobsim.MobSimulation as sim, the mob is moved by
+    the simulation instead of update(), and x/y only follow it when
+    sync_from_sim is called.
+    """
+
+    def __init__(self, x, y, terrain, *args, sim=None, max_sightrange=160,
+                 min_sightrange=0, rng=random, **kwargs):
+        # set by the MobGroup the mob is in
+        self.spatial_hash = None
         self.x = x
         self.y = y
+        self.rng = rng
         self.terrain = terrain
         self.dx = 0
         self.dy = 0
-        self.max_sightrange = 160
-        self.min_sightrange = 0
+        self.max_sightrange = max_sightrange
+        self.min_sightrange = min_sightrange
         self.target_pos = None
+        # whether a tree was in sight range after the last update
+        self.tree_in_sight = False
         self.rect = pygame.Rect(self.x, self.y, 6, 8)
-        self.sheet = SpriteSheet(assets_path.img_path(
+        self.sheet = tile_atlas.sheet(assets_path.img_path(
             "human.png"), 4, 4, 6, 8, BLACK)
-        self.image = self.sheet.image_by_cell(1, 1)
+        self.image = self.sheet.cell(1, 1)
+        self.sim = sim
+        self.sim_index = None
+        if sim is not None:
+            sim.add(self, x, y, self.max_sightrange, self.min_sightrange)
+        # last, as groups given here read the fields above
+        super().__init__(*args, **kwargs)
 
     def update(self, *args, **kwargs):
-        self.random_direction()
+        if self.sim is not None:
+            return
+        if self.target_pos is not None:
+            self.head_for_target()
+        else:
+            self.random_direction()
         self.x += self.dx * 2
         self.y += self.dy * 2
         self.update_img_pos()
-        search_result = self.search_tile("Tree", 3)
-        if search_result:
-            print("can find")
+        self.tree_in_sight = self.search_tile("Tree", 3)
         # self.can_see_in_sightrange((0, 0))
 
     def random_direction_y(self):
-        self.dy = random.randint(-1, 1)
+        self.dy = self.rng.randint(-1, 1)
 
     def random_direction_x(self):
-        self.dx = random.randint(-1, 1)
+        self.dx = self.rng.randint(-1, 1)
 
     def random_direction(self):
         self.random_direction_x()
         self.random_direction_y()
 
+    def head_for_target(self):
+        """Set dx and dy to follow the terrain flow fields to target_pos.
+        Mobs heading for the same tile share them.
+        """
+        tilesize = self.terrain.tilesize
+        navigator = self.terrain.navigator
+        goal_x = int(self.target_pos[0] // tilesize)
+        goal_y = int(self.target_pos[1] // tilesize)
+        col, row = self.pos_as_tilemap()
+        col, row = int(col), int(row)
+        direction = navigator.direction(col, row, goal_x, goal_y)
+        if direction is not None and direction != (0, 0):
+            self.dx, self.dy = direction
+            return
+        # on the goal tile, or no path: go straight for the target
+        dist_x = self.target_pos[0] - self.x
+        dist_y = self.target_pos[1] - self.y
+        self.dx = (dist_x >= 2) - (dist_x <= -2)
+        self.dy = (dist_y >= 2) - (dist_y <= -2)
+        if direction is None:
+            # but not into a blocked tile
+            self.dx, self.dy = navigator.open_direction(
+                col, row, self.dx, self.dy)
+
     def update_img_pos(self):
         self.rect.x = self.x
         self.rect.y = self.y
+        if self.spatial_hash is not None:
+            self.spatial_hash.move(self, self.x, self.y)
 
     def can_see_in_sightrange(self, obj_be_seen_pos) -> bool:
         dist_two_point_x = obj_be_seen_pos[0] - self.x
@@ -141,21 +517,87 @@ class HumanSprite(pygame.sprite.Sprite):
         return col, row
 
     def search_tile(self, tile, layer) -> bool:
-        tilemap = self.terrain.map[layer]
-        tile_id = self.terrain.tile_id_assign[tile]
         tilesize = self.terrain.tilesize
-        search_result = False
-        for y in range(len(tilemap)):
-            for x in range(len(tilemap[y])):
-                if tilemap[y][x] == tile_id:
-                    search_result = self.can_see_in_sightrange(
-                        (x*tilesize+tilesize//2, y*tilesize+tilesize//2))
-                    if search_result:
-                        break
-        return search_result
+        return self.terrain.tile_index.any_within(
+            layer, self.terrain.tile_id_assign[tile],
+            self.x / tilesize, self.y / tilesize,
+            self.max_sightrange / tilesize, self.min_sightrange / tilesize)
+
+    def search_nearest_tile(self, tile, layer):
+        """Tile position (col, row) of the nearest tile in sight or None"""
+        tilesize = self.terrain.tilesize
+        return self.terrain.tile_index.nearest(
+            layer, self.terrain.tile_id_assign[tile],
+            self.x / tilesize, self.y / tilesize,
+            self.max_sightrange / tilesize)
+
+    def mobs_in_sightrange(self):
+        """The other mobs of the group that can be seen from here"""
+        if self.spatial_hash is None:
+            return []
+        return [mob for mob in self.spatial_hash.query_radius(
+                    self.x, self.y, self.max_sightrange, self.min_sightrange)
+                if mob is not self]
+
+    def search_nearest_mob(self):
+        """The nearest other mob in sight or None"""
+        if self.spatial_hash is None:
+            return None
+        return self.spatial_hash.nearest(self.x, self.y, self.max_sightrange,
+                                         exclude=self)
 
     def set_target_pos(self, pos):
         self.target_pos = pos
+        if self.sim is not None:
+            self.sim.set_target(self.sim_index, pos)
+
+    def sync_from_sim(self):
+        self.x = int(self.sim.x[self.sim_index])
+        self.y = int(self.sim.y[self.sim_index])
+        self.dx = int(self.sim.dx[self.sim_index])
+        self.dy = int(self.sim.dy[self.sim_index])
+        self.update_img_pos()
+
+    def leave_sim(self):
+        """Stop being moved by sim, keeping the position it got to"""
+        if self.sim is not None:
+            self.sync_from_sim()
+            self.sim.remove(self.sim_index)
+            self.sim = None
+            self.sim_index = None
+
+    def kill(self):
+        self.leave_sim()
+        super().kill()
+
+
+class MobGroup(pygame.sprite.Group):
+    """Group of mobs keeping their positions in a SpatialHash, so the mobs
+    near a point or in a rect are found without looking at every mob.
+
+    Mobs move themselves in the hash when their x/y change, in
+    update_img_pos. Mobs moved by a mobsim.MobSimulation are where they
+    were last synced from it, and leave it when removed from the group.
+    """
+
+    def __init__(self, *sprites, cell_size=MOB_HASH_CELL_SIZE):
+        self.spatial_hash = spatialhash.SpatialHash(cell_size)
+        # largest sight range of the mobs added so far
+        self.max_sightrange = 0
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, *args):
+        super().add_internal(sprite, *args)
+        self.spatial_hash.insert(sprite, sprite.x, sprite.y)
+        sprite.spatial_hash = self.spatial_hash
+        self.max_sightrange = max(self.max_sightrange, sprite.max_sightrange)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.spatial_hash.remove(sprite)
+        sprite.spatial_hash = None
+        # a mob taken out of the group is not stepped any more
+        sprite.leave_sim()
 
 
 class ButtonSprite(pygame.sprite.Sprite):
@@ -166,18 +608,21 @@ class ButtonSprite(pygame.sprite.Sprite):
         # This value is for moving y of the icon when button pressing.
         self.y_pressing = 2
         # self.rect = pygame.Rect(x, y, self.width, self.height)
-        self.btn_sheet = SpriteSheet(assets_path.img_path(
+        self.btn_sheet = tile_atlas.sheet(assets_path.img_path(
             "button.png"), 1, 2, self.rect.width, self.rect.height, BLACK)
-        self.icon_sheet = SpriteSheet(assets_path.img_path(
+        self.icon_sheet = tile_atlas.sheet(assets_path.img_path(
             "btn_icon.png"), 1, 3, self.rect.width, self.rect.height, BLACK)
         self.is_pressed = False
+        # images of the button with its icon, unpressed and pressed
+        self.icon_cell = None
+        self.state_images = {}
 
     def update(self, *args, **kwargs):
         pass
 
-    def set_image_with_icon(self, icon_sheet_row,
-                            icon_sheet_column) -> pygame.Surface:
-        if self.is_pressed:
+    def make_image(self, icon_sheet_row, icon_sheet_column,
+                   pressed) -> pygame.Surface:
+        if pressed:
             btn_row = 1
             btn_column = 2
             icon_y = self.y_pressing
@@ -188,11 +633,55 @@ class ButtonSprite(pygame.sprite.Sprite):
         btn_surface = pygame.Surface(
             (self.rect.width, self.rect.height))
         btn_surface.set_colorkey(self.btn_sheet.colorkey)
-        btn_surface.blit(self.btn_sheet.image_by_cell(
+        btn_surface.blit(self.btn_sheet.cell(
             btn_row, btn_column), (0, 0))
-        btn_surface.blit(self.icon_sheet.image_by_cell(
+        btn_surface.blit(self.icon_sheet.cell(
             icon_sheet_row, icon_sheet_column), (0, icon_y))
-        self.image = btn_surface
+        return btn_surface
+
+    def set_image_with_icon(self, icon_sheet_row,
+                            icon_sheet_column) -> pygame.Surface:
+        """Show the icon at (row, column) of the icon sheet. The images of
+        both button states are made once per icon.
+        """
+        icon_cell = icon_sheet_row, icon_sheet_column
+        if icon_cell != self.icon_cell:
+            self.icon_cell = icon_cell
+            self.state_images = {
+                pressed: self.make_image(*icon_cell, pressed)
+                for pressed in (False, True)}
+        self.image = self.state_images[self.is_pressed]
+        return self.image
+
+    def refresh_image(self) -> bool:
+        """Switch to the image of the current state. Return whether it
+        changed.
+        """
+        image = self.state_images[self.is_pressed]
+        if image is self.image:
+            return False
+        self.image = image
+        return True
+
+
+# cost for mobs to walk on each tile type, others cost 1
+TERRAIN_TILE_COSTS = {"Water": 6, "Tree": 2, "Mount": navigation.BLOCKED}
+FIELD_REBUILDS_PER_STEP = 1  # most stale flow fields rebuilt in one step
+FIELD_REBUILD_DELAY = 15  # steps without edits before a field is rebuilt
+# (layer, tile) written by each painting tool of the toolbar
+PAINT_TOOLS = {"Water": [(2, None), (0, "Water")], "Dirt": [(2, "Dirt")],
+               "Mount": [(3, "Mount")], "Tree": [(3, "Tree")],
+               "Eraser": [(3, None)]}
+PAINT_MODE_KEYS = {pygame.K_b: "brush", pygame.K_r: "rect",
+                   pygame.K_f: "fill"}
+MAX_BRUSH_RADIUS = 8
+FLOOD_FILL_MAX_TILES = 1 << 14  # most tiles one flood fill paints
+HISTORY_BUDGET = 4 << 20  # bytes of undo history kept
+HISTORY_CHECKPOINT_INTERVAL = 32  # edits per undo checkpoint
+
+# (row, column) of each tile type in skyeyebg.png
+TERRAIN_TILE_CELLS = {"Glass": (1, 1), "Dirt": (1, 2), "Water": (3, 1),
+                      "Tree": (2, 7), "Mount": (1, 5)}
 
 
 def get_swap_dict(dictionary):
@@ -204,23 +693,367 @@ class Terrain:
         self.tile_id_assign = {None: 0, "Glass": 1,
                                "Dirt": 2, "Water": 3, "Tree": 4, "Mount": 5}
         self.tile_type_from_id = get_swap_dict(self.tile_id_assign)
-        self.map = [[[]]]
+        self.map = tilegrid.TileGrid(1, 1, 0)
+        self.tile_index = tileindex.TileIndex(self.map)
+        self.navigator = navigation.Navigator(self.map, {
+            self.tile_id_assign[tile]: cost
+            for tile, cost in TERRAIN_TILE_COSTS.items()},
+            rebuilds_per_step=FIELD_REBUILDS_PER_STEP,
+            rebuild_delay=FIELD_REBUILD_DELAY)
         self.tilesize = 16
+        # Callables notified as listener(layer_id, x, y, width, height) after
+        # every write made through the methods below. layer_id is None when
+        # the whole map was replaced. Writing to self.map directly bypasses
+        # them.
+        self.write_listeners = []
+        # inside batch(), {layer_id: [left, top, right, bottom]} written
+        self.batch_depth = 0
+        self.batch_regions = {}
+        # the write methods below record their edits for undo here
+        self.history = history.EditHistory(HISTORY_BUDGET,
+                                           HISTORY_CHECKPOINT_INTERVAL)
+        # open snapshots of the map (see snapshot()), told of writes to
+        # come
+        self.snapshots = []
+
+    def add_write_listener(self, listener):
+        self.write_listeners.append(listener)
+
+    def remove_write_listener(self, listener):
+        self.write_listeners.remove(listener)
+
+    def notify_write(self, layer_id, x, y, width, height):
+        if self.batch_depth:
+            if layer_id is not None:
+                region = self.batch_regions.get(layer_id)
+                if region is None:
+                    self.batch_regions[layer_id] = [x, y, x + width,
+                                                    y + height]
+                else:
+                    region[0] = min(region[0], x)
+                    region[1] = min(region[1], y)
+                    region[2] = max(region[2], x + width)
+                    region[3] = max(region[3], y + height)
+                return
+            # the map was replaced, the writes before do not matter
+            self.batch_regions.clear()
+        if layer_id is None:
+            # snapshots of the old map stay as they are
+            self.snapshots = []
+            self.history.reset(self.map)
+            self.tile_index = self.make_tile_index()
+            self.navigator.set_grid(self.map)
+        else:
+            self.history.commit()
+            self.tile_index.update_region(layer_id, x, y, width, height)
+            self.navigator.invalidate_region(x, y, width, height)
+        for listener in self.write_listeners:
+            listener(layer_id, x, y, width, height)
+
+    def capture_write(self, layer_id, x, y, width, height):
+        """Called by the write methods before writing a region"""
+        self.history.capture(layer_id, x, y, width, height)
+        self.capture_snapshots(layer_id, x, y, width, height)
+
+    def capture_snapshots(self, layer_id, x, y, width, height):
+        if not self.snapshots:
+            return
+        self.snapshots = [snapshot for snapshot in self.snapshots
+                          if not snapshot.closed]
+        for snapshot in self.snapshots:
+            snapshot.capture(layer_id, x, y, width, height)
+
+    def snapshot(self):
+        """A snapshot of the map, kept as it is until closed: a
+        GridSnapshot, or a ChunkedGridSnapshot for a chunked map
+        """
+        if isinstance(self.map, chunkgrid.ChunkedTileGrid):
+            snapshot = autosave.ChunkedGridSnapshot(self.map)
+        else:
+            snapshot = autosave.GridSnapshot(self.map)
+        self.snapshots.append(snapshot)
+        return snapshot
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Notify the writes made in the with block when it ends, once per
+        layer for the region bounding them
+        """
+        self.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                regions = self.batch_regions
+                self.batch_regions = {}
+                for layer_id in sorted(regions):
+                    left, top, right, bottom = regions[layer_id]
+                    self.notify_write(layer_id, left, top, right - left,
+                                      bottom - top)
+
+    def make_tile_index(self):
+        if isinstance(self.map, chunkgrid.ChunkedTileGrid):
+            # chunks keep their own indexes
+            return self.map
+        return tileindex.TileIndex(self.map)
+
+    def close_map(self):
+        """Free the swap files of a chunked map about to be replaced"""
+        if (isinstance(self.map, chunkgrid.ChunkedTileGrid) and
+                all(snapshot.closed for snapshot in self.snapshots)):
+            # else a save still reads them, they go with the last
+            # reference to the map
+            self.map.close()
+
+    def reset_map(self, layer_num, height, width, init_tile=None,
+                  chunk_size=None):
+        """With chunk_size, the map is a ChunkedTileGrid which keeps only
+        the chunks in use in memory, for very large worlds.
+        """
+        self.close_map()
+        if chunk_size is None:
+            self.map = tilegrid.TileGrid(
+                layer_num, height, width, self.tile_id_assign[init_tile])
+        else:
+            self.map = chunkgrid.ChunkedTileGrid(
+                layer_num, height, width, self.tile_id_assign[init_tile],
+                chunk_size)
+        self.notify_write(None, 0, 0, width, height)
 
-    def reset_map(self, layer_num, height, width, init_tile=None):
-        self.map = [[[self.tile_id_assign[init_tile] for x in range(
-            width)] for y in range(height)] for z in range(layer_num)]
+    def set_map(self, tile_grid):
+        if tile_grid is not self.map:
+            self.close_map()
+        self.map = tile_grid
+        self.notify_write(None, 0, 0, tile_grid.width, tile_grid.height)
 
     def rewrite_map_tile(self, layer_id, x, y, tile):
+        self.capture_write(layer_id, x % self.map.width,
+                           y % self.map.height, 1, 1)
         self.map[layer_id][y][x] = self.tile_id_assign[tile]
+        self.notify_write(layer_id, x % self.map.width, y % self.map.height,
+                          1, 1)
 
     def fill_map(self, layer_id, start_x, width, start_y, height, tile):
-        for y in range(start_y, start_y + height):
-            self.map[
-                layer_id][
-                    y][
-                start_x: start_x + width] = [
-                    self.tile_id_assign[tile] for x in range(width)]
+        self.capture_write(layer_id, start_x, start_y, width, height)
+        self.map.fill(layer_id, start_x, start_y, width, height,
+                      self.tile_id_assign[tile])
+        x, y, width, height = self.map.clip_region(
+            start_x, start_y, width, height)
+        if width and height:
+            self.notify_write(layer_id, x, y, width, height)
+
+    def fill_spans(self, layer_id, spans, tile):
+        """Write tile over spans, (x, y, width) runs of tiles on a row, as
+        one batch
+        """
+        value = self.tile_id_assign[tile]
+        with self.batch():
+            for x, y, width in spans:
+                x, y, width, height = self.map.clip_region(x, y, width, 1)
+                if width and height:
+                    self.capture_write(layer_id, x, y, width, 1)
+                    self.map.fill(layer_id, x, y, width, 1, value)
+                    self.notify_write(layer_id, x, y, width, 1)
+
+    def replace_map_tile(self, layer_id, old_tile, new_tile):
+        self.capture_write(layer_id, 0, 0, self.map.width, self.map.height)
+        self.map.replace(layer_id, self.tile_id_assign[old_tile],
+                         self.tile_id_assign[new_tile])
+        self.notify_write(layer_id, 0, 0, self.map.width, self.map.height)
+
+    def undo(self, steps=1):
+        self.write_history(self.history.undo(steps, self.capture_snapshots))
+
+    def redo(self, steps=1):
+        self.write_history(self.history.redo(steps, self.capture_snapshots))
+
+    def write_history(self, regions):
+        with self.batch():
+            for layer_id, x, y, width, height in regions:
+                self.notify_write(layer_id, x, y, width, height)
+
+
+class TerrainChunkSurface:
+    """Rendered tiles of one chunk of the terrain"""
+
+    def __init__(self, tile_x, tile_y, width, height, tilesize):
+        self.tile_x = tile_x
+        self.tile_y = tile_y
+        self.tilesize = tilesize
+        self.rect = pygame.Rect(
+            tile_x*tilesize, tile_y*tilesize, width*tilesize,
+            height*tilesize)
+        self.surface = pygame.Surface(self.rect.size).convert_alpha()
+        # 1 for each tile already drawn on surface, 0 for stale ones
+        self.drawn = tilegrid.TileGrid(1, height, width)
+
+
+class TerrainPyramidCell:
+    """Image of the tiles in tile_rect at one level of a TerrainPyramid"""
+
+    def __init__(self, tile_rect, size):
+        self.tile_rect = tile_rect
+        self.surface = pygame.Surface(size, 0, 24)
+        self.drawn = False
+        # tile rects written since drawn, stale when any tile was
+        self.dirty_rects = []
+        self.stale = False
+
+
+class TerrainPyramid:
+    """Terrain of the zoom levels from LOD_ZOOM on, each level half the
+    size of the one under it, like the mipmaps of a texture.
+
+    Levels are split in cells of LOD_CELL_SIZE pixels per side, so the
+    cells in view are as many at every level. At base_level a pixel is one
+    tile, of the average color of its top tile image (tile_color_image),
+    and the levels under it scale that up. The cells above it are four
+    cells of the level under them scaled down. Writes redraw the tiles
+    they changed in the cells up to base_level and mark the cells above
+    stale, and cells are only drawn when in view, at most
+    LOD_BUILDS_PER_FRAME new ones per frame.
+    """
+
+    def __init__(self, tilesize):
+        self.tilesize = tilesize
+        self.base_level = tilesize.bit_length() - 1
+        self.terrain_map = None
+        self.color_tables = None
+        self.builds_left = 0
+        level_budget = LOD_SURFACE_BUDGET // (MAX_ZOOM - LOD_ZOOM + 1)
+        self.levels = {
+            level: chunkstore.ChunkStore(
+                lambda key, level=level: self.create_cell(level, key), None,
+                level_budget, LOD_CELL_SIZE**2 * 4)
+            for level in range(LOD_ZOOM, MAX_ZOOM + 1)}
+
+    def clear(self):
+        for cells in self.levels.values():
+            cells.clear()
+
+    def cell_tiles(self, level):
+        """Tiles per side of a cell of level"""
+        return LOD_CELL_SIZE * (1 << level) // self.tilesize
+
+    def level_pixels(self, level, tiles):
+        if level <= self.base_level:
+            return tiles << (self.base_level - level)
+        return -(-tiles >> (level - self.base_level))
+
+    def create_cell(self, level, key):
+        span = self.cell_tiles(level)
+        if key[0] < 0 or key[1] < 0:
+            return None
+        x, y, width, height = self.terrain_map.clip_region(
+            key[0]*span, key[1]*span, span, span)
+        if not width or not height:
+            return None
+        return TerrainPyramidCell(
+            pygame.Rect(x, y, width, height),
+            (self.level_pixels(level, width),
+             self.level_pixels(level, height)))
+
+    def on_write(self, x, y, width, height):
+        rect = pygame.Rect(x, y, width, height)
+        for level, cells in self.levels.items():
+            for cell in cells.chunks.values():
+                if not cell.drawn or not cell.tile_rect.colliderect(rect):
+                    continue
+                if level > self.base_level:
+                    cell.stale = True
+                elif len(cell.dirty_rects) >= 64:
+                    cell.dirty_rects = [rect.clip(cell.tile_rect).unionall(
+                        cell.dirty_rects)]
+                else:
+                    cell.dirty_rects.append(rect.clip(cell.tile_rect))
+
+    def draw_cell(self, level, key):
+        """The cell of level at key, drawn up to date unless that takes
+        more new cells than are left to build this frame. None when there
+        is no such cell or it was never drawn.
+        """
+        cell = self.levels[level].get(key)
+        if cell is None:
+            return None
+        if level <= self.base_level:
+            if not cell.drawn:
+                if self.builds_left <= 0:
+                    return None
+                self.builds_left -= 1
+                cell.dirty_rects = [cell.tile_rect]
+                cell.drawn = True
+            scale = 1 << (self.base_level - level)
+            for rect in cell.dirty_rects:
+                image = tile_color_image(self.terrain_map, *rect,
+                                         self.color_tables)
+                if scale > 1:
+                    image = pygame.transform.scale(
+                        image, (rect.width*scale, rect.height*scale))
+                cell.surface.blit(image,
+                                  ((rect.x - cell.tile_rect.x)*scale,
+                                   (rect.y - cell.tile_rect.y)*scale))
+            cell.dirty_rects = []
+            return cell
+        if cell.drawn and not cell.stale:
+            return cell
+        old_cell = cell if cell.drawn else None
+        if self.builds_left <= 0:
+            return old_cell
+        span = self.cell_tiles(level - 1)
+        children = []
+        for child_y in (key[1]*2, key[1]*2 + 1):
+            for child_x in (key[0]*2, key[0]*2 + 1):
+                if (child_x*span >= self.terrain_map.width or
+                        child_y*span >= self.terrain_map.height):
+                    continue
+                child = self.draw_cell(level - 1, (child_x, child_y))
+                if child is None or child.stale:
+                    return old_cell
+                children.append(((child_x % 2, child_y % 2), child))
+        self.builds_left -= 1
+        half = LOD_CELL_SIZE // 2
+        cell.surface.fill(BLACK)
+        for (i, j), child in children:
+            width, height = child.surface.get_size()
+            cell.surface.blit(
+                pygame.transform.smoothscale(
+                    child.surface, ((width + 1) // 2, (height + 1) // 2)),
+                (i*half, j*half))
+        cell.drawn = True
+        cell.stale = False
+        return cell
+
+    def render(self, screen, terrain_map, level, viewport, pos):
+        """Blit the terrain under viewport, a rect in pixels of level, to
+        screen with its top left at pos
+        """
+        if terrain_map is not self.terrain_map:
+            self.clear()
+            self.terrain_map = terrain_map
+        if self.color_tables is None:
+            self.color_tables = tile_atlas.color_tables()
+        self.builds_left = LOD_BUILDS_PER_FRAME
+        size = LOD_CELL_SIZE
+        keys = [(cell_x, cell_y)
+                for cell_y in range(max(viewport.top, 0) // size,
+                                    (viewport.bottom - 1) // size + 1)
+                for cell_x in range(max(viewport.left, 0) // size,
+                                    (viewport.right - 1) // size + 1)]
+        self.levels[level].pin(keys)
+        blit_sequence = []
+        for key in keys:
+            cell = self.draw_cell(level, key)
+            if cell is None:
+                continue
+            rect = pygame.Rect((key[0]*size, key[1]*size),
+                               cell.surface.get_size())
+            area = rect.clip(viewport)
+            blit_sequence.append(
+                (cell.surface,
+                 (pos[0] + area.x - viewport.x, pos[1] + area.y - viewport.y),
+                 area.move(-rect.x, -rect.y)))
+        screen.blits(blit_sequence, False)
 
 
 class GameSceneManager(scenetrans.SceneManager):
@@ -228,6 +1061,38 @@ class GameSceneManager(scenetrans.SceneManager):
         super().__init__()
         self.screen = screen
         self.game = game
+        # scenes time their render steps with profiler.phase
+        self.profiler = profiler.FrameProfiler()
+        # mouse and held keys of the frame, read by the scenes instead of
+        # pygame.mouse and pygame.key so recorded sessions replay the same
+        self.input = replay.FrameInput()
+
+    def update_display(self, dirty_rects):
+        """Push the dirty rects a scene returned from render to the
+        display. Overlapping rects are merged, and the whole screen is
+        updated when dirty_rects is None or covers over
+        FULL_UPDATE_FRACTION of it.
+        """
+        if dirty_rects is None:
+            pygame.display.update()
+            return
+        screen_rect = self.screen.get_rect()
+        merged = []
+        for rect in dirty_rects:
+            rect = screen_rect.clip(rect)
+            if not rect.width or not rect.height:
+                continue
+            index = rect.collidelist(merged)
+            while index != -1:
+                rect.union_ip(merged.pop(index))
+                index = rect.collidelist(merged)
+            merged.append(rect)
+        dirty_area = sum(rect.width * rect.height for rect in merged)
+        if dirty_area > (screen_rect.width * screen_rect.height *
+                         FULL_UPDATE_FRACTION):
+            pygame.display.update()
+        elif merged:
+            pygame.display.update(merged)
 
 
 class TitleScene(scenetrans.Scene):
@@ -236,6 +1101,8 @@ class TitleScene(scenetrans.Scene):
         self.menu_items = ["game", "config", "exit"]
         self.menu_item_num = len(self.menu_items)
         self.menu_select_num = 0
+        # screen rect of the menu cursor drawn, None when nothing is drawn
+        self.cursor_rect = None
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
@@ -258,34 +1125,59 @@ class TitleScene(scenetrans.Scene):
     def update(self):
         pass
 
+    def enter(self):
+        self.cursor_rect = None
+
     def render(self):
-        self.sm.screen.fill(BLACK)
-        font = pygame.font.Font(
-            str(assets_path.font_path("misaki_gothic_2nd.ttf")), 48)
-        title_text = font.render(GAME_TITLE, True, WHITE)
-        font = pygame.font.Font(
-            str(assets_path.font_path("misaki_gothic_2nd.ttf")), 32)
+        """Draw the whole menu when entered, then only the cursor as it
+        moves.
+        """
+        title_text = asset_cache.text(GAME_TITLE, 48)
         title_pos = (
             text_pos_to_center(
                 self.sm.screen.get_size(), title_text.get_size(), 1, 0.25))
+        menu_cursor = asset_cache.text(">", 32)
+        cursor_rect = menu_cursor.get_rect(topleft=(
+            title_pos[0] * 0.75, title_pos[1] * (self.menu_select_num+3)))
+        if self.cursor_rect is not None:
+            if cursor_rect == self.cursor_rect:
+                return []
+            dirty_rects = [self.cursor_rect, cursor_rect]
+            self.sm.screen.fill(BLACK, self.cursor_rect)
+            self.sm.screen.blit(menu_cursor, cursor_rect)
+            self.cursor_rect = cursor_rect
+            return dirty_rects
+        self.sm.screen.fill(BLACK)
         self.sm.screen.blit(title_text, title_pos)
         for index in range(self.menu_item_num):
-            start_text = font.render(self.menu_items[index], True, WHITE)
+            start_text = asset_cache.text(self.menu_items[index], 32)
             self.sm.screen.blit(
                 start_text, (title_pos[0], title_pos[1] * (index+3)))
-            menu_cursor = font.render(">", True, WHITE)
-            self.sm.screen.blit(
-                menu_cursor,
-                (title_pos[0] * 0.75, title_pos[1] * (self.menu_select_num+3)))
+        self.sm.screen.blit(menu_cursor, cursor_rect)
+        self.cursor_rect = cursor_rect
+        return None
 
 
 class GameScene(scenetrans.Scene):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, vectorized_mobs=False, seed=None,
+                 map_width=64, map_height=64, chunked_terrain=False,
+                 mob_processes=0, **kwargs):
         super().__init__(*args, **kwargs)
+        if chunked_terrain and mob_processes:
+            raise ValueError("mob processes need an unchunked terrain")
+        if vectorized_mobs and mob_processes:
+            raise ValueError("vectorized mobs cannot run in mob processes")
+        # with mob_processes, mobs are stepped by that many worker
+        # processes reading the terrain from shared memory
+        self.region_sim = (regionsim.RegionSimulation(mob_processes,
+                                                      seed=seed)
+                           if mob_processes else None)
         self.terrain = Terrain()
         self.TILESIZE = self.terrain.tilesize  # to be short
-        self.MAP_HEIGHT = 64
-        self.MAP_WIDTH = 64
+        self.MAP_HEIGHT = map_height
+        self.MAP_WIDTH = map_width
+        self.world_name = "world"
+        self.steps_since_save = 0
         self.MAP_VIEWER_X = 16
         self.MAP_VIEWER_Y = 16
         self.MAP_VIEWER_HEIGHT = 480
@@ -294,14 +1186,49 @@ class GameScene(scenetrans.Scene):
         self.scroll_y = 0
         self.scroll_vx = 0
         self.scroll_vy = 0
+        # the view shows 2**zoom world pixels per screen pixel
+        self.zoom = 0
         self.mouse_pos_history = []
-        self.terrain.reset_map(4, self.MAP_HEIGHT, self.MAP_WIDTH)
-        self.terrain.fill_map(2, 0, 64, 0, 64, "Glass")
-        self.map_surface = pygame.Surface(
-            (self.MAP_WIDTH*self.TILESIZE, self.MAP_HEIGHT*self.TILESIZE)
-        ).convert_alpha()
-        self.minimap_surface = pygame.Surface(
-            (self.MAP_WIDTH, self.MAP_HEIGHT))
+        # Painting with the tool buttons: a click or drag paints a brush
+        # stroke, a rectangle or a flood fill by paint_mode. paint_tool,
+        # paint_start and paint_last are the tool and first and last tiles
+        # of the drag in progress. Edits wait in paint_edits as (tool,
+        # mode, tiles, brush radius) to be written in one batch.
+        self.paint_mode = "brush"
+        self.brush_radius = 0
+        self.paint_tool = None
+        self.paint_start = None
+        self.paint_last = None
+        self.paint_edits = []
+        # The rendered terrain is cached in TerrainChunkSurfaces of the
+        # chunks in view or seen lately, one store per zoom level under
+        # LOD_ZOOM with tiles scaled down to it. render_terrain only
+        # redraws their stale tiles inside the viewport. Further out the
+        # terrain comes from terrain_pyramid. Mobs go on mob_surface.
+        self.terrain_chunk_levels = [
+            chunkstore.ChunkStore(
+                lambda key, level=level: self.create_terrain_chunk(
+                    key, level),
+                None, TERRAIN_SURFACE_BUDGET >> level,
+                (TERRAIN_CHUNK_SIZE*(self.TILESIZE >> level))**2 * 4)
+            for level in range(LOD_ZOOM)]
+        self.terrain_chunks = self.terrain_chunk_levels[0]
+        self.terrain_pyramid = TerrainPyramid(self.TILESIZE)
+        # tile region drawn on minimap_surface and tile rects changed since
+        self.minimap_drawn_region = None
+        self.minimap_dirty_rects = []
+        self.terrain.add_write_listener(self.on_terrain_write)
+        # worlds are loaded chunked too, so memory stays bounded
+        self.chunk_size = TILE_CHUNK_SIZE if chunked_terrain else None
+        # the blank world is not an edit to undo
+        with self.terrain.history.paused():
+            self.terrain.reset_map(4, self.MAP_HEIGHT, self.MAP_WIDTH,
+                                   chunk_size=self.chunk_size)
+            self.terrain.fill_map(
+                2, 0, self.MAP_WIDTH, 0, self.MAP_HEIGHT, "Glass")
+        self.mob_surface = pygame.Surface(
+            (self.MAP_VIEWER_WIDTH, self.MAP_VIEWER_HEIGHT)).convert_alpha()
+        self.minimap_surface = pygame.Surface(self.minimap_region()[2:])
         self.water_btn = ButtonSprite("Water", 16, SCRN_HEIGHT - 139 + 16)
         btn_size = self.water_btn.rect.size
         self.dirt_btn = ButtonSprite(
@@ -320,45 +1247,107 @@ class GameScene(scenetrans.Scene):
         self.destroy_tile_btn = ButtonSprite(
             "Eraser", 16 + btn_size[0]*2 + 16*2,
             SCRN_HEIGHT - 139 + 16 + btn_size[1] + 16)
+        self.water_btn.set_image_with_icon(1, 2)
+        self.dirt_btn.set_image_with_icon(1, 1)
+        self.mount_btn.set_image_with_icon(1, 3)
+        self.human_btn.set_image_with_icon(1, 4)
+        self.tree_btn.set_image_with_icon(2, 1)
+        self.save_btn.set_image_with_icon(2, 2)
+        self.load_btn.set_image_with_icon(2, 3)
+        self.destroy_tile_btn.set_image_with_icon(2, 4)
         self.btn_group = pygame.sprite.RenderUpdates()
         self.btn_group.add(self.water_btn, self.dirt_btn,
                            self.mount_btn, self.tree_btn,
                            self.human_btn,
                            self.save_btn, self.load_btn,
                            self.destroy_tile_btn)
-        self.mob_group = pygame.sprite.Group()
+        # The toolbar is only drawn when the scene is entered or a button
+        # changes state, everything else each frame
+        self.toolbar_rect = pygame.Rect(
+            0, SCRN_HEIGHT - TOOLBAR_HEIGHT, SCRN_WIDTH, TOOLBAR_HEIGHT)
+        self.toolbar_stale = True
+        # the background above the toolbar is likewise only filled when
+        # entered, the map viewer and cursor text are redrawn every frame
+        self.view_stale = True
+        self.cursor_text_rect = pygame.Rect(0, 0, 0, 0)
+        self.mob_group = MobGroup()
+        # random moves of the mobs of this scene
+        self.rng = random.Random(seed)
+        # with vectorized_mobs, mobs are moved by mob_sim in one batch
+        self.mob_sim = (mobsim.MobSimulation(seed=seed)
+                        if vectorized_mobs else None)
+        tile_atlas.assign_tiles(
+            self.terrain.tile_id_assign,
+            tile_atlas.sheet(assets_path.img_path("skyeyebg.png"), 1, 1,
+                             self.TILESIZE, self.TILESIZE, BLACK),
+            TERRAIN_TILE_CELLS)
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
-            if pygame.key.get_pressed()[pygame.K_UP]:
-                self.scroll_vy = -9
-            if pygame.key.get_pressed()[pygame.K_DOWN]:
-                self.scroll_vy = 9
-            if pygame.key.get_pressed()[pygame.K_RIGHT]:
-                self.scroll_vx = 9
-            if pygame.key.get_pressed()[pygame.K_LEFT]:
-                self.scroll_vx = -9
-        if pygame.mouse.get_pressed()[0]:
+            scale = 1 << self.zoom
+            if self.sm.input.key_pressed(pygame.K_UP):
+                self.scroll_vy = -9 * scale
+            if self.sm.input.key_pressed(pygame.K_DOWN):
+                self.scroll_vy = 9 * scale
+            if self.sm.input.key_pressed(pygame.K_RIGHT):
+                self.scroll_vx = 9 * scale
+            if self.sm.input.key_pressed(pygame.K_LEFT):
+                self.scroll_vx = -9 * scale
+            if event.key in (pygame.K_MINUS, pygame.K_EQUALS):
+                # zoom around the middle of the viewer
+                self.set_zoom(
+                    self.zoom + (1 if event.key == pygame.K_MINUS else -1),
+                    (self.MAP_VIEWER_X + self.MAP_VIEWER_WIDTH // 2,
+                     self.MAP_VIEWER_Y + self.MAP_VIEWER_HEIGHT // 2))
+            elif event.key in PAINT_MODE_KEYS and self.paint_tool is None:
+                self.paint_mode = PAINT_MODE_KEYS[event.key]
+            elif event.key == pygame.K_LEFTBRACKET:
+                self.brush_radius = max(self.brush_radius - 1, 0)
+            elif event.key == pygame.K_RIGHTBRACKET:
+                self.brush_radius = min(self.brush_radius + 1,
+                                        MAX_BRUSH_RADIUS)
+            elif (event.key in (pygame.K_z, pygame.K_y) and
+                    event.mod & pygame.KMOD_CTRL and self.paint_tool is None):
+                self.apply_paint_edits()
+                if event.key == pygame.K_z:
+                    self.terrain.undo()
+                else:
+                    self.terrain.redo()
+        if self.sm.input.mouse_buttons[0]:
             is_btn_pressing = False
             for btn_sprite in iter(self.btn_group):
                 if btn_sprite.is_pressed:
                     is_btn_pressing = True
                     break
             if not is_btn_pressing and self.is_pos_on_map(
-                    pygame.mouse.get_pos()):
+                    self.sm.input.mouse_pos):
                 # move map viewer with mouse dragging
-                mouse_pos = pygame.mouse.get_pos()
+                mouse_pos = self.sm.input.mouse_pos
                 self.mouse_pos_history.append(mouse_pos)
                 if 2 < len(self.mouse_pos_history):
                     self.scroll_vx = - \
                         (self.mouse_pos_history[1][0] -
-                         self.mouse_pos_history[0][0])
+                         self.mouse_pos_history[0][0]) << self.zoom
                     self.scroll_vy = - \
                         (self.mouse_pos_history[1][1] -
-                         self.mouse_pos_history[0][1])
+                         self.mouse_pos_history[0][1]) << self.zoom
                     self.mouse_pos_history.pop(0)
+        if (event.type == pygame.MOUSEBUTTONDOWN and event.button == 3 and
+                self.is_pos_on_map(event.pos)):
+            # send every mob to the clicked spot
+            target_pos = self.world_pos(event.pos)
+            for mob in self.mob_group:
+                mob.set_target_pos(target_pos)
+        if (event.type == pygame.MOUSEBUTTONDOWN and event.button in (4, 5)
+                and self.is_pos_on_map(event.pos)):
+            # the wheel zooms around the pointer
+            self.set_zoom(self.zoom + (1 if event.button == 5 else -1),
+                          event.pos)
         if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
             self.mouse_pos_history.clear()
+            self.finish_painting()
+        if event.type == pygame.MOUSEMOTION and self.paint_tool is not None:
+            self.continue_painting(event.pos)
         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
             for btn_sprite in iter(self.btn_group):
                 if btn_sprite.rect.collidepoint(event.pos):
@@ -366,150 +1355,559 @@ class GameScene(scenetrans.Scene):
                     for other_btn in iter(self.btn_group):
                         if other_btn.id != btn_sprite.id:
                             other_btn.is_pressed = False
+                    if btn_sprite.id == "Save":
+                        btn_sprite.is_pressed = False
+                        self.save_world()
+                    elif btn_sprite.id == "Load":
+                        btn_sprite.is_pressed = False
+                        self.load_world(self.world_name)
                 if self.is_pos_on_map(event.pos):
                     if btn_sprite.is_pressed:
-                        if btn_sprite.id == "Water":
-                            self.rewrite_tile_with_mouse(
-                                2, None, event.pos)
-                            self.rewrite_tile_with_mouse(
-                                0, "Water", event.pos)
-                        if btn_sprite.id == "Dirt":
-                            self.rewrite_tile_with_mouse(
-                                2, "Dirt", event.pos)
-                        if btn_sprite.id == "Mount":
-                            self.rewrite_tile_with_mouse(
-                                3, "Mount", event.pos)
-                        if btn_sprite.id == "Tree":
-                            self.rewrite_tile_with_mouse(
-                                3, "Tree", event.pos)
+                        if btn_sprite.id in PAINT_TOOLS:
+                            self.start_painting(btn_sprite.id, event.pos)
                         if btn_sprite.id == "Human":
                             self.spawn_human_with_mouse(event.pos)
-                        if btn_sprite.id == "Eraser":
-                            self.destroy_tile_with_mouse(event.pos)
         # scroll map
         self.scroll_x += self.scroll_vx
         self.scroll_y += self.scroll_vy
         self.scroll_vx = 0
         self.scroll_vy = 0
 
+    def update(self):
+        self.terrain.navigator.tick()
+        self.apply_paint_edits()
+        self.update_mobs()
+        self.autosave()
+
+    def mob_states(self):
+        for mob in self.mob_group:
+            if mob.sim is not None:
+                mob.sync_from_sim()
+            yield mob.x, mob.y, mob.max_sightrange, mob.min_sightrange
+
+    def hash_state(self, digest):
+        """Feed the terrain, view and mob state to a hashlib digest"""
+        terrain_map = self.terrain.map
+        if isinstance(terrain_map, chunkgrid.ChunkedTileGrid):
+            # the chunks not created hold the init values
+            digest.update(bytes(terrain_map.init_values))
+            for key in sorted(terrain_map.known_chunks()):
+                digest.update(struct.pack("<ii", *key))
+                digest.update(terrain_map.chunk(*key).grid.data)
+        else:
+            for z in range(terrain_map.layer_num):
+                for y in range(terrain_map.height):
+                    digest.update(
+                        terrain_map.row_bytes(z, 0, y, terrain_map.width))
+        digest.update(struct.pack("<dd", self.scroll_x, self.scroll_y))
+        for mob_state in self.mob_states():
+            digest.update(struct.pack("<dddd", *mob_state))
+
+    def save_world(self):
+        self.sm.game.world_manager.save_world_in_background(
+            self.world_name, self.terrain, list(self.mob_states()))
+
+    def autosave(self):
+        """Save every autosave_interval seconds of game time, unless the
+        last save is still being written
+        """
+        interval = self.sm.game.autosave_interval
+        if interval is None:
+            return
+        self.steps_since_save += 1
+        if (self.steps_since_save >= interval * SIM_RATE and
+                not self.sm.game.world_manager.saver.busy(self.world_name)):
+            self.steps_since_save = 0
+            self.save_world()
+
+    def load_world(self, name) -> bool:
+        """Load the saved world name and make it the one saved to.
+        Return False, leaving the scene as it was, if it cannot be read.
+        """
+        try:
+            tile_grid, mobs = self.sm.game.world_manager.load_world(
+                name, self.chunk_size)
+        except (OSError, worldfile.WorldFileError) as e:
+            print(f"could not load world {name}: {e}")
+            return False
+        self.world_name = name
+        self.terrain.set_map(tile_grid)
+        self.MAP_WIDTH = tile_grid.width
+        self.MAP_HEIGHT = tile_grid.height
+        for mob in list(self.mob_group):
+            mob.kill()
+        for x, y, max_sightrange, min_sightrange in mobs:
+            self.mob_group.add(HumanSprite(
+                x, y, self.terrain, sim=self.mob_sim,
+                max_sightrange=max_sightrange,
+                min_sightrange=min_sightrange, rng=self.rng))
+        return True
+
     def is_pos_on_map(self, pos):
         return (self.MAP_VIEWER_X <= pos[0] <=
                 (self.MAP_VIEWER_WIDTH + self.TILESIZE) and
                 self.MAP_VIEWER_Y <= pos[1] <=
                 (self.MAP_VIEWER_HEIGHT + self.TILESIZE))
 
+    def world_pos(self, screen_pos):
+        """World pixel under a screen position in the map viewer"""
+        return (self.scroll_x +
+                ((screen_pos[0] - self.MAP_VIEWER_X) << self.zoom),
+                self.scroll_y +
+                ((screen_pos[1] - self.MAP_VIEWER_Y) << self.zoom))
+
+    def set_zoom(self, zoom, screen_pos):
+        """Change the zoom level, keeping the world pixel at screen_pos
+        in place
+        """
+        zoom = min(max(zoom, 0), MAX_ZOOM)
+        if zoom == self.zoom:
+            return
+        world_x, world_y = self.world_pos(screen_pos)
+        self.zoom = zoom
+        self.scroll_x = world_x - ((screen_pos[0] - self.MAP_VIEWER_X) << zoom)
+        self.scroll_y = world_y - ((screen_pos[1] - self.MAP_VIEWER_Y) << zoom)
+        if zoom < LOD_ZOOM:
+            self.terrain_chunks = self.terrain_chunk_levels[zoom]
+
     def spawn_human_with_mouse(self, mouse_pos):
-        spawn_x = (self.scroll_x+mouse_pos[0]-self.MAP_VIEWER_X)
-        spawn_y = (self.scroll_y+mouse_pos[1]-self.MAP_VIEWER_Y)
-        human_sprite = HumanSprite(spawn_x, spawn_y, self.terrain)
+        spawn_x, spawn_y = self.world_pos(mouse_pos)
+        human_sprite = HumanSprite(
+            spawn_x, spawn_y, self.terrain, sim=self.mob_sim, rng=self.rng)
         self.mob_group.add(human_sprite)
 
-    def rewrite_tile_with_mouse(self, layer_id, tile_type, mouse_pos):
-        tile_x = (self.scroll_x+mouse_pos[0]-self.MAP_VIEWER_X)//self.TILESIZE
-        tile_y = (self.scroll_y+mouse_pos[1]-self.MAP_VIEWER_Y)//self.TILESIZE
-        self.terrain.rewrite_map_tile(layer_id, tile_x, tile_y, tile_type)
-
-    def destroy_tile_with_mouse(self, mouse_pos):
-        tile_x = (self.scroll_x+mouse_pos[0]-self.MAP_VIEWER_X)//self.TILESIZE
-        tile_y = (self.scroll_y+mouse_pos[1]-self.MAP_VIEWER_Y)//self.TILESIZE
-        self.terrain.rewrite_map_tile(3, tile_x, tile_y, None)
-        # for layer in range(len(self.terrain.map)):
-        # if self.terrain.map[layer][tile_y][tile_x]:
-        # print("aaa")
-        # self.terrain.rewrite_map_tile(layer, tile_x, tile_y, "Water")
+    def mouse_tile(self, mouse_pos):
+        world_x, world_y = self.world_pos(mouse_pos)
+        return world_x // self.TILESIZE, world_y // self.TILESIZE
+
+    def start_painting(self, tool, mouse_pos):
+        tile = self.mouse_tile(mouse_pos)
+        if self.paint_mode == "fill":
+            self.paint_edits.append((tool, "fill", [tile], 0))
+            return
+        self.paint_tool = tool
+        self.paint_start = tile
+        self.paint_last = tile
+        if self.paint_mode == "brush":
+            # the whole stroke is undone at once
+            self.terrain.history.begin_group()
+            self.paint_edits.append((tool, "brush", [tile],
+                                     self.brush_radius))
+
+    def continue_painting(self, mouse_pos):
+        if not self.is_pos_on_map(mouse_pos):
+            # the stroke starts over where the mouse comes back
+            if self.paint_mode == "brush":
+                self.paint_last = None
+            return
+        tile = self.mouse_tile(mouse_pos)
+        if tile == self.paint_last:
+            return
+        if self.paint_mode == "brush":
+            # every tile on the way, however fast the mouse moved
+            tiles = ([tile] if self.paint_last is None else
+                     tilepaint.line_points(*self.paint_last, *tile)[1:])
+            self.paint_edits.append((self.paint_tool, "brush", tiles,
+                                     self.brush_radius))
+        self.paint_last = tile
+
+    def finish_painting(self):
+        if self.paint_tool is None:
+            return
+        if self.paint_mode == "rect":
+            self.paint_edits.append(
+                (self.paint_tool, "rect", [self.paint_start, self.paint_last],
+                 0))
+        else:
+            self.apply_paint_edits()
+            self.terrain.history.end_group()
+        self.paint_tool = None
+
+    def apply_paint_edits(self):
+        """Write the edits painted since the last call in one terrain batch,
+        so they are notified once per layer
+        """
+        if not self.paint_edits:
+            return
+        edits = self.paint_edits
+        self.paint_edits = []
+        with self.terrain.batch():
+            for tool, mode, tiles, radius in edits:
+                if mode == "brush":
+                    spans = tilepaint.stroke_spans(tiles, radius)
+                elif mode == "rect":
+                    spans = tilepaint.rect_spans(*tiles[0], *tiles[1])
+                else:
+                    spans = tilepaint.flood_spans(
+                        self.terrain.map, *tiles[0], FLOOD_FILL_MAX_TILES)
+                for layer_id, tile in PAINT_TOOLS[tool]:
+                    self.terrain.fill_spans(layer_id, spans, tile)
+
+    def enter(self):
+        self.toolbar_stale = True
+        self.view_stale = True
 
     def render(self):
-        self.sm.screen.fill((127, 127, 255))
-        self.render_terrain(self.terrain.map)
-        self.render_minimap(self.terrain.map)
-        self.sm.screen.blit(self.minimap_surface,
-                            (16 + self.MAP_VIEWER_WIDTH + 8, 16),
-                            (0, 0, self.MAP_WIDTH, self.MAP_HEIGHT))
-        self.sm.screen.fill(
-            (144, 78, 144), (0, SCRN_HEIGHT - 139, 768, 139))
-        self.water_btn.set_image_with_icon(1, 2)
-        self.dirt_btn.set_image_with_icon(1, 1)
-        self.mount_btn.set_image_with_icon(1, 3)
-        self.human_btn.set_image_with_icon(1, 4)
-        self.tree_btn.set_image_with_icon(2, 1)
-        self.save_btn.set_image_with_icon(2, 2)
-        self.load_btn.set_image_with_icon(2, 3)
-        self.destroy_tile_btn.set_image_with_icon(2, 4)
-        self.mob_group.draw(self.map_surface)
-        self.btn_group.draw(self.sm.screen)
+        # edits painted while no update ran are shown all the same
+        self.apply_paint_edits()
+        viewer_rect = pygame.Rect(
+            self.MAP_VIEWER_X, self.MAP_VIEWER_Y, self.MAP_VIEWER_WIDTH,
+            self.MAP_VIEWER_HEIGHT)
+        if self.view_stale:
+            self.view_stale = False
+            view_rect = pygame.Rect(0, 0, SCRN_WIDTH, self.toolbar_rect.top)
+            self.sm.screen.fill(GAME_BG_COLOR, view_rect)
+            self.minimap_drawn_region = None
+            dirty_rects = [view_rect]
+        else:
+            self.sm.screen.fill(GAME_BG_COLOR, self.cursor_text_rect)
+            self.sm.screen.fill(GAME_BG_COLOR, viewer_rect)
+            dirty_rects = [self.cursor_text_rect, viewer_rect]
+        phase = self.sm.profiler.phase
+        with phase("terrain"):
+            if self.zoom < LOD_ZOOM:
+                self.render_terrain(self.terrain.map)
+        with phase("minimap"):
+            if self.render_minimap(self.terrain.map):
+                dirty_rects.append(self.sm.screen.blit(
+                    self.minimap_surface,
+                    (16 + self.MAP_VIEWER_WIDTH + 8, 16)))
+        with phase("ui"):
+            dirty_rects += self.render_toolbar()
+        with phase("terrain"):
+            if self.zoom < LOD_ZOOM:
+                self.blit_terrain()
+            else:
+                self.terrain_pyramid.render(
+                    self.sm.screen, self.terrain.map, self.zoom,
+                    self.level_viewport(),
+                    (self.MAP_VIEWER_X, self.MAP_VIEWER_Y))
+        with phase("mobs"):
+            self.render_mobs()
+            self.sm.screen.blit(self.mob_surface,
+                                (self.MAP_VIEWER_X, self.MAP_VIEWER_Y))
+        with phase("ui"):
+            if self.paint_tool is not None and self.paint_mode == "rect":
+                self.render_paint_rect(viewer_rect)
+            cursor_pos_text = asset_cache.text(
+                f"x:{self.sm.input.mouse_pos[0]} "
+                f"y:{self.sm.input.mouse_pos[1]} "
+                f"{self.paint_mode}:{self.brush_radius}", 32)
+            self.cursor_text_rect = self.sm.screen.blit(
+                cursor_pos_text, (0, 0))
+            dirty_rects.append(self.cursor_text_rect)
+        return dirty_rects
+
+    def render_paint_rect(self, viewer_rect):
+        """Outline the rectangle being dragged out inside the viewer"""
+        left = min(self.paint_start[0], self.paint_last[0])
+        top = min(self.paint_start[1], self.paint_last[1])
+        right = max(self.paint_start[0], self.paint_last[0]) + 1
+        bottom = max(self.paint_start[1], self.paint_last[1]) + 1
+        rect = pygame.Rect(
+            self.screen_pos((left*self.TILESIZE, top*self.TILESIZE)),
+            (max((right - left)*self.TILESIZE >> self.zoom, 1),
+             max((bottom - top)*self.TILESIZE >> self.zoom, 1)))
+        rect = rect.clip(viewer_rect)
+        if rect.width and rect.height:
+            pygame.draw.rect(self.sm.screen, WHITE, rect, 1)
+
+    def render_toolbar(self):
+        """Draw the toolbar where it changed and return the changed rects:
+        all of it when stale, the buttons when one changed state, else none.
+        """
+        changed = [btn for btn in self.btn_group if btn.refresh_image()]
+        if self.toolbar_stale:
+            self.toolbar_stale = False
+            self.sm.screen.fill(TOOLBAR_COLOR, self.toolbar_rect)
+            self.btn_group.draw(self.sm.screen)
+            return [self.toolbar_rect]
+        if not changed:
+            return []
+        self.btn_group.clear(
+            self.sm.screen, lambda screen, rect: screen.fill(
+                TOOLBAR_COLOR, rect))
+        return self.btn_group.draw(self.sm.screen)
+
+    def update_mobs(self):
+        if self.mob_sim is not None:
+            self.mob_sim.step(self.terrain.navigator, self.terrain.tilesize)
+        elif self.region_sim is not None:
+            self.update_mobs_in_regions()
+        else:
+            self.mob_group.update()
+
+    def update_mobs_in_regions(self):
+        """Step the mobs in the region_sim worker processes. Mobs with a
+        target follow flow fields of this process and are updated here.
+        """
+        mobs = []
         for mob in self.mob_group:
+            if mob.target_pos is None:
+                mobs.append(mob)
+            else:
+                mob.update()
+        if not mobs:
+            return
+        results = self.region_sim.step(
+            [(mob.x, mob.y, mob.max_sightrange, mob.min_sightrange)
+             for mob in mobs],
+            self.TILESIZE, 3, self.terrain.tile_id_assign["Tree"])
+        for mob, (x, y, dx, dy, found) in zip(mobs, results):
+            mob.x = x
+            mob.y = y
+            mob.dx = dx
+            mob.dy = dy
+            mob.update_img_pos()
+            mob.tree_in_sight = found
+
+    def visible_mobs(self):
+        """Mobs whose sprite or sight circle reaches the map viewer"""
+        viewport = pygame.Rect(self.scroll_x, self.scroll_y,
+                               self.MAP_VIEWER_WIDTH << self.zoom,
+                               self.MAP_VIEWER_HEIGHT << self.zoom)
+        if self.mob_sim is None:
+            margin = int(self.mob_group.max_sightrange) + self.TILESIZE
+            return [mob for mob in self.mob_group.spatial_hash.query_rect(
+                        *viewport.inflate(margin*2, margin*2))
+                    if viewport.colliderect(mob.rect.inflate(
+                        mob.max_sightrange*2, mob.max_sightrange*2))]
+        if not self.mob_sim.count:
+            return []
+        margin = int(self.mob_sim.max_sightrange[:self.mob_sim.count].max())
+        mobs = [self.mob_sim.owners[index]
+                for index in self.mob_sim.indices_in_rect(
+                    *viewport, margin + self.TILESIZE)]
+        for mob in mobs:
+            mob.sync_from_sim()
+        return mobs
+
+    def render_mobs(self):
+        self.mob_surface.fill((0, 0, 0, 0))
+        visible_mobs = self.visible_mobs()
+        if self.zoom:
+            # zoomed out, a mob is a dot
+            for mob in visible_mobs:
+                x, y = self.screen_pos(mob.rect.center)
+                self.mob_surface.fill(
+                    WHITE, (x - self.MAP_VIEWER_X - 1,
+                            y - self.MAP_VIEWER_Y - 1, 2, 2))
+        else:
+            self.mob_surface.blits(
+                [(mob.image, (mob.rect.x - self.scroll_x,
+                              mob.rect.y - self.scroll_y))
+                 for mob in visible_mobs], False)
+        for mob in visible_mobs:
             self.render_mob_sightrange(mob)
-        self.sm.screen.blit(self.map_surface,
-                            (self.MAP_VIEWER_X, self.MAP_VIEWER_Y),
-                            (0+self.scroll_x,
-                             0+self.scroll_y,
-                             self.MAP_VIEWER_WIDTH,
-                             self.MAP_VIEWER_HEIGHT))
-        self.mob_group.update()
-        font = pygame.font.Font(
-            str(assets_path.font_path("misaki_gothic_2nd.ttf")), 32)
-        cursor_pos_text = font.render(
-            f"x:{pygame.mouse.get_pos()[0]} y:{pygame.mouse.get_pos()[1]}",
-            True, WHITE)
-        self.sm.screen.blit(cursor_pos_text, (0, 0))
 
     def render_mob_sightrange(self, mob):
-        pygame.draw.circle(self.map_surface, (255, 0, 0),
-                           (mob.x+mob.rect.width//2, mob.y+mob.rect.height//2),
-                           mob.max_sightrange, 1)
+        radius = int(mob.max_sightrange) >> self.zoom
+        if radius < 2:
+            return
+        pygame.draw.circle(self.mob_surface, (255, 0, 0),
+                           ((mob.x+mob.rect.width//2-self.scroll_x)
+                            / (1 << self.zoom),
+                            (mob.y+mob.rect.height//2-self.scroll_y)
+                            / (1 << self.zoom)),
+                           radius, 1)
+
+    def on_terrain_write(self, layer_id, x, y, width, height):
+        if layer_id is None:
+            for terrain_chunks in self.terrain_chunk_levels:
+                terrain_chunks.clear()
+            self.terrain_pyramid.clear()
+            self.minimap_drawn_region = None
+            if (self.region_sim is not None and
+                    self.terrain.map is not self.region_sim.grid):
+                self.terrain.set_map(
+                    self.region_sim.share_grid(self.terrain.map))
+            return
+        if self.region_sim is not None:
+            self.region_sim.on_write(layer_id, x, y, width, height)
+        self.minimap_dirty_rects.append(pygame.Rect(x, y, width, height))
+        for terrain_chunks in self.terrain_chunk_levels:
+            for chunk in terrain_chunks.chunks.values():
+                chunk.drawn.fill(0, x - chunk.tile_x, y - chunk.tile_y,
+                                 width, height, 0)
+        self.terrain_pyramid.on_write(x, y, width, height)
+
+    def create_terrain_chunk(self, key, level=0):
+        x, y, width, height = self.terrain.map.clip_region(
+            key[0]*TERRAIN_CHUNK_SIZE, key[1]*TERRAIN_CHUNK_SIZE,
+            TERRAIN_CHUNK_SIZE, TERRAIN_CHUNK_SIZE)
+        if not width or not height:
+            return None
+        return TerrainChunkSurface(x, y, width, height,
+                                   self.TILESIZE >> level)
+
+    def screen_pos(self, world_pos):
+        """Screen position of a world pixel, the inverse of world_pos"""
+        return (self.MAP_VIEWER_X + ((world_pos[0] - self.scroll_x)
+                                     >> self.zoom),
+                self.MAP_VIEWER_Y + ((world_pos[1] - self.scroll_y)
+                                     >> self.zoom))
+
+    def level_viewport(self):
+        """The map viewer in pixels of the current zoom level"""
+        return pygame.Rect(self.scroll_x >> self.zoom,
+                           self.scroll_y >> self.zoom,
+                           self.MAP_VIEWER_WIDTH, self.MAP_VIEWER_HEIGHT)
+
+    def visible_tile_region(self, margin=1):
+        """Tile region (x, y, width, height) under the map viewer, grown by
+        margin tiles on each side and clipped to the map.
+        """
+        left = self.scroll_x // self.TILESIZE - margin
+        top = self.scroll_y // self.TILESIZE - margin
+        return self.terrain.map.clip_region(
+            left, top,
+            (self.MAP_VIEWER_WIDTH << self.zoom) // self.TILESIZE + 1 +
+            margin * 2,
+            (self.MAP_VIEWER_HEIGHT << self.zoom) // self.TILESIZE + 1 +
+            margin * 2)
+
+    def visible_terrain_chunks(self):
+        """Keys of the terrain chunks under the map viewer"""
+        x, y, width, height = self.visible_tile_region()
+        if not width or not height:
+            return []
+        size = TERRAIN_CHUNK_SIZE
+        return [(chunk_x, chunk_y)
+                for chunk_y in range(y // size, (y + height - 1) // size + 1)
+                for chunk_x in range(x // size, (x + width - 1) // size + 1)]
 
     def render_terrain(self, terrain_map):
-        sprite = SpriteSheet(assets_path.img_path(
-            "skyeyebg.png"), 1, 1, self.TILESIZE, self.TILESIZE, BLACK)
-        for z in range(len(terrain_map)):
-            for y in range(len(terrain_map[0])):
-                for x in range(len(terrain_map[0][0])):
-                    if terrain_map[z][y][x] == 1:
-                        self.map_surface.blit(
-                            sprite.image_by_cell(1, 1),
-                            (self.TILESIZE*x, self.TILESIZE*y))
-                    elif terrain_map[z][y][x] == 2:
-                        self.map_surface.blit(
-                            sprite.image_by_cell(1, 2),
-                            (self.TILESIZE*x, self.TILESIZE*y))
-                    elif terrain_map[z][y][x] == 3:
-                        self.map_surface.blit(
-                            sprite.image_by_cell(3, 1),
-                            (self.TILESIZE*x, self.TILESIZE*y))
-                    elif terrain_map[z][y][x] == 4:
-                        self.map_surface.blit(
-                            sprite.image_by_cell(2, 7),
-                            (self.TILESIZE*x, self.TILESIZE*y))
-                    elif terrain_map[z][y][x] == 5:
-                        self.map_surface.blit(
-                            sprite.image_by_cell(1, 5),
-                            (self.TILESIZE*x, self.TILESIZE*y))
-
-    def render_minimap(self, terrain_map):
-        for z in range(len(terrain_map)):
-            for y in range(len(terrain_map[0])):
-                for x in range(len(terrain_map[0][0])):
-                    minimap_tile_color = (0, 0, 0)
-                    if terrain_map[0][y][x] != 0:
-                        minimap_tile_color = (123, 0, 0)
-                        self.minimap_surface.fill((66, 66, 0), (x, y, 1, 1))
-                    if terrain_map[1][y][x] != 0:
-                        minimap_tile_color = (123, 123, 0)
-                        self.minimap_surface.fill((123, 123, 0), (x, y, 1, 1))
-                    if terrain_map[2][y][x] != 0:
-                        minimap_tile_color = (255, 255, 0)
-                    if terrain_map[3][y][x] != 0:
-                        minimap_tile_color = (78, 255, 125)
-                    self.minimap_surface.fill(minimap_tile_color, (x, y, 1, 1))
+        """Draw the stale tiles of the terrain chunks that are in view.
+        Stale tiles out of view are left until they are scrolled to.
+        """
+        view_region = self.visible_tile_region()
+        if isinstance(terrain_map, chunkgrid.ChunkedTileGrid):
+            terrain_map.pin_region(*view_region)
+        keys = self.visible_terrain_chunks()
+        self.terrain_chunks.pin(keys)
+        for key in keys:
+            self.render_terrain_chunk(
+                self.terrain_chunks.get(key), terrain_map, view_region)
+
+    def render_terrain_chunk(self, chunk, terrain_map, view_region):
+        view_x, view_y, view_width, view_height = view_region
+        # the part of the view inside the chunk, in chunk coordinates
+        x, y, width, height = chunk.drawn.clip_region(
+            view_x - chunk.tile_x, view_y - chunk.tile_y,
+            view_width, view_height)
+        drawn = chunk.drawn
+        tilesize = chunk.tilesize
+        tile_imgs = tile_atlas.scaled_tile_imgs(tilesize)
+        blit_sequence = []
+        for y in range(y, y + height):
+            row_start = drawn.index(0, x, y)
+            row_end = row_start + width
+            start = drawn.data.find(b"\0", row_start, row_end)
+            while start != -1:
+                end = drawn.data.find(b"\1", start, row_end)
+                if end == -1:
+                    end = row_end
+                run_x = x + start - row_start
+                run_width = end - start
+                drawn.data[start:end] = b"\1" * run_width
+                chunk.surface.fill(
+                    (0, 0, 0, 0),
+                    (run_x*tilesize, y*tilesize, run_width*tilesize,
+                     tilesize))
+                for z in range(len(terrain_map)):
+                    row = terrain_map.row_bytes(
+                        z, chunk.tile_x + run_x, chunk.tile_y + y, run_width)
+                    for i, tile_id in enumerate(row):
+                        if tile_id in tile_imgs:
+                            blit_sequence.append(
+                                (tile_imgs[tile_id],
+                                 (tilesize*(run_x + i), tilesize*y)))
+                start = drawn.data.find(b"\0", end, row_end)
+        if blit_sequence:
+            chunk.surface.blits(blit_sequence, False)
+
+    def blit_terrain(self):
+        viewport = self.level_viewport()
+        blit_sequence = []
+        for key in self.visible_terrain_chunks():
+            chunk = self.terrain_chunks.peek(key)
+            if chunk is None:
+                continue
+            area = chunk.rect.clip(viewport)
+            blit_sequence.append(
+                (chunk.surface,
+                 (self.MAP_VIEWER_X + area.x - viewport.x,
+                  self.MAP_VIEWER_Y + area.y - viewport.y),
+                 area.move(-chunk.rect.x, -chunk.rect.y)))
+        self.sm.screen.blits(blit_sequence, False)
+
+    def minimap_region(self):
+        """Tile region (x, y, width, height) shown on the minimap, centered
+        on the map viewer when the map is larger than MINIMAP_SIZE.
+        """
+        center_x = (self.scroll_x +
+                    (self.MAP_VIEWER_WIDTH << self.zoom) // 2) \
+            // self.TILESIZE
+        center_y = (self.scroll_y +
+                    (self.MAP_VIEWER_HEIGHT << self.zoom) // 2) \
+            // self.TILESIZE
+        width = min(self.MAP_WIDTH, MINIMAP_SIZE)
+        height = min(self.MAP_HEIGHT, MINIMAP_SIZE)
+        x = min(max(center_x - width // 2, 0), self.MAP_WIDTH - width)
+        y = min(max(center_y - height // 2, 0), self.MAP_HEIGHT - height)
+        return x, y, width, height
+
+    def render_minimap(self, terrain_map) -> bool:
+        """Redraw the minimap where tiles changed, or all of it when the
+        region it shows moved. Return whether anything was redrawn.
+        """
+        region = self.minimap_region()
+        if region != self.minimap_drawn_region:
+            if self.minimap_surface.get_size() != region[2:]:
+                self.minimap_surface = pygame.Surface(region[2:])
+            self.minimap_drawn_region = region
+            self.minimap_dirty_rects = [pygame.Rect(region)]
+        elif len(self.minimap_dirty_rects) > 64:
+            self.minimap_dirty_rects = [
+                self.minimap_dirty_rects[0].unionall(
+                    self.minimap_dirty_rects)]
+        region_rect = pygame.Rect(region)
+        redrawn = False
+        for rect in self.minimap_dirty_rects:
+            rect = rect.clip(region_rect)
+            if rect.width and rect.height:
+                self.minimap_surface.blit(
+                    minimap_image(terrain_map, *rect),
+                    (rect.x - region_rect.x, rect.y - region_rect.y))
+                redrawn = True
+        self.minimap_dirty_rects.clear()
+        return redrawn
 
 
 class WorldSelectScene(scenetrans.Scene):
+    """"Create new world" followed by the saved worlds from the catalog,
+    of which only the rows in view are drawn and have their thumbnails
+    loaded. z picks a row, x goes back to the title.
+    """
+    MENU_ITEM_WIDTH = 496
+    MENU_ITEM_HEIGHT = 64
+    MENU_ITEM_GAP = 8
+    MENU_TOP = 48
+    MENU_ITEMS_IN_VIEW = (SCRN_HEIGHT - MENU_TOP) // (
+        MENU_ITEM_HEIGHT + MENU_ITEM_GAP)
+    ROW_THUMBNAIL_SIZE = 56
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.wm = self.sm.game.world_manager
-        self.menu_items = ["P", ]
-        self.menu_item_num = len(self.menu_items)
+        self.drawn = False
+        self.worlds = []
+        self.menu_item_num = 1
         self.menu_select_num = 0
+        # index of the first row in view
+        self.menu_scroll = 0
+        # {world name: (mtime, thumbnail surface or None)}
+        self.thumbnails = {}
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
@@ -518,69 +1916,355 @@ class WorldSelectScene(scenetrans.Scene):
                 self.menu_select_num -= 1
                 if self.menu_select_num < 0:
                     self.menu_select_num = self.menu_item_num-1
+                self.scroll_to_selection()
             elif (event.key == pygame.K_DOWN or
                     event.key == pygame.K_RIGHT):
                 self.menu_select_num += 1
                 if self.menu_select_num > self.menu_item_num-1:
                     self.menu_select_num = 0
+                self.scroll_to_selection()
             elif (event.key == pygame.K_z):
+                game_scene = self.sm.scene("game")
                 if self.menu_select_num == 0:
-                    self.sm.set_current_scene("game")
-                if self.menu_select_num == 2:
-                    self.sm.set_current_scene("title")
+                    game_scene.world_name = self.wm.new_world_name()
+                elif not game_scene.load_world(
+                        self.worlds[self.menu_select_num - 1]["name"]):
+                    # stay here rather than open a blank map that saving
+                    # would write over the world
+                    return
+                self.sm.set_current_scene("game")
+            elif (event.key == pygame.K_x):
+                self.sm.set_current_scene("title")
+
+    def scroll_to_selection(self):
+        if self.menu_select_num < self.menu_scroll:
+            self.menu_scroll = self.menu_select_num
+        elif (self.menu_select_num >=
+                self.menu_scroll + self.MENU_ITEMS_IN_VIEW):
+            self.menu_scroll = (self.menu_select_num -
+                                self.MENU_ITEMS_IN_VIEW + 1)
+        self.drawn = False
 
     def update(self):
         pass
 
+    def enter(self):
+        self.worlds = self.wm.list_worlds()
+        self.menu_item_num = len(self.worlds) + 1
+        self.menu_select_num = min(self.menu_select_num,
+                                   self.menu_item_num - 1)
+        self.scroll_to_selection()
+
+    def thumbnail(self, world) -> pygame.Surface:
+        """Thumbnail of a catalog entry, loaded the first time it is needed,
+        or None if it has none
+        """
+        cached = self.thumbnails.get(world["name"])
+        if cached is not None and cached[0] == world["mtime"]:
+            return cached[1]
+        image = None
+        if world["thumbnail"] is not None:
+            try:
+                image = pygame.image.load(str(self.wm.thumbnail_path(
+                    world["thumbnail"]))).convert()
+            except (OSError, pygame.error):
+                pass
+        self.thumbnails[world["name"]] = world["mtime"], image
+        return image
+
     def render(self):
+        """Draw the menu when entered or scrolled, it does not change
+        otherwise
+        """
+        if self.drawn:
+            return []
+        self.drawn = True
         self.sm.screen.fill(BLACK)
-        font = pygame.font.Font(
-            str(assets_path.font_path("misaki_gothic_2nd.ttf")), 24)
-        world_preview_frame_img = pygame.image.load(
-            str(assets_path.img_path("world_picture_frame.png"))
-        ).convert_alpha()
-        MENU_ITEM_WIDTH = 496
-        MENU_ITEM_HEIGHT = 64
-        MENU_ITEM_X_POS = SCRN_WIDTH * 0.5 - MENU_ITEM_WIDTH * 0.5
-        self.sm.screen.fill(
-            (122, 122, 122),
-            (SCRN_WIDTH * 0.5 - MENU_ITEM_WIDTH * 0.5, 48,
-             MENU_ITEM_WIDTH, MENU_ITEM_HEIGHT))
+        world_preview_frame_img = asset_cache.image(
+            assets_path.img_path("world_picture_frame.png"))
         self.sm.screen.blit(world_preview_frame_img, (0, 0))
-        text = font.render("Create new world", True, WHITE)
-        self.sm.screen.blit(
-            text,
-            (MENU_ITEM_X_POS + MENU_ITEM_WIDTH * 0.5
-             - text.get_size()[0] * 0.5,
-             48 + MENU_ITEM_HEIGHT * 0.5
-             - text.get_size()[1] * 0.5))
+        if self.menu_select_num:
+            preview = self.thumbnail(self.worlds[self.menu_select_num - 1])
+            if preview is not None:
+                frame_rect = world_preview_frame_img.get_rect()
+                self.sm.screen.blit(
+                    pygame.transform.scale(
+                        preview, frame_rect.inflate(-8, -8).size),
+                    frame_rect.inflate(-8, -8))
+        for index in range(self.menu_scroll, min(
+                self.menu_scroll + self.MENU_ITEMS_IN_VIEW,
+                self.menu_item_num)):
+            self.render_menu_item(index, self.MENU_TOP + (
+                index - self.menu_scroll) * (self.MENU_ITEM_HEIGHT +
+                                             self.MENU_ITEM_GAP))
+        return None
+
+    def render_menu_item(self, index, y):
+        item_rect = pygame.Rect(
+            SCRN_WIDTH * 0.5 - self.MENU_ITEM_WIDTH * 0.5, y,
+            self.MENU_ITEM_WIDTH, self.MENU_ITEM_HEIGHT)
+        self.sm.screen.fill(
+            (170, 170, 170) if index == self.menu_select_num
+            else (122, 122, 122), item_rect)
+        if index == 0:
+            text = asset_cache.text("Create new world", 24)
+            self.sm.screen.blit(text, text.get_rect(center=item_rect.center))
+            return
+        world = self.worlds[index - 1]
+        thumbnail = self.thumbnail(world)
+        if thumbnail is not None:
+            self.sm.screen.blit(
+                pygame.transform.scale(
+                    thumbnail,
+                    (self.ROW_THUMBNAIL_SIZE, self.ROW_THUMBNAIL_SIZE)),
+                (item_rect.x + 4, item_rect.y + 4))
+        text_x = item_rect.x + self.ROW_THUMBNAIL_SIZE + 12
+        self.sm.screen.blit(asset_cache.text(world["name"], 24),
+                            (text_x, item_rect.y + 6))
+        details = "{}x{}  mobs {}  {}".format(
+            world["width"], world["height"], world["mob_count"],
+            time.strftime("%Y-%m-%d %H:%M",
+                          time.localtime(world["mtime"])))
+        self.sm.screen.blit(asset_cache.text(details, 16),
+                            (text_x, item_rect.y + 38))
+
+
+class PerfOverlay:
+    """Rolling graph of frame times and the mean time of each phase of the
+    last second, drawn over the current scene
+    """
+    WIDTH = 240
+    HEIGHT = 160
+    GRAPH_HEIGHT = 64
+    FONT_SIZE = 16
+
+    def __init__(self, frame_profiler, pos):
+        self.profiler = frame_profiler
+        self.rect = pygame.Rect(pos, (self.WIDTH, self.HEIGHT))
+        self.surface = pygame.Surface(self.rect.size)
+
+    def render(self, screen) -> pygame.Rect:
+        self.surface.fill(BLACK)
+        self.render_graph()
+        stats = self.profiler.stats(FPS)
+        if stats:
+            lines = ["{:5.1f} fps {:6.2f} ms".format(
+                1 / max(stats["frame"], 1e-6), stats["frame"] * 1000)]
+            lines += ["{:<8}{:6.2f}".format(name[:8], seconds * 1000)
+                      for name, seconds in stats.items() if name != "frame"]
+            column_width = self.WIDTH // 2
+            for index, line in enumerate(lines):
+                # the first line spans both columns
+                slot = index + 1 if index else 0
+                x = slot % 2 * column_width
+                y = self.GRAPH_HEIGHT + 4 + slot // 2 * self.FONT_SIZE
+                self.surface.blit(
+                    asset_cache.text(line, self.FONT_SIZE), (x, y))
+        return screen.blit(self.surface, self.rect)
+
+    def render_graph(self):
+        """One column per frame, newest on the right. The line marks the
+        frame time of FPS and taller columns are red.
+        """
+        target = 1 / FPS
+        scale = self.GRAPH_HEIGHT / (target * 2)
+        frames = list(self.profiler.frames)[-self.WIDTH:]
+        x = self.WIDTH - len(frames)
+        for frame in frames:
+            height = min(round(frame["frame"] * scale), self.GRAPH_HEIGHT)
+            color = (255, 64, 64) if frame["frame"] > target * 1.1 \
+                else (64, 255, 64)
+            pygame.draw.line(
+                self.surface, color, (x, self.GRAPH_HEIGHT - 1),
+                (x, self.GRAPH_HEIGHT - height), 1)
+            x += 1
+        target_y = self.GRAPH_HEIGHT - round(target * scale)
+        pygame.draw.line(self.surface, WHITE, (0, target_y),
+                         (self.WIDTH, target_y), 1)
 
 
 class Game:
-    def __init__(self):
+    def __init__(self, headless=False, seed=None, mob_processes=0,
+                 map_width=64, map_height=64, chunked_terrain=False,
+                 vectorized_mobs=False):
+        if headless:
+            # draw into offscreen surfaces, no window or sound device
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            os.environ["SDL_AUDIODRIVER"] = "dummy"
+        if seed is not None:
+            random.seed(seed)
+        self.seed = seed
         pygame.init()
         pygame.key.set_repeat(KEY_REPEAT_DELAY, KEY_REPEAT_INTERVAL)
         pygame.display.set_caption(GAME_TITLE)
         self.screen = pygame.display.set_mode(SCRN_SIZE)
         self.world_manager = WorldDataManager(MAIN_PRG_DIR / "saves")
+        # scenes update at SIM_RATE steps per second of game time however
+        # fast they render. Set timestep.speed to fast-forward the world or
+        # render_throttle.render_rate to render less often than FPS.
+        self.timestep = timestep.FixedTimestep(SIM_RATE, MAX_SIM_STEPS)
+        self.render_throttle = timestep.RenderThrottle(FPS)
         # sm means "screen manager"
         self.sm = GameSceneManager(self.screen, self)
+        # only the title is built up front, the other scenes when first
+        # shown, while their assets are read in the background meanwhile
         self.sm.append_scene("title", TitleScene(self.sm))
-        self.sm.append_scene("game", GameScene(self.sm))
-        self.sm.append_scene("world_select", WorldSelectScene(self.sm))
+        self.sm.append_scene("game", lambda: GameScene(
+            self.sm, seed=seed, map_width=map_width, map_height=map_height,
+            chunked_terrain=chunked_terrain, mob_processes=mob_processes,
+            vectorized_mobs=vectorized_mobs))
+        self.sm.append_scene("world_select", lambda: WorldSelectScene(self.sm))
         self.sm.set_current_scene("title")
-
-    def run(self):
+        asset_cache.preload(
+            [assets_path.img_path(filename) for filename in PRELOAD_IMAGES],
+            PRELOAD_FONT_SIZES)
+        # traces and cProfile stats of the debug keys are written here
+        self.profiles_dir = MAIN_PRG_DIR / "profiles"
+        self.perf_overlay = None
+        # a replay.Recorder the input of every frame is written to, and a
+        # replay.Replay to take it from instead of pygame
+        self.recorder = None
+        self.replay = None
+        self.frame_num = 0
+        # seconds of game time between autosaves of the game scene, None
+        # for none
+        self.autosave_interval = AUTOSAVE_INTERVAL
+
+    def run(self, max_frames=None):
+        """Run the game loop, forever unless max_frames is given. With a
+        replay, frames come from it without waiting for the frame rate and
+        the loop ends with the recording.
+        """
         clock = pygame.time.Clock()
-        while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    sys.exit()
-                self.sm.current_scene.handle_event(event)
-            self.sm.current_scene.update()
-            self.sm.current_scene.render()
-            pygame.display.update()
-            clock.tick(60)
+        elapsed = 0
+        frame = 0
+        frame_profiler = self.sm.profiler
+        frames = None if self.replay is None else self.replay.frames()
+        while max_frames is None or frame < max_frames:
+            frame += 1
+            frame_profiler.begin_frame()
+            with frame_profiler.phase("events"):
+                if frames is None:
+                    frame_input = self.poll_input(elapsed)
+                else:
+                    frame_input = next(frames, None)
+                    if frame_input is None:
+                        return
+                self.frame_num += 1
+                if self.recorder is not None:
+                    self.recorder.write_frame(frame_input)
+                self.sm.input = frame_input
+                for record in frame_input.events:
+                    event = input_event(record)
+                    if event.type == pygame.QUIT:
+                        sys.exit()
+                    self.sm.current_scene.handle_event(event)
+            with frame_profiler.phase("update"):
+                for _ in range(frame_input.steps):
+                    self.sm.current_scene.update()
+            if frame_input.render:
+                with frame_profiler.phase("render"):
+                    dirty_rects = self.sm.current_scene.render()
+                    if self.perf_overlay is not None:
+                        overlay_rect = self.perf_overlay.render(self.screen)
+                        if dirty_rects is not None:
+                            dirty_rects.append(overlay_rect)
+                with frame_profiler.phase("display"):
+                    self.sm.update_display(dirty_rects)
+            if frames is None:
+                elapsed = clock.tick(FPS) / 1000
+
+    def poll_input(self, elapsed) -> replay.FrameInput:
+        """Input of a frame from pygame, elapsed seconds after the last.
+        Debug keys are handled here and left out.
+        """
+        records = []
+        for event in pygame.event.get():
+            if (event.type == pygame.KEYDOWN and
+                    self.handle_debug_key(event.key)):
+                continue
+            record = event_record(event)
+            if record is not None:
+                records.append(record)
+        pressed = pygame.key.get_pressed()
+        return replay.FrameInput(
+            self.timestep.advance(elapsed),
+            self.render_throttle.due(elapsed), pygame.mouse.get_pos(),
+            pygame.mouse.get_pressed()[:3],
+            [key for key in WATCHED_KEYS if pressed[key]], records)
+
+    def state_digest(self) -> bytes:
+        """SHA-1 of the current scene and the game world, equal for runs
+        from the same seed and input
+        """
+        digest = hashlib.sha1()
+        for name, scene in self.sm.scene_list.items():
+            if scene is self.sm.current_scene:
+                digest.update(name.encode())
+        game_scene = self.sm.scene_list.get("game")
+        if game_scene is not None:
+            game_scene.hash_state(digest)
+        return digest.digest()
+
+    def handle_debug_key(self, key) -> bool:
+        """Handle the profiling keys and return whether key was one"""
+        if key == OVERLAY_KEY:
+            if self.perf_overlay is None:
+                self.perf_overlay = PerfOverlay(
+                    self.sm.profiler,
+                    (SCRN_WIDTH - PerfOverlay.WIDTH - 8,
+                     SCRN_HEIGHT - PerfOverlay.HEIGHT - 8))
+            else:
+                self.perf_overlay = None
+                # redraw what the overlay covered
+                self.sm.current_scene.enter()
+        elif key == TRACE_KEY:
+            path = self.profile_path("trace", "csv")
+            self.sm.profiler.write_trace(path)
+            print(f"wrote frame trace to {path}")
+        elif key == PROFILE_KEY:
+            if not self.sm.profiler.profiling:
+                path = self.profile_path("profile", "prof")
+                self.sm.profiler.start_profile(PROFILE_FRAMES, path)
+                print(f"profiling {PROFILE_FRAMES} frames to {path}")
+        else:
+            return False
+        return True
+
+    def profile_path(self, kind, suffix) -> pathlib.Path:
+        self.profiles_dir.mkdir(parents=True, exist_ok=True)
+        return self.profiles_dir / "{}-{}.{}".format(
+            kind, time.strftime("%Y%m%d-%H%M%S"), suffix)
+
+
+def event_record(event):
+    """(kind, code, mod, x, y, buttons) of an event for a recording, or
+    None for events the scenes do not handle
+    """
+    kind = RECORDED_EVENTS.get(event.type)
+    if kind is None:
+        return None
+    if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+        return kind, event.key, event.mod, 0, 0, 0
+    if event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+        return kind, event.button, 0, event.pos[0], event.pos[1], 0
+    if event.type == pygame.MOUSEMOTION:
+        return (kind, 0, 0, event.pos[0], event.pos[1],
+                replay.pack_buttons(event.buttons))
+    return kind, 0, 0, 0, 0, 0
+
+
+def input_event(record) -> pygame.event.Event:
+    kind, code, mod, x, y, buttons = record
+    event_type = EVENT_TYPES[kind]
+    if event_type in (pygame.KEYDOWN, pygame.KEYUP):
+        return pygame.event.Event(event_type, key=code, mod=mod)
+    if event_type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+        return pygame.event.Event(event_type, button=code, pos=(x, y))
+    if event_type == pygame.MOUSEMOTION:
+        return pygame.event.Event(event_type, pos=(x, y),
+                                  buttons=replay.unpack_buttons(buttons))
+    return pygame.event.Event(event_type)
 
 
 def text_pos_to_center(screen_size, text_size,
@@ -593,9 +2277,97 @@ def text_pos_to_center(screen_size, text_size,
             (screen_size[1]*0.5-text_size[1]*0.5)*multiply_to_fix_pos_y)
 
 
-def main():
-    game = Game()
-    game.run()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=GAME_TITLE)
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window, e.g. on CI")
+    parser.add_argument("--seed", type=int, help="seed for random numbers")
+    parser.add_argument("--frames", type=int,
+                        help="quit after running this many frames")
+    parser.add_argument("--scene", default="title",
+                        help="scene to start in (default: title)")
+    parser.add_argument("--mob-processes", type=int, default=0,
+                        help="step mobs in this many worker processes")
+    parser.add_argument("--vectorized-mobs", action="store_true",
+                        help="step all mobs at once with NumPy")
+    parser.add_argument("--map-size", type=int, default=64,
+                        help="tiles per side of a new world (default: 64)")
+    parser.add_argument("--chunked-terrain", action="store_true",
+                        help="keep the terrain in chunks swapped to disk, "
+                             "for very large worlds")
+    parser.add_argument("--record", metavar="PATH",
+                        help="record the input of the session to PATH")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="replay a recorded session headless, as fast "
+                             "as it runs, and check its final state")
+    args = parser.parse_args(argv)
+    if args.vectorized_mobs and not mobsim.is_available():
+        parser.error("--vectorized-mobs needs numpy")
+    if args.vectorized_mobs and args.mob_processes:
+        parser.error("--vectorized-mobs cannot be used with --mob-processes")
+    if args.chunked_terrain and args.mob_processes:
+        parser.error("--chunked-terrain cannot be used with --mob-processes")
+    if args.replay is not None:
+        replay_session(args.replay, args.frames)
+        return
+    if args.record is not None and args.seed is None:
+        # a recording needs a seed to replay from
+        args.seed = random.randrange(1 << 32)
+    game = Game(headless=args.headless, seed=args.seed,
+                mob_processes=args.mob_processes, map_width=args.map_size,
+                map_height=args.map_size,
+                chunked_terrain=args.chunked_terrain,
+                vectorized_mobs=args.vectorized_mobs)
+    game.sm.set_current_scene(args.scene)
+    if args.record is not None:
+        game.recorder = replay.Recorder(
+            args.record, args.seed, args.mob_processes, args.scene,
+            args.map_size, args.map_size, args.chunked_terrain,
+            args.vectorized_mobs)
+    try:
+        game.run(args.frames)
+    finally:
+        if game.recorder is not None:
+            game.recorder.close(game.state_digest())
+
+
+def replay_session(path, max_frames=None):
+    try:
+        session = replay.Replay(path)
+    except (OSError, replay.ReplayError) as e:
+        print(f"could not replay {path}: {e}")
+        return
+    if session.vectorized_mobs and not mobsim.is_available():
+        print(f"could not replay {path}: its mobs need numpy")
+        return
+    game = Game(headless=True, seed=session.seed,
+                mob_processes=session.mob_processes,
+                map_width=session.map_width, map_height=session.map_height,
+                chunked_terrain=session.chunked_terrain,
+                vectorized_mobs=session.vectorized_mobs)
+    # the saves of the session are not written again
+    game.autosave_interval = None
+    game.sm.set_current_scene(session.scene)
+    game.replay = session
+    start = time.perf_counter()
+    try:
+        game.run(max_frames)
+    except SystemExit:
+        # the session quit here
+        pass
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    print(f"replayed {game.frame_num} frames in {elapsed:.2f} s, "
+          f"{game.frame_num / FPS / elapsed:.1f}x real time")
+    digest = game.state_digest()
+    print(f"final state {digest.hex()}")
+    if session.digest is None:
+        print("the end of the recording was not reached, nothing to "
+              "check against")
+    elif digest == session.digest:
+        print("final state matches the recording")
+    else:
+        print(f"final state differs from the recorded "
+              f"{session.digest.hex()}")
 
 
 if __name__ == "__main__":